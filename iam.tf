@@ -32,7 +32,9 @@ resource "aws_iam_role_policy" "ec2_references_policy" {
 data "aws_iam_policy_document" "ec2_references_policy" {
   statement {
     actions = [
+      "s3:GetObject",
       "s3:PutObject",
+      "s3:DeleteObject",
     ]
     resources = [
       "${aws_s3_bucket.pgxflow-references.arn}/*",
@@ -77,6 +79,30 @@ data "aws_iam_policy_document" "lambda-initFlow" {
       "${aws_s3_bucket.pgxflow-references.arn}/*",
     ]
   }
+  statement {
+    actions = [
+      "s3:ListBucket",
+    ]
+    resources = [
+      aws_s3_bucket.pgxflow-bucket.arn,
+    ]
+    condition {
+      test     = "StringLike"
+      variable = "s3:prefix"
+      values = [
+        "vcf_profiles/*",
+      ]
+    }
+  }
+  statement {
+    actions = [
+      "s3:GetObject",
+      "s3:PutObject",
+    ]
+    resources = [
+      "${aws_s3_bucket.pgxflow-bucket.arn}/vcf_profiles/*",
+    ]
+  }
   statement {
     actions = [
       "dynamodb:GetItem",
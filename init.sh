@@ -37,4 +37,10 @@ cp ${SOURCE}/bcftools/bcftools ./layers/binaries/bin/
 
 # python libraries layer
 cd ${REPOSITORY_DIRECTORY}
-pip install ijson==3.3.0 --target layers/python_libraries/python
\ No newline at end of file
+# Binary wheels for the lambda runtime include the yajl2_c ijson backend
+pip install ijson==3.3.0 \
+    --platform manylinux2014_x86_64 \
+    --implementation cp \
+    --python-version 3.12 \
+    --only-binary=:all: \
+    --target layers/python_libraries/python
\ No newline at end of file
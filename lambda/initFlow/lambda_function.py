@@ -1,7 +1,6 @@
 import json
 from pathlib import Path
 import os
-import subprocess
 import traceback
 from urllib.parse import urlparse
 
@@ -10,17 +9,20 @@ from botocore.client import ClientError
 from shared.apiutils import bad_request, bundle_response
 from shared.dynamodb import check_user_in_project, update_clinic_job
 from shared.utils import (
+    get_vcf_profile,
     LoggingClient,
     handle_failed_execution,
     query_references_table,
     require_permission,
     InsufficientPermissionError,
 )
+from shared.utils.lambda_utils import ProcessError
 from dynamodb import does_clinic_job_exist_by_name
 from pharmcat import check_pharmcat_configuration
 from lookup import check_assoc_matrix
 
 HUB_NAME = os.environ["HUB_NAME"]
+PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
 PHARMCAT_PREPROCESSOR_SNS_TOPIC_ARN = os.environ["PHARMCAT_PREPROCESSOR_SNS_TOPIC_ARN"]
 LOOKUP_DBSNP_SNS_TOPIC_ARN = os.environ["LOOKUP_DBSNP_SNS_TOPIC_ARN"]
 PHARMCAT_HUBS = ["RSPON", "RSJPD"]
@@ -126,12 +128,6 @@ def parse_api_gateway(event):
     return result
 
 
-def get_sample_count(location):
-    cmd = f'bcftools query -l "{location}" | wc -l'
-    result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
-    return int(result.stdout.strip())
-
-
 def lambda_handler(event, context):
     print(f"Event received: {json.dumps(event)}")
     is_batch_job = False
@@ -175,11 +171,12 @@ def lambda_handler(event, context):
             return handle_init_failure(result, is_batch_job, pipeline_names)
 
         try:
-            sample_count = get_sample_count(location)
-        except subprocess.CalledProcessError as e:
-            result["error"] = f"Error counting samples: {str(e)}"
+            # Saved for the pipeline stages, so they don't read the VCF again
+            vcf_profile = get_vcf_profile(location, PGXFLOW_BUCKET)
+        except (ClientError, ProcessError) as e:
+            result["error"] = f"Error reading VCF header: {str(e)}"
             return handle_init_failure(result, is_batch_job, pipeline_names)
-        if sample_count != 1:
+        if len(vcf_profile["samples"]) != 1:
             result["error"] = "Only single-sample VCFs are supported."
             return handle_init_failure(result, is_batch_job, pipeline_names)
 
@@ -243,6 +240,7 @@ def lambda_handler(event, context):
                         "requestId": request_id,
                         "projectName": project,
                         "sourceVcfKey": source_vcf_key,
+                        "vcfProfileKey": vcf_profile["profile_key"],
                         "missingToRef": missing_to_ref,
                     }
                 )
@@ -87,6 +87,7 @@ module "lambda-initFlow" {
   tags = var.common-tags
 
   environment_variables = {
+    PGXFLOW_BUCKET                      = aws_s3_bucket.pgxflow-bucket.bucket
     REFERENCE_BUCKET                    = aws_s3_bucket.pgxflow-references.bucket
     PHARMCAT_PREPROCESSOR_SNS_TOPIC_ARN = module.pipeline_pharmcat.preprocessor_sns_topic_arn
     LOOKUP_DBSNP_SNS_TOPIC_ARN          = module.pipeline_lookup.dbsnp_sns_topic_arn
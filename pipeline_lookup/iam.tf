@@ -20,6 +20,7 @@ data "aws_iam_policy_document" "lambda-dbsnp" {
     ]
     resources = [
       var.pgxflow-reference-bucket-arn,
+      var.pgxflow-backend-bucket-arn,
     ]
   }
   statement {
@@ -29,14 +30,17 @@ data "aws_iam_policy_document" "lambda-dbsnp" {
     resources = [
       "${var.data-portal-bucket-arn}/projects/*/project-files/*",
       "${var.pgxflow-reference-bucket-arn}/*",
+      "${var.pgxflow-backend-bucket-arn}/*",
     ]
   }
   statement {
     actions = [
       "s3:PutObject",
+      "s3:AbortMultipartUpload",
     ]
     resources = [
       "${var.pgxflow-backend-bucket-arn}/*",
+      "${var.data-portal-bucket-arn}/projects/*/clinical-workflows/*",
     ]
   }
   statement {
@@ -48,6 +52,14 @@ data "aws_iam_policy_document" "lambda-dbsnp" {
       var.dynamo-clinic-jobs-table-arn,
     ]
   }
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      var.dynamo-references-table-arn,
+    ]
+  }
   statement {
     actions = [
       "lambda:InvokeFunction",
@@ -81,6 +93,7 @@ data "aws_iam_policy_document" "lambda-lookup" {
   statement {
     actions = [
       "s3:PutObject",
+      "s3:AbortMultipartUpload",
       "s3:DeleteObject",
     ]
     resources = [
@@ -105,9 +118,34 @@ data "aws_iam_policy_document" "lambda-lookup" {
       var.send-job-email-lambda-function-arn,
     ]
   }
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      var.dynamo-references-table-arn,
+    ]
+  }
 }
 
 data "aws_iam_policy_document" "lambda-gnomad" {
+  statement {
+    actions = [
+      "s3:GetObject",
+    ]
+    resources = [
+      "${var.pgxflow-reference-bucket-arn}/gnomad/*",
+    ]
+  }
+  statement {
+    actions = [
+      "s3:ListBucket",
+    ]
+    resources = [
+      var.pgxflow-reference-bucket-arn,
+      var.pgxflow-backend-bucket-arn,
+    ]
+  }
   statement {
     actions = [
       "s3:GetObject",
@@ -119,6 +157,7 @@ data "aws_iam_policy_document" "lambda-gnomad" {
   statement {
     actions = [
       "s3:PutObject",
+      "s3:AbortMultipartUpload",
     ]
     resources = [
       "${var.data-portal-bucket-arn}/projects/*/clinical-workflows/*",
@@ -149,6 +188,22 @@ data "aws_iam_policy_document" "lambda-gnomad" {
       var.send-job-email-lambda-function-arn,
     ]
   }
+  statement {
+    actions = [
+      "s3:PutObject",
+    ]
+    resources = [
+      "${var.pgxflow-backend-bucket-arn}/gnomad/*",
+    ]
+  }
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      var.dynamo-references-table-arn,
+    ]
+  }
 }
 
 #
@@ -1,33 +1,65 @@
 import csv
+import hashlib
 import json
 import os
+import shutil
 import subprocess
+import tempfile
+import time
 from io import StringIO
 
+from botocore.exceptions import ClientError
+
 from shared.utils import (
     LoggingClient,
     CheckedProcess,
-    get_chromosome_mapping,
-    match_chromosome_name,
+    DBSNP_SUBSET_ID,
+    get_dbsnp_subset_key,
+    get_row_interval,
+    get_vcf_profile,
     handle_failed_execution,
+    log_block_cache_stats,
+    merge_regions,
+    POSITION_JOIN_MODE,
+    query_references_table,
+    with_block_cache,
 )
+from shared.utils.lambda_utils import ProcessError
+from shared.dynamodb import update_clinic_job
+
+# The lookup and gnomad stages are packaged alongside this function so small
+# inputs can run through the whole pipeline in one invocation
+from lookup import lambda_function as lookup_stage
+from gnomad import lambda_function as gnomad_stage
 
 LOCAL_DIR = "/tmp"
 DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
 PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
 REFERENCE_BUCKET = os.environ["REFERENCE_BUCKET"]
 DBSNP_REFERENCE = os.environ["DBSNP_REFERENCE"]
+DBSNP_SUBSET_DIR = os.path.join(LOCAL_DIR, "dbsnp_subset")
+LOOKUP_REGIONS_PREFIX = "lookup_regions/"
+LOOKUP_REGIONS_DIR = os.path.join(LOCAL_DIR, "lookup_regions")
 LOOKUP_REFERENCE = os.environ["LOOKUP_REFERENCE"]
 PGXFLOW_LOOKUP_LAMBDA = os.environ["PGXFLOW_LOOKUP_LAMBDA"]
 CHR_HEADER = os.environ["CHR_HEADER"]
 START_HEADER = os.environ["START_HEADER"]
 END_HEADER = os.environ["END_HEADER"]
+# Source VCFs up to this size run every stage here instead of chaining lambdas
+FUSED_MAX_INPUT_BYTES = int(os.environ.get("FUSED_MAX_INPUT_BYTES", 256 * 1024 * 1024))
 
 lambda_client = LoggingClient("lambda")
 s3_client = LoggingClient("s3")
 
 
-def generate_target_region_files(source_chromosome_mapping):
+def read_lookup_regions(normalised_chromosomes):
+    """
+    Read the matrix coordinates on the given chromosomes and merge them.
+
+    Returns:
+        dict: The merged regions in normalised chromosome names and whether
+            every matrix row has coordinates
+    """
     assert LOOKUP_REFERENCE.endswith(".csv")
 
     response = s3_client.get_object(
@@ -35,26 +67,139 @@ def generate_target_region_files(source_chromosome_mapping):
         Key=LOOKUP_REFERENCE,
     )
     body = response["Body"]
-    csvfile = StringIO(body.read().decode("utf-8"))
+    csvfile = StringIO(body.read().decode("utf-8-sig"))
     reader = csv.DictReader(csvfile)
 
+    regions = []
+    all_rows_have_coordinates = True
+    n_rows = 0
+    for row in reader:
+        n_rows += 1
+        interval = get_row_interval(row, (CHR_HEADER, START_HEADER, END_HEADER))
+        if interval is None:
+            all_rows_have_coordinates = False
+        elif interval[0] in normalised_chromosomes:
+            regions.append(interval)
+    merged_regions = merge_regions(regions)
+    print(f"Merged regions of {n_rows} lookup rows into {len(merged_regions)}")
+    return {
+        "regions": merged_regions,
+        "all_rows_have_coordinates": all_rows_have_coordinates,
+    }
+
+
+def get_lookup_regions(source_chromosome_mapping):
+    """
+    Return the merged matrix regions for a source VCF.
+
+    They only depend on the lookup table and the chromosomes and naming of
+    the source VCF, so they are cached by those in LOCAL_DIR and S3.
+    """
+    lookup_hash = query_references_table("lookup_hash")
+    if lookup_hash is None:
+        return read_lookup_regions(set(source_chromosome_mapping.values()))
+    naming = hashlib.md5(
+        json.dumps(sorted(source_chromosome_mapping.items())).encode()
+    ).hexdigest()
+    cache_key = f"{LOOKUP_REGIONS_PREFIX}{lookup_hash}/{naming}.json"
+    local_cache_path = os.path.join(LOOKUP_REGIONS_DIR, lookup_hash, f"{naming}.json")
+    if os.path.exists(local_cache_path):
+        print(f"Using cached lookup regions {local_cache_path}")
+        with open(local_cache_path) as f:
+            return json.load(f)
+
+    try:
+        response = s3_client.get_object(Bucket=PGXFLOW_BUCKET, Key=cache_key)
+        lookup_regions = json.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        lookup_regions = read_lookup_regions(set(source_chromosome_mapping.values()))
+        s3_client.put_object(
+            Bucket=PGXFLOW_BUCKET,
+            Key=cache_key,
+            Body=json.dumps(lookup_regions).encode(),
+        )
+    # Regions for previous versions of the lookup table are no longer needed
+    if os.path.isdir(LOOKUP_REGIONS_DIR):
+        for cached_hash in os.listdir(LOOKUP_REGIONS_DIR):
+            if cached_hash != lookup_hash:
+                shutil.rmtree(os.path.join(LOOKUP_REGIONS_DIR, cached_hash))
+    os.makedirs(os.path.dirname(local_cache_path), exist_ok=True)
+    with open(local_cache_path, "w") as f:
+        json.dump(lookup_regions, f)
+    return lookup_regions
+
+
+def generate_target_region_files(source_chromosome_mapping):
+    """
+    Write the merged matrix regions in the source chromosome names.
+
+    Returns:
+        tuple: The regions path, whether any region is on a chromosome in the
+            source VCF and whether every matrix row has coordinates
+    """
+    lookup_regions = get_lookup_regions(source_chromosome_mapping)
     local_regions_path = os.path.join(LOCAL_DIR, "regions.txt")
-    local_norm_regions_path = os.path.join(LOCAL_DIR, "norm_regions.txt")
     reversed_chromosome_mapping = {v: k for k, v in source_chromosome_mapping.items()}
-    regions_exists = False
-    with open(local_regions_path, "w") as f, open(local_norm_regions_path, "w") as n_f:
-        for row in reader:
-            normalised_chr = match_chromosome_name(row[CHR_HEADER])
-            if normalised_chr not in reversed_chromosome_mapping:
-                continue
-            regions_exists = True
+    with open(local_regions_path, "w") as f:
+        for normalised_chr, start, end in lookup_regions["regions"]:
             chr = reversed_chromosome_mapping[normalised_chr]
-            start = row[START_HEADER]
-            end = row[END_HEADER]
             f.write(f"{chr}\t{start}\t{end}\n")
-            n_f.write(f"{normalised_chr}\t{start}\t{end}\n")
 
-    return local_regions_path, local_norm_regions_path, regions_exists
+    return (
+        local_regions_path,
+        bool(lookup_regions["regions"]),
+        lookup_regions["all_rows_have_coordinates"],
+    )
+
+
+def get_dbsnp_location():
+    """
+    Prefer the PGx dbSNP subset built by updateReferenceFiles if it matches
+    the current dbSNP and lookup table versions.
+
+    The subset is kept in LOCAL_DIR across warm starts, so it is only
+    downloaded again when a new version is published.
+    """
+    dbsnp_s3_uri = f"s3://{REFERENCE_BUCKET}/{DBSNP_REFERENCE}"
+    subset_version = query_references_table(DBSNP_SUBSET_ID)
+    dbsnp_version = query_references_table("dbsnp_version")
+    lookup_hash = query_references_table("lookup_hash")
+    if subset_version is None or not subset_version.startswith(
+        f"{dbsnp_version}:{lookup_hash}:"
+    ):
+        print("No dbSNP subset for the current lookup table, using the full dbSNP")
+        return with_block_cache(dbsnp_s3_uri)
+
+    subset_dir = os.path.join(
+        DBSNP_SUBSET_DIR, hashlib.md5(subset_version.encode()).hexdigest()
+    )
+    subset_key = get_dbsnp_subset_key(subset_version)
+    local_subset_path = os.path.join(subset_dir, os.path.basename(subset_key))
+    complete_marker = os.path.join(subset_dir, ".complete")
+    if os.path.exists(complete_marker):
+        print(f"Using cached dbSNP subset {subset_version}")
+        return local_subset_path
+    # Only one version of the subset is kept
+    shutil.rmtree(DBSNP_SUBSET_DIR, ignore_errors=True)
+    os.makedirs(subset_dir)
+    for key in [subset_key, f"{subset_key}.csi"]:
+        try:
+            s3_client.download_file(
+                Bucket=REFERENCE_BUCKET,
+                Key=key,
+                Filename=os.path.join(subset_dir, os.path.basename(key)),
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            # Replaced by a newer version since the table was read
+            print(f"dbSNP subset {subset_version} was removed, using the full dbSNP")
+            shutil.rmtree(DBSNP_SUBSET_DIR, ignore_errors=True)
+            return with_block_cache(dbsnp_s3_uri)
+    open(complete_marker, "w").close()
+    return local_subset_path
 
 
 def filter_and_rename_chrs(
@@ -65,8 +210,12 @@ def filter_and_rename_chrs(
         for orig, normalised in source_chromosome_mapping.items():
             f.write(f"{orig}\t{normalised}\n")
     try:
-        local_renamed_vcf_path = os.path.join(LOCAL_DIR, "renamed.vcf.gz")
+        start = time.perf_counter()
         if regions_exists:
+            # Only read by annotate_rsids, so it is written as BCF without
+            # compression. It can't be piped instead: bcftools annotate needs
+            # an indexed input to annotate from a VCF such as dbSNP.
+            local_renamed_vcf_path = os.path.join(LOCAL_DIR, "renamed.bcf")
             rename_vcf_args = [
                 "bcftools",
                 "annotate",
@@ -75,11 +224,13 @@ def filter_and_rename_chrs(
                 "-R",
                 local_regions_path,
                 source_vcf_s3_uri,
-                "-Oz",
+                "-Ob0",
+                "--write-index",
                 "-o",
                 local_renamed_vcf_path,
             ]
         else:
+            local_renamed_vcf_path = os.path.join(LOCAL_DIR, "renamed.vcf.gz")
             rename_vcf_args = [
                 "bcftools",
                 "annotate",
@@ -89,16 +240,17 @@ def filter_and_rename_chrs(
                 "0",
                 source_vcf_s3_uri,
                 "-Oz",
+                "--write-index",
                 "-o",
                 local_renamed_vcf_path,
             ]
         rename_vcf_process = CheckedProcess(rename_vcf_args)
         rename_vcf_process.check()
-
         local_renamed_vcf_index_path = f"{local_renamed_vcf_path}.csi"
-        index_renamed_vcf_args = ["bcftools", "index", local_renamed_vcf_path]
-        index_renamed_vcf_process = CheckedProcess(index_renamed_vcf_args)
-        index_renamed_vcf_process.check()
+        print(
+            f"Renamed chromosomes in {time.perf_counter() - start:.2f}s, wrote"
+            f" {os.path.getsize(local_renamed_vcf_path)} bytes"
+        )
 
         return local_renamed_vcf_path, local_renamed_vcf_index_path
     except subprocess.CalledProcessError as e:
@@ -107,30 +259,32 @@ def filter_and_rename_chrs(
         )
 
 
-def annotate_rsids(local_renamed_vcf_path, dbsnp_vcf_s3_uri, local_norm_regions_path):
+def annotate_rsids(local_renamed_vcf_path, dbsnp_vcf_location):
+    # The renamed VCF only holds records inside the regions already, so it is
+    # read through rather than filtered by them again
     try:
+        start = time.perf_counter()
         local_annotated_vcf_path = os.path.join(LOCAL_DIR, "annotated.vcf.gz")
         annotate_vcf_args = [
             "bcftools",
             "annotate",
             "--annotations",
-            dbsnp_vcf_s3_uri,
+            dbsnp_vcf_location,
             "--columns",
             "ID",
-            "-R",
-            local_norm_regions_path,
             local_renamed_vcf_path,
             "-Oz",
+            "--write-index",
             "-o",
             local_annotated_vcf_path,
         ]
         annotate_vcf_process = CheckedProcess(annotate_vcf_args)
         annotate_vcf_process.check()
-
         local_annotated_vcf_index_path = f"{local_annotated_vcf_path}.csi"
-        index_annotated_vcf_args = ["bcftools", "index", local_annotated_vcf_path]
-        index_annotated_vcf_process = CheckedProcess(index_annotated_vcf_args)
-        index_annotated_vcf_process.check()
+        print(
+            f"Annotated rsIDs in {time.perf_counter() - start:.2f}s, wrote"
+            f" {os.path.getsize(local_annotated_vcf_path)} bytes"
+        )
 
         return local_annotated_vcf_path, local_annotated_vcf_index_path
     except subprocess.CalledProcessError as e:
@@ -139,6 +293,96 @@ def annotate_rsids(local_renamed_vcf_path, dbsnp_vcf_s3_uri, local_norm_regions_
         )
 
 
+def use_fused_pipeline(source_vcf_key):
+    response = s3_client.head_object(Bucket=DPORTAL_BUCKET, Key=source_vcf_key)
+    input_size = response["ContentLength"]
+    fused = input_size <= FUSED_MAX_INPUT_BYTES
+    print(
+        f"Source VCF is {input_size} bytes, running the lookup pipeline"
+        f" {'in this invocation' if fused else 'across lambdas'}"
+    )
+    return fused
+
+
+def run_fused_pipeline(
+    request_id,
+    project,
+    format_tags,
+    local_renamed_vcf_path,
+    dbsnp_vcf_location,
+    annotate_ids,
+):
+    """
+    Run the annotation, lookup and gnomad stages without S3 hand-offs.
+
+    The annotated VCF is streamed from bcftools annotate straight into
+    bcftools query, and the lookup results are passed to gnomad in memory.
+    """
+    fields = lookup_stage.get_query_fields(format_tags)
+    query_args = [
+        "bcftools",
+        "query",
+        "-f",
+        "\t".join(fields.values()) + "\n",
+    ]
+    annotate_vcf_process = None
+    if annotate_ids:
+        annotate_vcf_args = [
+            "bcftools",
+            "annotate",
+            "--annotations",
+            dbsnp_vcf_location,
+            "--columns",
+            "ID",
+            local_renamed_vcf_path,
+            "-Ou",
+        ]
+        # Nothing reads annotate's stderr until query has finished, so a pipe
+        # could fill up and stall both processes
+        annotate_stderr = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        annotate_vcf_process = CheckedProcess(annotate_vcf_args, stderr=annotate_stderr)
+        query_process = CheckedProcess(
+            query_args + ["-"], stdin=annotate_vcf_process.stdout
+        )
+        # Only bcftools query should read the annotated records
+        annotate_vcf_process.stdout.close()
+    else:
+        query_process = CheckedProcess(query_args + [local_renamed_vcf_path])
+    join_mode = lookup_stage.LOOKUP_JOIN_MODE
+    lookup_results = list(
+        lookup_stage.join_lookup(
+            query_process.stdout,
+            fields,
+            lookup_stage.load_lookup_table(join_mode),
+            join_mode,
+        )
+    )
+    query_process.check()
+    if annotate_vcf_process is not None:
+        # check() can't be used with stdout handed over and stderr in a file
+        returncode = annotate_vcf_process.process.wait()
+        annotate_stderr.seek(0)
+        stderr = annotate_stderr.read()
+        annotate_stderr.close()
+        if returncode != 0:
+            raise ProcessError(
+                annotate_vcf_process.error_message,
+                None,
+                stderr,
+                returncode,
+                annotate_vcf_args,
+            )
+    os.remove(local_renamed_vcf_path)
+    os.remove(f"{local_renamed_vcf_path}.csi")
+    print(f"Found {len(lookup_results)} lookup results")
+
+    gnomad_stage.write_results(
+        request_id, project, gnomad_stage.annotate_batches([lookup_results])
+    )
+    log_block_cache_stats()
+    update_clinic_job(request_id, job_status="completed", pipeline_names=["lookup"])
+
+
 def lambda_handler(event, context):
     print(f"Event received: {json.dumps(event)}")
     message = json.loads(event["Records"][0]["Sns"]["Message"])
@@ -147,14 +391,25 @@ def lambda_handler(event, context):
     project = message["projectName"]
 
     source_vcf_s3_uri = f"s3://{DPORTAL_BUCKET}/{source_vcf_key}"
-    dbsnp_vcf_s3_uri = f"s3://{REFERENCE_BUCKET}/{DBSNP_REFERENCE}"
 
     try:
-        source_chromosome_mapping = get_chromosome_mapping(source_vcf_s3_uri)
+        vcf_profile = get_vcf_profile(
+            source_vcf_s3_uri, PGXFLOW_BUCKET, message.get("vcfProfileKey")
+        )
+        source_chromosome_mapping = vcf_profile["chromosome_mapping"]
 
-        local_regions_path, local_norm_regions_path, regions_exists = (
-            generate_target_region_files(source_chromosome_mapping)
+        (
+            local_regions_path,
+            regions_exists,
+            all_rows_have_coordinates,
+        ) = generate_target_region_files(source_chromosome_mapping)
+        # Position joins only need rsIDs for matrix rows without coordinates
+        annotate_ids = regions_exists and not (
+            lookup_stage.LOOKUP_JOIN_MODE == POSITION_JOIN_MODE
+            and all_rows_have_coordinates
         )
+        if regions_exists and not annotate_ids:
+            print("Every lookup row has coordinates, skipping dbSNP annotation")
 
         local_renamed_vcf_path, local_renamed_vcf_index_path = filter_and_rename_chrs(
             source_vcf_s3_uri,
@@ -163,16 +418,32 @@ def lambda_handler(event, context):
             regions_exists,
         )
 
-        if regions_exists:
+        dbsnp_vcf_location = get_dbsnp_location() if annotate_ids else None
+
+        if use_fused_pipeline(source_vcf_key):
+            run_fused_pipeline(
+                request_id,
+                project,
+                vcf_profile["format_tags"],
+                local_renamed_vcf_path,
+                dbsnp_vcf_location,
+                annotate_ids,
+            )
+            return
+
+        if annotate_ids:
             local_annotated_vcf_path, local_annotated_vcf_index_path = annotate_rsids(
-                local_renamed_vcf_path, dbsnp_vcf_s3_uri, local_norm_regions_path
+                local_renamed_vcf_path, dbsnp_vcf_location
             )
             os.remove(local_renamed_vcf_path)
+            os.remove(local_renamed_vcf_index_path)
+            log_block_cache_stats()
         else:
             local_annotated_vcf_path = local_renamed_vcf_path
             local_annotated_vcf_index_path = local_renamed_vcf_index_path
 
-        annotated_vcf_key = f"annotated_{request_id}.vcf.gz"
+        extension = ".bcf" if local_annotated_vcf_path.endswith(".bcf") else ".vcf.gz"
+        annotated_vcf_key = f"annotated_{request_id}{extension}"
         s3_client.upload_file(
             Bucket=PGXFLOW_BUCKET,
             Key=annotated_vcf_key,
@@ -197,6 +468,7 @@ def lambda_handler(event, context):
                     "requestId": request_id,
                     "projectName": project,
                     "dbsnpAnnotatedVcfLocation": annotated_vcf_location,
+                    "vcfProfileKey": vcf_profile["profile_key"],
                 }
             ),
         )
@@ -2,103 +2,78 @@ from collections import defaultdict
 import json
 import os
 
-from shared.utils import CheckedProcess, handle_failed_execution, LoggingClient
+from shared.utils import (
+    GNOMAD_CACHE_RELEASE,
+    GnomadCache,
+    handle_failed_execution,
+    LoggingClient,
+    load_gnomad_subset,
+    log_block_cache_stats,
+    query_gnomad,
+    S3MultipartWriter,
+)
 from shared.dynamodb import update_clinic_job
 
 LOCAL_DIR = "/tmp"
 RESULT_SUFFIX = os.environ["RESULT_SUFFIX"]
 DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
 PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
-GNOMAD_S3_PREFIX = "https://gnomad-public-us-east-1.s3.amazonaws.com/release/4.1/vcf/genomes/gnomad.genomes.v4.1.sites."
-GNOMAD_S3_SUFFIX = ".vcf.bgz"
-MAX_REGIONS_PER_QUERY = 20
-# Just the columns after the identifying columns
-GNOMAD_COLUMNS = {
-    "afAfr": "INFO/AF_afr",
-    "afEas": "INFO/AF_eas",
-    "afFin": "INFO/AF_fin",
-    "afNfe": "INFO/AF_nfe",
-    "afSas": "INFO/AF_sas",
-    "afAmr": "INFO/AF_amr",
-    "af": "INFO/AF",
-    "ac": "INFO/AC",
-    "an": "INFO/AN",
-    "siftMax": "INFO/sift_max",
-}
+REFERENCE_BUCKET = os.environ["REFERENCE_BUCKET"]
+GNOMAD_BATCH_SIZE = int(os.environ.get("GNOMAD_BATCH_SIZE", 10000))
 
 s3_client = LoggingClient("s3")
+# Kept between invocations so an unchanged cache isn't downloaded again
+gnomad_cache = GnomadCache(PGXFLOW_BUCKET, GNOMAD_CACHE_RELEASE, LOCAL_DIR)
 
 
-def get_query_process(regions, ref_chrom):
-    chrom = f"chr{ref_chrom}"
-    args = [
-        "bcftools",
-        "query",
-        "--regions",
-        ",".join(f"{chrom}:{pos}" for pos, _, _ in regions),
-        "--format",
-        f"%POS\t%REF\t%ALT\t{'\\t'.join("%" + val for val in GNOMAD_COLUMNS.values())}\n",
-        f"{GNOMAD_S3_PREFIX}{chrom}{GNOMAD_S3_SUFFIX}",
-    ]
-    return CheckedProcess(args, error_message="bcftools error querying gnomAD")
+def add_gnomad_data(input_data, gnomad_subset):
+    rows = defaultdict(list)
+    positions = defaultdict(set)
+    for data in input_data:
+        chrom = data["chromVcf"]
+        rows[(chrom, data["posVcf"], data["refVcf"], data["altVcf"])].append(data)
+        positions[chrom].add(data["posVcf"])
+    lines_updated = 0
+    for *key, values in query_gnomad(positions, gnomad_subset, gnomad_cache):
+        for data in rows.get(tuple(key), []):
+            data.update(values)
+            lines_updated += 1
+    print(f"Updated {lines_updated}/{len(input_data)} rows with gnomad data")
 
 
-def convert_to_region_lines(input_data):
-    regions_data = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
-    for data in input_data:
-        regions_data[data["chromVcf"]][data["posVcf"]][
-            (data["refVcf"], data["altVcf"])
-        ].append(data)
-    # Split into chunks of MAX_REGIONS_PER_QUERY
-    region_query_lines = []
-    for chrom, pos_lines in regions_data.items():
-        pos_list = sorted(list(pos_lines.keys()))
-        region_chunks = [
-            pos_list[i : i + MAX_REGIONS_PER_QUERY]
-            for i in range(0, len(pos_list), MAX_REGIONS_PER_QUERY)
-        ]
-        region_query_lines.extend(
-            [
-                (
-                    chrom,
-                    {
-                        (pos, ref, alt): data_value
-                        for pos in region_chunk
-                        for (ref, alt), data_value in regions_data[chrom][pos].items()
-                    },
-                )
-                for region_chunk in region_chunks
-            ]
-        )
-    return region_query_lines
+def read_batches(lines, batch_size=GNOMAD_BATCH_SIZE):
+    """Parse JSON lines into lists of at most batch_size rows."""
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(json.loads(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
-def add_gnomad_data(input_data):
-    region_queries_lines = convert_to_region_lines(input_data)
-    query_processes = [
-        get_query_process(query_region.keys(), chrom)
-        for chrom, query_region in region_queries_lines
-    ]
-    lines_updated = 0
-    for query_process, (_, regions_data) in zip(query_processes, region_queries_lines):
-        for line in query_process.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            pos_s, ref, alt, *query_data = line.split("\t")
-            pos = int(pos_s)
-            for data in regions_data.get((pos, ref, alt), []):
-                data.update(
-                    {
-                        col_name: gnomad_datum
-                        for col_name, gnomad_datum in zip(
-                            list(GNOMAD_COLUMNS.keys()), query_data
-                        )
-                    }
-                )
-                lines_updated += 1
-        query_process.check()
-    print(f"Updated {lines_updated}/{len(input_data)} rows with gnomad data")
+def annotate_batches(input_batches):
+    # Every batch shares one load of the subset and cache, and the results of
+    # all of them are saved to the cache together
+    gnomad_subset = load_gnomad_subset(REFERENCE_BUCKET, LOCAL_DIR)
+    gnomad_cache.load()
+    for input_data in input_batches:
+        add_gnomad_data(input_data, gnomad_subset)
+        yield input_data
+    gnomad_cache.save()
+
+
+def write_results(request_id, project_name, result_batches):
+    s3_output_key = (
+        f"projects/{project_name}/clinical-workflows/{request_id}{RESULT_SUFFIX}"
+    )
+    with S3MultipartWriter(DPORTAL_BUCKET, s3_output_key) as writer:
+        for results in result_batches:
+            for line in results:
+                writer.write(json.dumps(line) + "\n")
 
 
 def lambda_handler(event, context):
@@ -111,23 +86,10 @@ def lambda_handler(event, context):
             Bucket=PGXFLOW_BUCKET,
             Key=input_data_key,
         )
-        input_data = json.loads(response["Body"].read().decode("utf-8"))
-        add_gnomad_data(input_data)
-        local_output_path = os.path.join(LOCAL_DIR, f"results.jsonl")
-        with open(local_output_path, "w") as output_file:
-            for line in input_data:
-                json.dump(line, output_file)
-                output_file.write("\n")
-
-        s3_output_key = (
-            f"projects/{project_name}/clinical-workflows/{request_id}{RESULT_SUFFIX}"
-        )
-
-        s3_client.upload_file(
-            Bucket=DPORTAL_BUCKET,
-            Key=s3_output_key,
-            Filename=local_output_path,
-        )
+        # Only one batch of rows is held in memory at a time
+        input_batches = read_batches(response["Body"].iter_lines())
+        write_results(request_id, project_name, annotate_batches(input_batches))
+        log_block_cache_stats()
 
         s3_client.delete_object(
             Bucket=PGXFLOW_BUCKET,
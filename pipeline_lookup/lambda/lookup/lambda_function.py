@@ -4,7 +4,27 @@ import json
 import os
 from urllib.parse import urlparse
 
-from shared.utils import CheckedProcess, handle_failed_execution, LoggingClient
+from botocore.exceptions import ClientError
+
+from shared.utils import (
+    CheckedProcess,
+    get_lookup_index_key,
+    get_row_interval,
+    handle_failed_execution,
+    LoggingClient,
+    load_vcf_profile,
+    LOOKUP_INDEX_SUFFIX,
+    LookupIndex,
+    LookupIndexError,
+    match_chromosome_name,
+    POSITION_JOIN_MODE,
+    query_references_table,
+    read_vcf_profile,
+    RSID_JOIN_MODE,
+    S3MultipartWriter,
+    write_lookup_index,
+)
+from shared.utils.chrom_matching import ChromosomeNotFoundError
 
 LOCAL_DIR = os.environ.get("LOCAL_DIR", "/tmp")
 DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
@@ -12,10 +32,26 @@ PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
 REFERENCE_BUCKET = os.environ["REFERENCE_BUCKET"]
 LOOKUP_REFERENCE = os.environ["LOOKUP_REFERENCE"]
 PGXFLOW_GNOMAD_LAMBDA = os.environ["PGXFLOW_GNOMAD_LAMBDA"]
+LOOKUP_INDEX_DIR = os.path.join(LOCAL_DIR, "lookup_index")
+VARIANT_HEADER = "Variant"
+CHR_HEADER = os.environ["CHR_HEADER"]
+START_HEADER = os.environ["START_HEADER"]
+END_HEADER = os.environ["END_HEADER"]
+# "rsid" joins on dbSNP IDs, "position" joins on the matrix coordinates and
+# only uses rsIDs for rows without them
+LOOKUP_JOIN_MODE = os.environ.get("LOOKUP_JOIN_MODE", RSID_JOIN_MODE)
+# Optional matrix column holding the alt allele a row applies to
+LOOKUP_ALLELE_HEADER = os.environ.get("LOOKUP_ALLELE_HEADER", "")
+if LOOKUP_JOIN_MODE not in (RSID_JOIN_MODE, POSITION_JOIN_MODE):
+    raise ValueError(f"Unknown LOOKUP_JOIN_MODE {LOOKUP_JOIN_MODE!r}")
 
 s3_client = LoggingClient("s3")
 lambda_client = LoggingClient("lambda")
 
+# Kept across warm starts, keyed by lookup_hash
+loaded_lookup_index = {}
+compiled_lookup_index = {}
+
 
 REQUESTED_FIELDS = {
     "_rsid": "%ID",
@@ -36,25 +72,22 @@ REQUESTED_FORMAT_TAGS = {
 }
 
 
-def get_format_tags(location):
-    args = [
-        "bcftools",
-        "head",
-        location,
-    ]
-    process = CheckedProcess(args, cwd=LOCAL_DIR)
-    format_tags = {
-        line.split("ID=")[1].split(",")[0]
-        for line in process.stdout
-        if line.startswith("##FORMAT=<ID=")
-    }
-    process.check()
+def get_format_tags(location, vcf_profile_key=None):
+    """
+    Return the FORMAT tags of the source VCF from the profile saved by
+    initFlow, reading the VCF header only if there is no profile.
+    """
+    vcf_profile = None
+    if vcf_profile_key is not None:
+        vcf_profile = load_vcf_profile(PGXFLOW_BUCKET, vcf_profile_key)
+    if vcf_profile is None:
+        vcf_profile = read_vcf_profile(location, cwd=LOCAL_DIR)
+    format_tags = set(vcf_profile["format_tags"])
     print("Found FORMAT tags:", format_tags)
     return format_tags
 
 
-def get_query_fields(location):
-    format_tags = get_format_tags(location)
+def get_query_fields(format_tags):
     return {
         **REQUESTED_FIELDS,
         **{
@@ -74,7 +107,7 @@ def load_lookup():
     reader = csv.DictReader(csvfile)
     lookup_table = {}
     for row in reader:
-        rsid = row["Variant"]
+        rsid = row[VARIANT_HEADER]
         values = {key: row[key] for key in row}
         if rsid in lookup_table:
             lookup_table[rsid].append(values)
@@ -83,6 +116,169 @@ def load_lookup():
     return lookup_table
 
 
+def load_lookup_index(lookup_hash):
+    """
+    Memory-map the compiled lookup index for the current lookup_hash.
+
+    The index is cached in LOCAL_DIR so warm starts only pay for the mmap.
+    Returns None if no index has been published for the current hash.
+    """
+    if lookup_hash is None:
+        print("No lookup_hash in the references table")
+        return None
+    if lookup_hash in loaded_lookup_index:
+        return loaded_lookup_index[lookup_hash]
+
+    os.makedirs(LOOKUP_INDEX_DIR, exist_ok=True)
+    index_filename = f"{lookup_hash}{LOOKUP_INDEX_SUFFIX}"
+    local_index_path = os.path.join(LOOKUP_INDEX_DIR, index_filename)
+    if not os.path.exists(local_index_path):
+        # Remove indexes for previous versions of the lookup table
+        for filename in os.listdir(LOOKUP_INDEX_DIR):
+            os.remove(os.path.join(LOOKUP_INDEX_DIR, filename))
+        partial_index_path = f"{local_index_path}.partial"
+        try:
+            s3_client.download_file(
+                Bucket=REFERENCE_BUCKET,
+                Key=get_lookup_index_key(LOOKUP_REFERENCE, lookup_hash),
+                Filename=partial_index_path,
+            )
+        except ClientError as e:
+            print(f"Unable to download lookup index: {e}")
+            return None
+        os.rename(partial_index_path, local_index_path)
+
+    try:
+        lookup_index = LookupIndex(local_index_path)
+    except LookupIndexError as e:
+        print(f"Unable to load lookup index: {e}")
+        os.remove(local_index_path)
+        return None
+    for previous_index in loaded_lookup_index.values():
+        previous_index.close()
+    loaded_lookup_index.clear()
+    loaded_lookup_index[lookup_hash] = lookup_index
+    print(f"Loaded lookup index with {lookup_index.n_rows} rows")
+    return lookup_index
+
+
+def compile_lookup_index(lookup_hash):
+    """
+    Build an index with coordinates from the CSV, for position joins.
+
+    Like a published index, it is kept in LOCAL_DIR for warm starts with the
+    same lookup_hash, and removed with it once the hash changes.
+    """
+    if lookup_hash in compiled_lookup_index:
+        return compiled_lookup_index[lookup_hash]
+    os.makedirs(LOOKUP_INDEX_DIR, exist_ok=True)
+    local_index_path = os.path.join(
+        LOOKUP_INDEX_DIR, f"local_{lookup_hash}{LOOKUP_INDEX_SUFFIX}"
+    )
+    # Without a hash there is no way to tell whether the CSV has changed
+    if lookup_hash is None or not os.path.exists(local_index_path):
+        response = s3_client.get_object(Bucket=REFERENCE_BUCKET, Key=LOOKUP_REFERENCE)
+        reader = csv.DictReader(
+            io.StringIO(response["Body"].read().decode("utf-8-sig"))
+        )
+        partial_index_path = f"{local_index_path}.partial"
+        write_lookup_index(
+            partial_index_path,
+            reader.fieldnames,
+            reader,
+            VARIANT_HEADER,
+            interval_columns=(CHR_HEADER, START_HEADER, END_HEADER),
+        )
+        # Replaced rather than rewritten, as a previous copy may still be mapped
+        os.replace(partial_index_path, local_index_path)
+    lookup_index = LookupIndex(local_index_path)
+    if lookup_hash is not None:
+        for previous_index in compiled_lookup_index.values():
+            previous_index.close()
+        compiled_lookup_index.clear()
+        compiled_lookup_index[lookup_hash] = lookup_index
+    return lookup_index
+
+
+def load_lookup_table(join_mode=RSID_JOIN_MODE):
+    if join_mode == POSITION_JOIN_MODE and not LOOKUP_ALLELE_HEADER:
+        # Without an allele column a row matches every alt at its position
+        print(
+            "WARNING: LOOKUP_JOIN_MODE is position but LOOKUP_ALLELE_HEADER is"
+            " not set, so lookup rows are joined on position only and apply to"
+            " every alt allele at a matching position"
+        )
+    lookup_hash = query_references_table("lookup_hash")
+    lookup_table = load_lookup_index(lookup_hash)
+    if join_mode == POSITION_JOIN_MODE:
+        if lookup_table is None or not lookup_table.has_intervals:
+            print("Lookup index has no coordinates, compiling one from CSV")
+            lookup_table = compile_lookup_index(lookup_hash)
+    elif lookup_table is None:
+        print("Falling back to loading the lookup table from CSV")
+        lookup_table = load_lookup()
+    return lookup_table
+
+
+def get_lookup_matches(lookup_table, join_mode, rsid, chrom, pos):
+    """Return the lookup rows matching a variant under the join mode."""
+    if join_mode != POSITION_JOIN_MODE:
+        return lookup_table.get(rsid, [])
+    try:
+        matches = lookup_table.overlapping(match_chromosome_name(chrom), pos)
+    except ChromosomeNotFoundError:
+        matches = []
+    # Rows without coordinates can still be found by rsID
+    interval_columns = (CHR_HEADER, START_HEADER, END_HEADER)
+    matches.extend(
+        row
+        for row in lookup_table.get(rsid, [])
+        if get_row_interval(row, interval_columns) is None
+    )
+    return matches
+
+
+def join_lookup(query_lines, fields, lookup_table, join_mode=RSID_JOIN_MODE):
+    """
+    Join bcftools query output against the lookup table.
+
+    Args:
+        query_lines (Iterable[str]): Lines of bcftools query output in the
+            order of fields
+        fields (dict): Output keys mapped to their bcftools format strings
+        lookup_table (dict | LookupIndex): Lookup rows keyed by rsID. Position
+            joins need a LookupIndex with intervals.
+        join_mode (str): RSID_JOIN_MODE or POSITION_JOIN_MODE
+
+    Yields:
+        dict: A lookup result for each alt allele of each matching variant
+    """
+    for line in query_lines:
+        line_fields = {
+            key: value for key, value in zip(fields.keys(), line.strip().split("\t"))
+        }
+        rsid = line_fields.pop("_rsid")
+        alts = line_fields.pop("_alts")
+        line_fields["posVcf"] = int(line_fields["posVcf"])
+        for lookup_values in get_lookup_matches(
+            lookup_table,
+            join_mode,
+            rsid,
+            line_fields["chromVcf"],
+            line_fields["posVcf"],
+        ):
+            lookup_allele = lookup_values.get(LOOKUP_ALLELE_HEADER) or None
+            for allele in alts.split(","):
+                if allele == "." or lookup_allele not in (None, allele):
+                    continue
+                yield dict(
+                    **lookup_values,
+                    refVcf=line_fields["refVcf"],
+                    altVcf=allele,
+                    **{k: v for k, v in line_fields.items() if k != "refVcf"},
+                )
+
+
 def lambda_handler(event, context):
     print(f"Event received: {json.dumps(event)}")
     request_id = event["requestId"]
@@ -90,7 +286,10 @@ def lambda_handler(event, context):
     dbsnp_annotated_vcf_location = event["dbsnpAnnotatedVcfLocation"]
     dbsnp_annotated_vcf_parsed = urlparse(dbsnp_annotated_vcf_location)
     dbsnp_annotated_vcf_key = dbsnp_annotated_vcf_parsed.path.lstrip("/")
-    fields = get_query_fields(dbsnp_annotated_vcf_location)
+    format_tags = get_format_tags(
+        dbsnp_annotated_vcf_location, event.get("vcfProfileKey")
+    )
+    fields = get_query_fields(format_tags)
 
     try:
         query_rsid_args = [
@@ -101,36 +300,15 @@ def lambda_handler(event, context):
             dbsnp_annotated_vcf_location,
         ]
         query_rsid_process = CheckedProcess(query_rsid_args, cwd=LOCAL_DIR)
-        lookup_table = load_lookup()
-        lookup_results = []
-        for line in query_rsid_process.stdout:
-            line_fields = {
-                key: value
-                for key, value in zip(fields.keys(), line.strip().split("\t"))
-            }
-            rsid = line_fields.pop("_rsid")
-            alts = line_fields.pop("_alts")
-            line_fields["posVcf"] = int(line_fields["posVcf"])
-            for lookup_values in lookup_table.get(rsid, []):
-                for allele in alts.split(","):
-                    if allele == ".":
-                        continue
-                    lookup_results.append(
-                        dict(
-                            **lookup_values,
-                            refVcf=line_fields["refVcf"],
-                            altVcf=allele,
-                            **{k: v for k, v in line_fields.items() if k != "refVcf"},
-                        )
-                    )
-        query_rsid_process.check()
-
-        s3_output_key = f"{request_id}_lookup.json"
-        s3_client.put_object(
-            Bucket=PGXFLOW_BUCKET,
-            Key=s3_output_key,
-            Body=json.dumps(lookup_results).encode(),
-        )
+        lookup_table = load_lookup_table(LOOKUP_JOIN_MODE)
+        # Rows are streamed to S3 as JSON lines as they are matched
+        s3_output_key = f"{request_id}_lookup.jsonl"
+        with S3MultipartWriter(PGXFLOW_BUCKET, s3_output_key) as writer:
+            for lookup_result in join_lookup(
+                query_rsid_process.stdout, fields, lookup_table, LOOKUP_JOIN_MODE
+            ):
+                writer.write(json.dumps(lookup_result) + "\n")
+            query_rsid_process.check()
 
         s3_client.delete_object(
             Bucket=PGXFLOW_BUCKET,
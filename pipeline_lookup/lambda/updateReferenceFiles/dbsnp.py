@@ -3,11 +3,24 @@ import os
 
 import boto3
 
+from shared.utils import (
+    DBSNP_SUBSET_ID,
+    get_dbsnp_subset_key,
+    merge_regions,
+    query_references_table,
+)
+from regions import get_lookup_regions
+
 EC2_IAM_INSTANCE_PROFILE = os.environ["EC2_IAM_INSTANCE_PROFILE"]
 REFERENCE_LOCATION = os.environ["REFERENCE_LOCATION"]
 AWS_REGION = os.environ["AWS_REGION"]
 FUNCTION_NAME = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
 DYNAMO_PGXFLOW_REFERENCES_TABLE = os.environ["DYNAMO_PGXFLOW_REFERENCES_TABLE"]
+# Bases added around each region, part of the subset version
+DBSNP_SUBSET_MARGIN = int(os.environ["DBSNP_SUBSET_MARGIN"])
+DBSNP_SUBSET_REGIONS_KEY = "dbsnp/pgx_regions.txt"
+
+s3_client = boto3.client("s3")
 
 REGION_AMI_MAP = {
     "ap-southeast-2": "ami-0822a7a2356687b0f",
@@ -15,7 +28,41 @@ REGION_AMI_MAP = {
 }
 
 
-def update_dbsnp(dbsnp_version):
+def get_dbsnp_subset_regions():
+    # Padded so that indels overlapping the edge of a region are kept
+    regions = merge_regions(
+        (chrom, max(1, start - DBSNP_SUBSET_MARGIN), end + DBSNP_SUBSET_MARGIN)
+        for chrom, start, end in get_lookup_regions()
+    )
+    # dbSNP uses chromosome names without a chr prefix
+    return "".join(f"{chrom}\t{start}\t{end}\n" for chrom, start, end in regions)
+
+
+def update_dbsnp(dbsnp_version, dbsnp_subset_version, download_dbsnp=True):
+    """
+    Launch an EC2 instance to refresh dbSNP and the PGx dbSNP subset.
+
+    Args:
+        dbsnp_version (str): Latest dbSNP version
+        dbsnp_subset_version (str | None): Version of the subset to build,
+            or None to leave the subset as it is
+        download_dbsnp (bool): Whether the full dbSNP VCF is outdated too.
+            If not, the subset is extracted from the remote dbSNP VCF.
+    """
+    subset_key = ""
+    previous_subset_key = ""
+    if dbsnp_subset_version is not None:
+        s3_client.put_object(
+            Bucket=REFERENCE_LOCATION,
+            Key=DBSNP_SUBSET_REGIONS_KEY,
+            Body=get_dbsnp_subset_regions().encode(),
+        )
+        subset_key = get_dbsnp_subset_key(dbsnp_subset_version)
+        # Removed once the new version is switched to in the references table
+        previous_version = query_references_table(DBSNP_SUBSET_ID)
+        if previous_version is not None:
+            previous_subset_key = get_dbsnp_subset_key(previous_version)
+
     ec2_client = boto3.client("ec2")
     ami = REGION_AMI_MAP[AWS_REGION]
     device_name = ec2_client.describe_images(ImageIds=[ami])["Images"][0][
@@ -29,6 +76,12 @@ def update_dbsnp(dbsnp_version):
             .replace("__TABLE__", DYNAMO_PGXFLOW_REFERENCES_TABLE)
             .replace("__DBSNP_ID__", "dbsnp_version")
             .replace("__DBSNP_VERSION__", dbsnp_version)
+            .replace("__DOWNLOAD_DBSNP__", "true" if download_dbsnp else "false")
+            .replace("__DBSNP_SUBSET_ID__", DBSNP_SUBSET_ID)
+            .replace("__DBSNP_SUBSET_VERSION__", dbsnp_subset_version or "")
+            .replace("__DBSNP_SUBSET_KEY__", subset_key)
+            .replace("__PREVIOUS_DBSNP_SUBSET_KEY__", previous_subset_key)
+            .replace("__DBSNP_SUBSET_REGIONS_KEY__", DBSNP_SUBSET_REGIONS_KEY)
             .replace("__REFERENCE_LOCATION__", REFERENCE_LOCATION)
         )
     try:
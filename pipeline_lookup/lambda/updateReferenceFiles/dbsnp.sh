@@ -1,4 +1,4 @@
-#!bin/bash
+#!/bin/bash
 set -exuo pipefail
 trap 'shutdown -h now' EXIT
 
@@ -6,6 +6,13 @@ REGION="__REGION__"
 TABLE="__TABLE__"
 DBSNP_ID="__DBSNP_ID__"
 DBSNP_VERSION="__DBSNP_VERSION__"
+DOWNLOAD_DBSNP="__DOWNLOAD_DBSNP__"
+DBSNP_SUBSET_ID="__DBSNP_SUBSET_ID__"
+DBSNP_SUBSET_VERSION="__DBSNP_SUBSET_VERSION__"
+DBSNP_SUBSET_KEY="__DBSNP_SUBSET_KEY__"
+PREVIOUS_DBSNP_SUBSET_KEY="__PREVIOUS_DBSNP_SUBSET_KEY__"
+DBSNP_SUBSET_REGIONS_KEY="__DBSNP_SUBSET_REGIONS_KEY__"
+DBSNP_URL="https://ftp.ncbi.nih.gov/snp/organisms/human_9606/VCF/00-All.vcf.gz"
 REFERENCE_LOCATION="__REFERENCE_LOCATION__"
 
 dnf install -y \
@@ -33,15 +40,64 @@ wget "https://github.com/samtools/htslib/releases/download/1.21/htslib-1.21.tar.
     && make install \
     && cd ..
 
-wget -q "https://ftp.ncbi.nih.gov/snp/organisms/human_9606/VCF/00-All.vcf.gz" -O dbsnp.vcf.gz
-aws s3 cp dbsnp.vcf.gz "s3://${REFERENCE_LOCATION}/dbsnp.vcf.gz" --region "${REGION}"
+wget "https://github.com/samtools/bcftools/releases/download/1.21/bcftools-1.21.tar.bz2" \
+    && tar -xvjf bcftools-1.21.tar.bz2 \
+    && cd bcftools-1.21 \
+    && ./configure \
+    && make \
+    && make install \
+    && cd ..
+
+if [ "${DOWNLOAD_DBSNP}" = "true" ]; then
+    wget -q "${DBSNP_URL}" -O dbsnp.vcf.gz
+    aws s3 cp dbsnp.vcf.gz "s3://${REFERENCE_LOCATION}/dbsnp.vcf.gz" --region "${REGION}"
+
+    wget -q "${DBSNP_URL}.tbi" -O dbsnp.vcf.gz.tbi
+    aws s3 cp dbsnp.vcf.gz.tbi "s3://${REFERENCE_LOCATION}/dbsnp.vcf.gz.tbi" --region "${REGION}"
+    DBSNP_SOURCE="dbsnp.vcf.gz"
+else
+    # dbSNP hasn't changed, so only the records in the regions are fetched
+    DBSNP_SOURCE="${DBSNP_URL}"
+fi
+
+# Subset of dbSNP restricted to the padded association matrix regions, left
+# as it is when there is no association matrix to take the regions from
+if [ -n "${DBSNP_SUBSET_VERSION}" ]; then
+    aws s3 cp "s3://${REFERENCE_LOCATION}/${DBSNP_SUBSET_REGIONS_KEY}" regions.txt --region "${REGION}"
+else
+    : > regions.txt
+fi
+if [ -s regions.txt ]; then
+    bcftools view \
+        --regions-file regions.txt \
+        "${DBSNP_SOURCE}" \
+        -Oz \
+        --write-index \
+        -o pgx_subset.vcf.gz
+    # Published under its version before the version is switched to, so the
+    # lambdas never pair a subset with the index of another version
+    aws s3 cp pgx_subset.vcf.gz "s3://${REFERENCE_LOCATION}/${DBSNP_SUBSET_KEY}" --region "${REGION}"
+    aws s3 cp pgx_subset.vcf.gz.csi "s3://${REFERENCE_LOCATION}/${DBSNP_SUBSET_KEY}.csi" --region "${REGION}"
+
+    aws dynamodb update-item \
+        --region "${REGION}" \
+        --table-name "${TABLE}" \
+        --key '{"id": {"S": "'"${DBSNP_SUBSET_ID}"'"}}' \
+        --update-expression "SET version = :version" \
+        --expression-attribute-values '{":version": {"S": "'"${DBSNP_SUBSET_VERSION}"'"}}'
 
-wget -q "https://ftp.ncbi.nih.gov/snp/organisms/human_9606/VCF/00-All.vcf.gz.tbi" -O dbsnp.vcf.gz.tbi
-aws s3 cp dbsnp.vcf.gz.tbi "s3://${REFERENCE_LOCATION}/dbsnp.vcf.gz.tbi" --region "${REGION}"
+    # Lambdas still holding the previous version fall back to the full dbSNP
+    if [ -n "${PREVIOUS_DBSNP_SUBSET_KEY}" ] && [ "${PREVIOUS_DBSNP_SUBSET_KEY}" != "${DBSNP_SUBSET_KEY}" ]; then
+        aws s3 rm "s3://${REFERENCE_LOCATION}/${PREVIOUS_DBSNP_SUBSET_KEY}" --region "${REGION}"
+        aws s3 rm "s3://${REFERENCE_LOCATION}/${PREVIOUS_DBSNP_SUBSET_KEY}.csi" --region "${REGION}"
+    fi
+fi
 
-aws dynamodb update-item \
-    --region "${REGION}" \
-    --table-name "${TABLE}" \
-    --key '{"id": {"S": "'"${DBSNP_ID}"'"}}' \
-    --update-expression "SET version = :version" \
-    --expression-attribute-values '{":version": {"S": "'"${DBSNP_VERSION}"'"}}'
+if [ "${DOWNLOAD_DBSNP}" = "true" ]; then
+    aws dynamodb update-item \
+        --region "${REGION}" \
+        --table-name "${TABLE}" \
+        --key '{"id": {"S": "'"${DBSNP_ID}"'"}}' \
+        --update-expression "SET version = :version" \
+        --expression-attribute-values '{":version": {"S": "'"${DBSNP_VERSION}"'"}}'
+fi
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+import boto3
+
+from shared.utils import (
+    GNOMAD_S3_PREFIX,
+    GNOMAD_S3_SUFFIX,
+    GNOMAD_SUBSET_ID,
+    get_gnomad_subset_prefix,
+    merge_regions,
+    query_references_table,
+)
+from regions import get_lookup_regions, get_pharmcat_regions
+
+s3_client = boto3.client("s3")
+
+EC2_IAM_INSTANCE_PROFILE = os.environ["EC2_IAM_INSTANCE_PROFILE"]
+REFERENCE_LOCATION = os.environ["REFERENCE_LOCATION"]
+AWS_REGION = os.environ["AWS_REGION"]
+FUNCTION_NAME = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
+DYNAMO_PGXFLOW_REFERENCES_TABLE = os.environ["DYNAMO_PGXFLOW_REFERENCES_TABLE"]
+
+# Only the INFO fields read by the gnomAD lambdas are kept in the subset
+GNOMAD_INFO_FIELDS = [
+    "AF_afr",
+    "AF_eas",
+    "AF_fin",
+    "AF_nfe",
+    "AF_sas",
+    "AF_amr",
+    "AF",
+    "AC",
+    "AN",
+    "sift_max",
+]
+GNOMAD_SUBSET_REGIONS_KEY = "gnomad/pgx_regions.txt"
+
+REGION_AMI_MAP = {
+    "ap-southeast-2": "ami-0822a7a2356687b0f",
+    "ap-southeast-3": "ami-0f6fd501d5bfeb733",
+}
+
+
+def get_gnomad_subset_regions():
+    regions = merge_regions([*get_lookup_regions(), *get_pharmcat_regions()])
+    # gnomAD uses chr-prefixed chromosome names
+    return "".join(f"chr{chrom}\t{start}\t{end}\n" for chrom, start, end in regions)
+
+
+def check_gnomad_subset_version():
+    regions = get_gnomad_subset_regions()
+    md5 = hashlib.md5()
+    md5.update(GNOMAD_S3_PREFIX.encode())
+    md5.update(regions.encode())
+    latest_version = md5.hexdigest()
+    local_version = query_references_table(GNOMAD_SUBSET_ID)
+    return latest_version != local_version, latest_version, regions
+
+
+def update_gnomad_subset(gnomad_subset_version, regions):
+    if not regions:
+        print("No regions to extract from gnomAD, skipping subset update")
+        return {"StatusCode": 200, "body": json.dumps("No gnomAD regions")}
+
+    s3_client.put_object(
+        Bucket=REFERENCE_LOCATION,
+        Key=GNOMAD_SUBSET_REGIONS_KEY,
+        Body=regions.encode(),
+    )
+
+    # Removed once the new version is switched to in the references table
+    previous_version = query_references_table(GNOMAD_SUBSET_ID)
+    previous_prefix = (
+        "" if previous_version is None else get_gnomad_subset_prefix(previous_version)
+    )
+
+    ec2_client = boto3.client("ec2")
+    ami = REGION_AMI_MAP[AWS_REGION]
+    device_name = ec2_client.describe_images(ImageIds=[ami])["Images"][0][
+        "RootDeviceName"
+    ]
+
+    with open("gnomad.sh") as user_data_file:
+        ec2_startup = (
+            user_data_file.read()
+            .replace("__REGION__", AWS_REGION)
+            .replace("__TABLE__", DYNAMO_PGXFLOW_REFERENCES_TABLE)
+            .replace("__GNOMAD_SUBSET_ID__", GNOMAD_SUBSET_ID)
+            .replace("__GNOMAD_SUBSET_VERSION__", gnomad_subset_version)
+            .replace(
+                "__GNOMAD_SUBSET_PREFIX__",
+                get_gnomad_subset_prefix(gnomad_subset_version),
+            )
+            .replace("__PREVIOUS_GNOMAD_SUBSET_PREFIX__", previous_prefix)
+            .replace("__GNOMAD_S3_PREFIX__", GNOMAD_S3_PREFIX)
+            .replace("__GNOMAD_S3_SUFFIX__", GNOMAD_S3_SUFFIX)
+            .replace(
+                "__GNOMAD_INFO_FIELDS__",
+                ",".join(f"INFO/{field}" for field in GNOMAD_INFO_FIELDS),
+            )
+            .replace("__GNOMAD_SUBSET_REGIONS_KEY__", GNOMAD_SUBSET_REGIONS_KEY)
+            .replace("__REFERENCE_LOCATION__", REFERENCE_LOCATION)
+        )
+    try:
+        response = ec2_client.run_instances(
+            ImageId=REGION_AMI_MAP[AWS_REGION],
+            InstanceType="t3.medium",
+            MinCount=1,
+            MaxCount=1,
+            BlockDeviceMappings=[
+                {
+                    "DeviceName": device_name,
+                    "Ebs": {
+                        "DeleteOnTermination": True,
+                        "VolumeSize": 20,
+                        "VolumeType": "gp3",
+                        "Encrypted": True,
+                    },
+                },
+            ],
+            UserData=ec2_startup,
+            InstanceInitiatedShutdownBehavior="terminate",
+            TagSpecifications=[
+                {
+                    "ResourceType": "instance",
+                    "Tags": [{"Key": "Name", "Value": f"{FUNCTION_NAME}"}],
+                }
+            ],
+            IamInstanceProfile={"Name": EC2_IAM_INSTANCE_PROFILE},
+        )
+        instance_id = response["Instances"][0]["InstanceId"]
+    except Exception as e:
+        print(f"Error launching EC2 instance: {str(e)}")
+        return {"statusCode": 500, "body": json.dumps("Error launching EC2 instance")}
+    print(f"Launched EC2 instance {instance_id} to build the gnomAD subset")
+    return {
+        "StatusCode": 200,
+        "body": json.dumps(f"Launched EC2 instance {instance_id}"),
+    }
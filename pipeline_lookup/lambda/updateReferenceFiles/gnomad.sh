@@ -0,0 +1,90 @@
+#!/bin/bash
+set -exuo pipefail
+trap 'shutdown -h now' EXIT
+
+REGION="__REGION__"
+TABLE="__TABLE__"
+GNOMAD_SUBSET_ID="__GNOMAD_SUBSET_ID__"
+GNOMAD_SUBSET_VERSION="__GNOMAD_SUBSET_VERSION__"
+GNOMAD_SUBSET_PREFIX="__GNOMAD_SUBSET_PREFIX__"
+PREVIOUS_GNOMAD_SUBSET_PREFIX="__PREVIOUS_GNOMAD_SUBSET_PREFIX__"
+GNOMAD_S3_PREFIX="__GNOMAD_S3_PREFIX__"
+GNOMAD_S3_SUFFIX="__GNOMAD_S3_SUFFIX__"
+GNOMAD_INFO_FIELDS="__GNOMAD_INFO_FIELDS__"
+GNOMAD_SUBSET_REGIONS_KEY="__GNOMAD_SUBSET_REGIONS_KEY__"
+REFERENCE_LOCATION="__REFERENCE_LOCATION__"
+
+dnf install -y \
+    bzip2 \
+    gzip \
+    tar \
+    wget \
+    gcc \
+    make \
+    zlib-devel \
+    bzip2-devel \
+    xz-devel \
+    curl-devel \
+
+wget "https://awscli.amazonaws.com/awscli-exe-linux-x86_64.zip" -O awscliv2.zip \
+    && unzip awscliv2.zip \
+    && sudo ./aws/install \
+    && export PATH=/usr/local/bin:$PATH
+
+wget "https://github.com/samtools/bcftools/releases/download/1.21/bcftools-1.21.tar.bz2" \
+    && tar -xvjf bcftools-1.21.tar.bz2 \
+    && cd bcftools-1.21 \
+    && ./configure \
+    && make \
+    && make install \
+    && cd ..
+
+wget "https://github.com/samtools/htslib/releases/download/1.21/htslib-1.21.tar.bz2" \
+    && tar -xvjf htslib-1.21.tar.bz2 \
+    && cd htslib-1.21 \
+    && ./configure \
+    && make \
+    && make install \
+    && cd ..
+
+aws s3 cp "s3://${REFERENCE_LOCATION}/${GNOMAD_SUBSET_REGIONS_KEY}" regions.txt --region "${REGION}"
+
+# Extract each chromosome's regions, keeping only the INFO fields we annotate with
+mkdir -p chroms
+CHROM_FILES=()
+for CHROM in $(cut -f1 regions.txt | uniq); do
+    awk -v chrom="${CHROM}" '$1 == chrom' regions.txt > "chroms/${CHROM}.txt"
+    if ! curl --head --silent --fail "${GNOMAD_S3_PREFIX}${CHROM}${GNOMAD_S3_SUFFIX}" > /dev/null; then
+        echo "No gnomAD file for ${CHROM}, skipping"
+        continue
+    fi
+    bcftools view \
+        --regions-file "chroms/${CHROM}.txt" \
+        "${GNOMAD_S3_PREFIX}${CHROM}${GNOMAD_S3_SUFFIX}" \
+        -Ou \
+        | bcftools annotate -x "^${GNOMAD_INFO_FIELDS}" -Ob -o "chroms/${CHROM}.bcf"
+    CHROM_FILES+=("chroms/${CHROM}.bcf")
+done
+
+bcftools concat "${CHROM_FILES[@]}" -Oz -o pgx_subset.vcf.bgz
+bcftools index pgx_subset.vcf.bgz
+
+# Every file of the subset is published under its version before the version
+# is switched to, so the lambdas never read files from different versions
+aws s3 cp pgx_subset.vcf.bgz "s3://${REFERENCE_LOCATION}/${GNOMAD_SUBSET_PREFIX}pgx_subset.vcf.bgz" --region "${REGION}"
+aws s3 cp pgx_subset.vcf.bgz.csi "s3://${REFERENCE_LOCATION}/${GNOMAD_SUBSET_PREFIX}pgx_subset.vcf.bgz.csi" --region "${REGION}"
+aws s3 cp regions.txt "s3://${REFERENCE_LOCATION}/${GNOMAD_SUBSET_PREFIX}pgx_subset_regions.txt" --region "${REGION}"
+
+aws dynamodb update-item \
+    --region "${REGION}" \
+    --table-name "${TABLE}" \
+    --key '{"id": {"S": "'"${GNOMAD_SUBSET_ID}"'"}}' \
+    --update-expression "SET version = :version" \
+    --expression-attribute-values '{":version": {"S": "'"${GNOMAD_SUBSET_VERSION}"'"}}'
+
+# Lambdas still holding the previous version fall back to the public files
+if [ -n "${PREVIOUS_GNOMAD_SUBSET_PREFIX}" ] && [ "${PREVIOUS_GNOMAD_SUBSET_PREFIX}" != "${GNOMAD_SUBSET_PREFIX}" ]; then
+    for FILENAME in pgx_subset.vcf.bgz pgx_subset.vcf.bgz.csi pgx_subset_regions.txt; do
+        aws s3 rm "s3://${REFERENCE_LOCATION}/${PREVIOUS_GNOMAD_SUBSET_PREFIX}${FILENAME}" --region "${REGION}"
+    done
+fi
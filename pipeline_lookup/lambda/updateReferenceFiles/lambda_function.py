@@ -1,8 +1,13 @@
 import json
 
-from version_checks import check_dbsnp_version, check_lookup_version
+from version_checks import (
+    check_dbsnp_subset_version,
+    check_dbsnp_version,
+    check_lookup_version,
+)
 from dbsnp import update_dbsnp
 from lookup import update_lookup
+from gnomad import check_gnomad_subset_version, update_gnomad_subset
 
 
 def lambda_handler(event, context):
@@ -11,8 +16,20 @@ def lambda_handler(event, context):
         dbsnp_outdated, dbsnp_version = check_dbsnp_version()
         lookup_outdated = check_lookup_version()
 
-        if dbsnp_outdated:
-            update_dbsnp(dbsnp_version)
-
         if lookup_outdated:
             update_lookup()
+
+        # Checked after the lookup update so the subset covers the new matrix
+        dbsnp_subset_outdated, dbsnp_subset_version = check_dbsnp_subset_version(
+            dbsnp_version
+        )
+        if dbsnp_outdated or dbsnp_subset_outdated:
+            update_dbsnp(
+                dbsnp_version, dbsnp_subset_version, download_dbsnp=dbsnp_outdated
+            )
+
+        gnomad_subset_outdated, gnomad_subset_version, gnomad_subset_regions = (
+            check_gnomad_subset_version()
+        )
+        if gnomad_subset_outdated:
+            update_gnomad_subset(gnomad_subset_version, gnomad_subset_regions)
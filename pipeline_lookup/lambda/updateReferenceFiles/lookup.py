@@ -5,7 +5,13 @@ import os
 import boto3
 from botocore.client import ClientError
 
-from shared.utils import update_references_table
+from shared.utils import (
+    get_lookup_index_key,
+    LOOKUP_INDEX_SUFFIX,
+    query_references_table,
+    update_references_table,
+    write_lookup_index,
+)
 from shared.utils.chrom_matching import (
     match_chromosome_name,
     CHROMOSOME_LENGTHS_MBP,
@@ -21,6 +27,7 @@ LOOKUP_REFERENCE = os.environ["LOOKUP_REFERENCE"]
 CHR_HEADER = os.environ["CHR_HEADER"]
 START_HEADER = os.environ["START_HEADER"]
 END_HEADER = os.environ["END_HEADER"]
+VARIANT_HEADER = "Variant"
 
 
 def chromosome_sort_key(chr_name):
@@ -117,6 +124,22 @@ def update_lookup():
         writer.writeheader()
         writer.writerows(sorted_rows)
 
+    local_index_path = os.path.join(
+        LOCAL_DIR, f"{LOOKUP_REFERENCE}{LOOKUP_INDEX_SUFFIX}"
+    )
+    # Read back with utf-8-sig so a byte order mark isn't kept in the first column
+    with open(
+        os.path.join(LOCAL_DIR, LOOKUP_REFERENCE), "r", encoding="utf-8-sig"
+    ) as f:
+        index_reader = csv.DictReader(f)
+        write_lookup_index(
+            local_index_path,
+            index_reader.fieldnames,
+            index_reader,
+            VARIANT_HEADER,
+            interval_columns=(CHR_HEADER, START_HEADER, END_HEADER),
+        )
+
     md5 = hashlib.md5()
     with open(os.path.join(LOCAL_DIR, LOOKUP_REFERENCE), "rb") as f:
         while chunk := f.read(8192):
@@ -128,5 +151,19 @@ def update_lookup():
         Bucket=REFERENCE_LOCATION,
         Key=prod_lookup_reference,
     )
+    # Publish the index under its hash before the hash itself, so it always
+    # exists for the hash a lookup reads
+    previous_checksum = query_references_table("lookup_hash")
+    s3_client.upload_file(
+        Filename=local_index_path,
+        Bucket=REFERENCE_LOCATION,
+        Key=get_lookup_index_key(prod_lookup_reference, checksum),
+    )
     update_references_table("lookup_hash", checksum)
+    if previous_checksum not in (None, checksum):
+        # Lookups still holding the old hash fall back to the CSV
+        s3_client.delete_object(
+            Bucket=REFERENCE_LOCATION,
+            Key=get_lookup_index_key(prod_lookup_reference, previous_checksum),
+        )
     s3_client.delete_object(Bucket=REFERENCE_LOCATION, Key=staging_lookup_reference)
@@ -0,0 +1,57 @@
+import csv
+import io
+import os
+
+import boto3
+from botocore.client import ClientError
+
+from shared.utils.chrom_matching import ChromosomeNotFoundError, match_chromosome_name
+
+s3_client = boto3.client("s3")
+
+REFERENCE_LOCATION = os.environ["REFERENCE_LOCATION"]
+LOOKUP_REFERENCE = os.environ["LOOKUP_REFERENCE"]
+CHR_HEADER = os.environ["CHR_HEADER"]
+START_HEADER = os.environ["START_HEADER"]
+END_HEADER = os.environ["END_HEADER"]
+PHARMCAT_REGIONS_KEY = "pharmcat-preprocessor/pharmcat_regions.bed"
+
+
+def get_reference_body(key):
+    try:
+        response = s3_client.get_object(Bucket=REFERENCE_LOCATION, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            print(f"s3://{REFERENCE_LOCATION}/{key} does not exist, skipping")
+            return None
+        raise
+    return response["Body"].read().decode("utf-8-sig")
+
+
+def get_lookup_regions():
+    """Yield 1-based inclusive (chromosome, start, end) regions of the matrix."""
+    body = get_reference_body(f"prod/{LOOKUP_REFERENCE}")
+    if body is None:
+        return
+    for row in csv.DictReader(io.StringIO(body)):
+        try:
+            yield (
+                match_chromosome_name(row[CHR_HEADER]),
+                int(row[START_HEADER]),
+                int(row[END_HEADER]),
+            )
+        except (ChromosomeNotFoundError, ValueError):
+            print(f"Skipping lookup row with invalid coordinates: {row}")
+
+
+def get_pharmcat_regions():
+    """Yield 1-based inclusive (chromosome, start, end) regions of PharmCAT."""
+    body = get_reference_body(PHARMCAT_REGIONS_KEY)
+    if body is None:
+        return
+    for line in body.splitlines():
+        if not line or line.startswith(("#", "track", "browser")):
+            continue
+        chrom, start, end = line.split("\t")[:3]
+        # BED is 0-based and half-open
+        yield match_chromosome_name(chrom), int(start) + 1, int(end)
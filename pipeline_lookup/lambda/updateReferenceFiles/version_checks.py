@@ -2,7 +2,8 @@ import os
 
 import boto3
 
-from shared.utils import fetch_remote_content, query_references_table
+from shared.utils import DBSNP_SUBSET_ID, fetch_remote_content, query_references_table
+from dbsnp import DBSNP_SUBSET_MARGIN
 
 s3_client = boto3.client("s3")
 
@@ -20,6 +21,17 @@ def check_dbsnp_version():
     return latest_dbsnp_version != local_dbsnp_version, latest_dbsnp_version
 
 
+def check_dbsnp_subset_version(dbsnp_version):
+    # The subset depends on both dbSNP and the association matrix regions
+    lookup_hash = query_references_table("lookup_hash")
+    if lookup_hash is None:
+        print("No lookup table has been published, skipping the dbSNP subset")
+        return False, None
+    latest_version = f"{dbsnp_version}:{lookup_hash}:{DBSNP_SUBSET_MARGIN}"
+    local_version = query_references_table(DBSNP_SUBSET_ID)
+    return latest_version != local_version, latest_version
+
+
 def check_lookup_version():
     lookup_reference_staging = f"staging/{LOOKUP_REFERENCE}"
     reference_bucket = os.environ["REFERENCE_LOCATION"]
@@ -2,6 +2,12 @@ data "aws_caller_identity" "this" {}
 
 locals {
   result_suffix = "_lookup_results.jsonl"
+  # /tmp of the lambdas below, shared by the htslib index cache, the block
+  # cache, the gnomAD result cache, the reference subsets and the VCFs
+  ephemeral_storage_size   = 2048
+  htslib_index_cache_bytes = 128 * 1024 * 1024
+  block_cache_bytes        = 512 * 1024 * 1024
+  gnomad_cache_max_bytes   = 128 * 1024 * 1024
 }
 
 #
@@ -10,34 +16,54 @@ locals {
 module "lambda-dbsnp" {
   source = "terraform-aws-modules/lambda/aws"
 
-  function_name       = "pgxflow-backend-dbsnp"
-  description         = "Gets RSIDs for variants in a VCF"
-  handler             = "lambda_function.lambda_handler"
-  runtime             = "python3.12"
-  memory_size         = 1792
-  timeout             = 600
-  attach_policy_jsons = true
+  function_name          = "pgxflow-backend-dbsnp"
+  description            = "Gets RSIDs for variants in a VCF"
+  handler                = "lambda_function.lambda_handler"
+  runtime                = "python3.12"
+  memory_size            = 1792
+  ephemeral_storage_size = local.ephemeral_storage_size
+  timeout                = 600
+  attach_policy_jsons    = true
   policy_jsons = [
     data.aws_iam_policy_document.lambda-dbsnp.json
   ]
   number_of_policy_jsons = 1
-  source_path            = "${path.module}/lambda/dbsnp"
+  source_path = [
+    "${path.module}/lambda/dbsnp",
+    # Packaged for the fused pipeline mode
+    {
+      path          = "${path.module}/lambda/lookup"
+      prefix_in_zip = "lookup"
+    },
+    {
+      path          = "${path.module}/lambda/gnomad"
+      prefix_in_zip = "gnomad"
+    },
+  ]
 
   tags = var.common-tags
 
   environment_variables = {
-    PGXFLOW_BUCKET           = var.pgxflow-backend-bucket-name
-    DPORTAL_BUCKET           = var.data-portal-bucket-name
-    REFERENCE_BUCKET         = var.pgxflow-reference-bucket-name
-    PGXFLOW_LOOKUP_LAMBDA    = module.lambda-lookup.lambda_function_arn
-    DBSNP_REFERENCE          = var.dbsnp_reference
-    LOOKUP_REFERENCE         = "prod/${var.lookup_configuration["assoc_matrix_filename"]}"
-    CHR_HEADER               = var.lookup_configuration["chr_header"]
-    START_HEADER             = var.lookup_configuration["start_header"]
-    END_HEADER               = var.lookup_configuration["end_header"]
-    DYNAMO_CLINIC_JOBS_TABLE = var.dynamo-clinic-jobs-table
-    SEND_JOB_EMAIL_ARN       = var.send-job-email-lambda-function-arn
-    HTS_S3_HOST              = "s3.${var.region}.amazonaws.com"
+    RESULT_SUFFIX                   = local.result_suffix
+    PGXFLOW_BUCKET                  = var.pgxflow-backend-bucket-name
+    DPORTAL_BUCKET                  = var.data-portal-bucket-name
+    REFERENCE_BUCKET                = var.pgxflow-reference-bucket-name
+    PGXFLOW_LOOKUP_LAMBDA           = module.lambda-lookup.lambda_function_arn
+    PGXFLOW_GNOMAD_LAMBDA           = module.lambda-gnomad.lambda_function_arn
+    DBSNP_REFERENCE                 = var.dbsnp_reference
+    LOOKUP_REFERENCE                = "prod/${var.lookup_configuration["assoc_matrix_filename"]}"
+    CHR_HEADER                      = var.lookup_configuration["chr_header"]
+    START_HEADER                    = var.lookup_configuration["start_header"]
+    END_HEADER                      = var.lookup_configuration["end_header"]
+    LOOKUP_JOIN_MODE                = var.lookup_configuration["join_mode"]
+    LOOKUP_ALLELE_HEADER            = var.lookup_configuration["allele_header"]
+    DYNAMO_CLINIC_JOBS_TABLE        = var.dynamo-clinic-jobs-table
+    DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
+    SEND_JOB_EMAIL_ARN              = var.send-job-email-lambda-function-arn
+    HTS_S3_HOST                     = "s3.${var.region}.amazonaws.com"
+    HTSLIB_INDEX_CACHE_BYTES        = local.htslib_index_cache_bytes
+    BLOCK_CACHE_BYTES               = local.block_cache_bytes
+    GNOMAD_CACHE_MAX_BYTES          = local.gnomad_cache_max_bytes
   }
 
   layers = [
@@ -52,13 +78,14 @@ module "lambda-dbsnp" {
 module "lambda-lookup" {
   source = "terraform-aws-modules/lambda/aws"
 
-  function_name       = "pgxflow-backend-lookup"
-  description         = "Performs a lookup on custom association matrix to retrieve annotations"
-  handler             = "lambda_function.lambda_handler"
-  runtime             = "python3.12"
-  memory_size         = 1792
-  timeout             = 600
-  attach_policy_jsons = true
+  function_name          = "pgxflow-backend-lookup"
+  description            = "Performs a lookup on custom association matrix to retrieve annotations"
+  handler                = "lambda_function.lambda_handler"
+  runtime                = "python3.12"
+  memory_size            = 1792
+  ephemeral_storage_size = local.ephemeral_storage_size
+  timeout                = 600
+  attach_policy_jsons    = true
   policy_jsons = [
     data.aws_iam_policy_document.lambda-lookup.json
   ]
@@ -68,18 +95,22 @@ module "lambda-lookup" {
   tags = var.common-tags
 
   environment_variables = {
-    RESULT_SUFFIX            = local.result_suffix
-    PGXFLOW_BUCKET           = var.pgxflow-backend-bucket-name
-    DPORTAL_BUCKET           = var.data-portal-bucket-name
-    REFERENCE_BUCKET         = var.pgxflow-reference-bucket-name
-    LOOKUP_REFERENCE         = "prod/${var.lookup_configuration["assoc_matrix_filename"]}"
-    CHR_HEADER               = var.lookup_configuration["chr_header"]
-    START_HEADER             = var.lookup_configuration["start_header"]
-    END_HEADER               = var.lookup_configuration["end_header"]
-    PGXFLOW_GNOMAD_LAMBDA    = module.lambda-gnomad.lambda_function_arn
-    DYNAMO_CLINIC_JOBS_TABLE = var.dynamo-clinic-jobs-table
-    SEND_JOB_EMAIL_ARN       = var.send-job-email-lambda-function-arn
-    HTS_S3_HOST              = "s3.${var.region}.amazonaws.com"
+    RESULT_SUFFIX                   = local.result_suffix
+    PGXFLOW_BUCKET                  = var.pgxflow-backend-bucket-name
+    DPORTAL_BUCKET                  = var.data-portal-bucket-name
+    REFERENCE_BUCKET                = var.pgxflow-reference-bucket-name
+    LOOKUP_REFERENCE                = "prod/${var.lookup_configuration["assoc_matrix_filename"]}"
+    CHR_HEADER                      = var.lookup_configuration["chr_header"]
+    START_HEADER                    = var.lookup_configuration["start_header"]
+    END_HEADER                      = var.lookup_configuration["end_header"]
+    LOOKUP_JOIN_MODE                = var.lookup_configuration["join_mode"]
+    LOOKUP_ALLELE_HEADER            = var.lookup_configuration["allele_header"]
+    PGXFLOW_GNOMAD_LAMBDA           = module.lambda-gnomad.lambda_function_arn
+    DYNAMO_CLINIC_JOBS_TABLE        = var.dynamo-clinic-jobs-table
+    DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
+    SEND_JOB_EMAIL_ARN              = var.send-job-email-lambda-function-arn
+    HTS_S3_HOST                     = "s3.${var.region}.amazonaws.com"
+    HTSLIB_INDEX_CACHE_BYTES        = local.htslib_index_cache_bytes
   }
 
   layers = [
@@ -94,13 +125,14 @@ module "lambda-lookup" {
 module "lambda-gnomad" {
   source = "terraform-aws-modules/lambda/aws"
 
-  function_name       = "pgxflow-backend-gnomad"
-  description         = "Adds data from gnomAD to the lookup results"
-  handler             = "lambda_function.lambda_handler"
-  runtime             = "python3.12"
-  memory_size         = 1792
-  timeout             = 600
-  attach_policy_jsons = true
+  function_name          = "pgxflow-backend-gnomad"
+  description            = "Adds data from gnomAD to the lookup results"
+  handler                = "lambda_function.lambda_handler"
+  runtime                = "python3.12"
+  memory_size            = 1792
+  ephemeral_storage_size = local.ephemeral_storage_size
+  timeout                = 600
+  attach_policy_jsons    = true
   policy_jsons = [
     data.aws_iam_policy_document.lambda-gnomad.json
   ]
@@ -110,11 +142,16 @@ module "lambda-gnomad" {
   tags = var.common-tags
 
   environment_variables = {
-    RESULT_SUFFIX            = local.result_suffix
-    PGXFLOW_BUCKET           = var.pgxflow-backend-bucket-name
-    DPORTAL_BUCKET           = var.data-portal-bucket-name
-    DYNAMO_CLINIC_JOBS_TABLE = var.dynamo-clinic-jobs-table
-    SEND_JOB_EMAIL_ARN       = var.send-job-email-lambda-function-arn
+    RESULT_SUFFIX                   = local.result_suffix
+    PGXFLOW_BUCKET                  = var.pgxflow-backend-bucket-name
+    REFERENCE_BUCKET                = var.pgxflow-reference-bucket-name
+    DPORTAL_BUCKET                  = var.data-portal-bucket-name
+    DYNAMO_CLINIC_JOBS_TABLE        = var.dynamo-clinic-jobs-table
+    DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
+    SEND_JOB_EMAIL_ARN              = var.send-job-email-lambda-function-arn
+    HTSLIB_INDEX_CACHE_BYTES        = local.htslib_index_cache_bytes
+    BLOCK_CACHE_BYTES               = local.block_cache_bytes
+    GNOMAD_CACHE_MAX_BYTES          = local.gnomad_cache_max_bytes
   }
 
   layers = [
@@ -134,7 +171,7 @@ module "lambda-updateReferenceFiles" {
   handler             = "lambda_function.lambda_handler"
   runtime             = "python3.12"
   memory_size         = 1792
-  timeout             = 28
+  timeout             = 600
   attach_policy_jsons = true
   policy_jsons = [
     data.aws_iam_policy_document.lambda-updateReferenceFiles.json
@@ -152,6 +189,7 @@ module "lambda-updateReferenceFiles" {
     END_HEADER                      = var.lookup_configuration["end_header"]
     DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
     EC2_IAM_INSTANCE_PROFILE        = var.ec2-references-instance-profile
+    DBSNP_SUBSET_MARGIN             = var.lookup_configuration["dbsnp_subset_margin"]
   }
 
   layers = [
@@ -22,6 +22,7 @@ data "aws_iam_policy_document" "lambda-preprocessor" {
     resources = [
       "${var.data-portal-bucket-arn}/projects/*/project-files/*",
       "${var.pgxflow-reference-bucket-arn}/*",
+      "${var.pgxflow-backend-bucket-arn}/vcf_profiles/*",
     ]
   }
   statement {
@@ -41,6 +42,14 @@ data "aws_iam_policy_document" "lambda-preprocessor" {
       var.dynamo-clinic-jobs-table-arn,
     ]
   }
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      var.dynamo-references-table-arn,
+    ]
+  }
   statement {
     actions = [
       "lambda:InvokeFunction",
@@ -105,6 +114,7 @@ data "aws_iam_policy_document" "lambda-postprocessor" {
     actions = [
       "s3:GetObject",
       "s3:PutObject",
+      "s3:AbortMultipartUpload",
     ]
     resources = [
       "${var.pgxflow-backend-bucket-arn}/*"
@@ -139,6 +149,23 @@ data "aws_iam_policy_document" "lambda-postprocessor" {
 }
 
 data "aws_iam_policy_document" "lambda-gnomad" {
+  statement {
+    actions = [
+      "s3:GetObject",
+    ]
+    resources = [
+      "${var.pgxflow-reference-bucket-arn}/gnomad/*",
+    ]
+  }
+  statement {
+    actions = [
+      "s3:ListBucket",
+    ]
+    resources = [
+      var.pgxflow-reference-bucket-arn,
+      var.pgxflow-backend-bucket-arn,
+    ]
+  }
   statement {
     actions = [
       "s3:GetObject",
@@ -173,6 +200,22 @@ data "aws_iam_policy_document" "lambda-gnomad" {
       var.send-job-email-lambda-function-arn,
     ]
   }
+  statement {
+    actions = [
+      "s3:PutObject",
+    ]
+    resources = [
+      "${var.pgxflow-backend-bucket-arn}/gnomad/*",
+    ]
+  }
+  statement {
+    actions = [
+      "dynamodb:GetItem",
+    ]
+    resources = [
+      var.dynamo-references-table-arn,
+    ]
+  }
 }
 
 #
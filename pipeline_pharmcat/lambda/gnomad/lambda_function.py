@@ -2,28 +2,23 @@ from collections import defaultdict
 import json
 import os
 
-from shared.utils import CheckedProcess, handle_failed_execution, LoggingClient
+from shared.utils import (
+    GNOMAD_CACHE_RELEASE,
+    GNOMAD_COLUMNS,
+    GnomadCache,
+    handle_failed_execution,
+    LoggingClient,
+    load_gnomad_subset,
+    log_block_cache_stats,
+    query_gnomad,
+)
 from shared.dynamodb import update_clinic_job
 
+LOCAL_DIR = "/tmp"
 DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
 PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
+REFERENCE_BUCKET = os.environ["REFERENCE_BUCKET"]
 RESULT_SUFFIX = os.environ["RESULT_SUFFIX"]
-GNOMAD_S3_PREFIX = "https://gnomad-public-us-east-1.s3.amazonaws.com/release/4.1/vcf/genomes/gnomad.genomes.v4.1.sites."
-GNOMAD_S3_SUFFIX = ".vcf.bgz"
-MAX_REGIONS_PER_QUERY = 20
-# Just the columns after the identifying columns
-GNOMAD_COLUMNS = {
-    "afAfr": "INFO/AF_afr",
-    "afEas": "INFO/AF_eas",
-    "afFin": "INFO/AF_fin",
-    "afNfe": "INFO/AF_nfe",
-    "afSas": "INFO/AF_sas",
-    "afAmr": "INFO/AF_amr",
-    "af": "INFO/AF",
-    "ac": "INFO/AC",
-    "an": "INFO/AN",
-    "siftMax": "INFO/sift_max",
-}
 KEYS_TO_REMOVE = [
     "chromRef",
     "posVcf",
@@ -33,76 +28,28 @@ KEYS_TO_REMOVE = [
 ]
 
 s3_client = LoggingClient("s3")
+# Kept between invocations so an unchanged cache isn't downloaded again
+gnomad_cache = GnomadCache(PGXFLOW_BUCKET, GNOMAD_CACHE_RELEASE, LOCAL_DIR)
 lambda_client = LoggingClient("lambda")
 
 
-def get_query_process(regions, ref_chrom):
-    chrom = f"chr{ref_chrom}"
-    args = [
-        "bcftools",
-        "query",
-        "--regions",
-        ",".join(f"{chrom}:{pos}" for pos, _ in regions),
-        "--format",
-        f"%POS\t%REF\t%ALT\t{'\\t'.join("%" + val for val in GNOMAD_COLUMNS.values())}\n",
-        f"{GNOMAD_S3_PREFIX}{chrom}{GNOMAD_S3_SUFFIX}",
-    ]
-    return CheckedProcess(args, error_message="bcftools error querying gnomAD")
-
-
-def convert_to_region_lines(input_data):
-    regions_data = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+def add_gnomad_data(input_data):
+    rows = defaultdict(list)
+    positions = defaultdict(set)
     for data in input_data:
-        regions_data[data["chromRef"]][data["posVcf"]][data["refVcf"]].append(data)
+        chrom = data["chromRef"]
+        rows[(chrom, data["posVcf"], data["refVcf"])].append(data)
+        positions[chrom].add(data["posVcf"])
         data["per_alt"] = {}
-    # Split into chunks of MAX_REGIONS_PER_QUERY
-    region_query_lines = []
-    for chrom, pos_lines in regions_data.items():
-        pos_list = sorted(list(pos_lines.keys()))
-        region_chunks = [
-            pos_list[i : i + MAX_REGIONS_PER_QUERY]
-            for i in range(0, len(pos_list), MAX_REGIONS_PER_QUERY)
-        ]
-        region_query_lines.extend(
-            [
-                (
-                    chrom,
-                    {
-                        (pos, ref): data_value
-                        for pos in region_chunk
-                        for ref, data_value in regions_data[chrom][pos].items()
-                    },
-                )
-                for region_chunk in region_chunks
-            ]
-        )
-    return region_query_lines
-
-
-def add_gnomad_data(input_data):
-    region_queries_lines = convert_to_region_lines(input_data)
-    query_processes = [
-        get_query_process(query_region.keys(), chrom)
-        for chrom, query_region in region_queries_lines
-    ]
-    lines_updated = 0
-    for query_process, (_, regions_data) in zip(query_processes, region_queries_lines):
-        for line in query_process.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            pos_s, ref, alt, *query_data = line.split("\t")
-            pos = int(pos_s)
-            for data in regions_data.get((pos, ref), []):
-                if alt in data["altsVcf"]:
-                    data["per_alt"][alt] = {
-                        col_name: gnomad_datum
-                        for col_name, gnomad_datum in zip(
-                            list(GNOMAD_COLUMNS.keys()), query_data
-                        )
-                    }
-                lines_updated += 1
-        query_process.check()
+    gnomad_subset = load_gnomad_subset(REFERENCE_BUCKET, LOCAL_DIR)
+    gnomad_cache.load()
+    for chrom, pos, ref, alt, values in query_gnomad(
+        positions, gnomad_subset, gnomad_cache
+    ):
+        for data in rows.get((chrom, pos, ref), []):
+            if alt in data["altsVcf"]:
+                data["per_alt"][alt] = values
+    gnomad_cache.save()
     for data in input_data:
         data_per_alt = data["per_alt"]
         for col_name in GNOMAD_COLUMNS:
@@ -126,6 +73,7 @@ def lambda_handler(event, context):
         )
         input_data = json.loads(response["Body"].read().decode("utf-8"))
         add_gnomad_data(input_data["variants"])
+        log_block_cache_stats()
 
         s3_client.put_object(
             Bucket=DPORTAL_BUCKET,
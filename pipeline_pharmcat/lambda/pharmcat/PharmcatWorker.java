@@ -0,0 +1,66 @@
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+
+/**
+ * Runs PharmCAT jobs one after another in a long-lived JVM.
+ *
+ * <p>Each line on stdin is a job, holding the tab separated arguments of a PharmCAT command.
+ * PharmCAT's output is written to stdout as usual, followed by a line with DONE and the exit
+ * status of the job. PharmCAT calls System.exit when it finishes or fails, so exits are trapped
+ * and reported as the status instead of stopping the worker.
+ */
+public class PharmcatWorker {
+  static final String READY = "PHARMCAT_WORKER_READY";
+  static final String DONE = "PHARMCAT_WORKER_DONE";
+
+  static class ExitTrappedException extends SecurityException {
+    final int status;
+
+    ExitTrappedException(int status) {
+      super("PharmCAT exited with status " + status);
+      this.status = status;
+    }
+  }
+
+  public static void main(String[] args) throws Exception {
+    // Loaded before the first job so that it only pays for running PharmCAT
+    Method pharmcatMain =
+        Class.forName("org.pharmgkb.pharmcat.PharmCAT").getMethod("main", String[].class);
+    System.setSecurityManager(
+        new SecurityManager() {
+          @Override
+          public void checkPermission(Permission permission) {}
+
+          @Override
+          public void checkExit(int status) {
+            throw new ExitTrappedException(status);
+          }
+        });
+    System.out.println(READY);
+    System.out.flush();
+
+    BufferedReader reader =
+        new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+    String line;
+    while ((line = reader.readLine()) != null) {
+      int status = 0;
+      try {
+        pharmcatMain.invoke(null, (Object) line.split("\t"));
+      } catch (InvocationTargetException e) {
+        Throwable cause = e.getCause();
+        if (cause instanceof ExitTrappedException) {
+          status = ((ExitTrappedException) cause).status;
+        } else {
+          cause.printStackTrace(System.out);
+          status = 1;
+        }
+      }
+      System.out.println(DONE + " " + status);
+      System.out.flush();
+    }
+  }
+}
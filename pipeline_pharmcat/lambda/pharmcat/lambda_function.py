@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import glob
 import json
 import os
-import subprocess
+import time
 
 from shared.utils import handle_failed_execution, LoggingClient
+from pharmcat_worker import PharmcatWorker, run_once
 
 lambda_client = LoggingClient("lambda")
 s3_client = LoggingClient("s3")
@@ -13,26 +16,96 @@ PGXFLOW_PHARMCAT_POSTPROCESSOR_LAMBDA = os.environ[
     "PGXFLOW_PHARMCAT_POSTPROCESSOR_LAMBDA"
 ]
 
+# Started during init, so the JVM is ready by the time the inputs are downloaded
+pharmcat_worker = PharmcatWorker()
+pharmcat_worker.start()
 
-def run_pharmcat(input_path, vcf):
-    "Run PharmCAT on the preprocessed VCF"
-    cmd = [
-        "java",
-        "-Xmx2g",
-        "-Dlogback.configurationFile=/opt/logback.xml",
-        "-jar",
-        "pharmcat.jar",
+
+def get_report_path(name):
+    """Find the JSON report PharmCAT wrote for the output name."""
+    # Multi-sample VCFs in batch mode add the sample to the name
+    matches = sorted(glob.glob(os.path.join(LOCAL_DIR, f"{name}*.report.json")))
+    if not matches:
+        raise FileNotFoundError(f"PharmCAT didn't write a report for {name}")
+    return matches[0]
+
+
+def run_batch(input_paths, output_names, pharmcat_args):
+    """
+    Run PharmCAT on the VCFs in a new JVM, for when the worker isn't available.
+
+    A single VCF is named with its output name. Several are given to
+    PharmCAT's batch mode in a list file, and each report is named after its
+    VCF.
+    """
+    if len(input_paths) == 1:
+        vcf_args = ["-vcf", input_paths[0], "-bf", output_names[0]]
+    else:
+        list_path = os.path.join(LOCAL_DIR, f"{output_names[0]}.vcfs.txt")
+        with open(list_path, "w") as f:
+            f.writelines(f"{path}\n" for path in input_paths)
+        vcf_args = ["-vcf", list_path]
+    start = time.time()
+    for line in run_once(pharmcat_args + vcf_args):
+        print(line, end="")
+    print(f"Finished {len(input_paths)} VCFs in {time.time() - start:.2f}s")
+    # The JVM start isn't separable from the first VCF, and batch mode may
+    # process the VCFs concurrently, so each is timed by when its report was
+    # written
+    for name in output_names:
+        written_at = os.path.getmtime(get_report_path(name))
+        print(f"Wrote the report of {name} {written_at - start:.2f}s after start")
+
+
+def run_pharmcat(input_paths, base_filename):
+    """
+    Run PharmCAT on one or more preprocessed VCFs in a single JVM.
+
+    A single VCF is named with base_filename, several are named after their
+    VCFs, so the VCF file names need distinct prefixes. Each VCF is a
+    separate job of the warm worker, timed on its own, with the time spent
+    starting the worker reported separately. Without the worker, the VCFs
+    run together in a new JVM.
+
+    Args:
+        input_paths (list[str]): Paths of the preprocessed VCFs
+        base_filename (str): Output name of a single VCF
+
+    Returns:
+        list[str]: Path of the JSON report of each VCF
+    """
+    if len(input_paths) == 1:
+        output_names = [base_filename]
+    else:
+        output_names = [os.path.basename(path).split(".vcf")[0] for path in input_paths]
+    pharmcat_args = [
         "--reporter-extended",
         "--reporter-save-json",
         "--matcher-save-html",
-        "-vcf",
-        input_path,
         "-o",
         LOCAL_DIR,
-        "-bf",
-        vcf,
     ]
-    subprocess.run(cmd, check=True)
+    worker_start_seconds = pharmcat_worker.prepare()
+    if worker_start_seconds is None:
+        print("PharmCAT worker start: unavailable, using a new JVM")
+        run_batch(input_paths, output_names, pharmcat_args)
+    else:
+        warm = " (warm)" if worker_start_seconds == 0 else ""
+        print(f"PharmCAT worker start: {worker_start_seconds:.2f}s{warm}")
+        for input_path, name in zip(input_paths, output_names):
+            start = time.perf_counter()
+            job_args = pharmcat_args + ["-vcf", input_path, "-bf", name]
+            for line in pharmcat_worker.run(job_args):
+                print(line, end="")
+            print(f"Processed {name} in {time.perf_counter() - start:.2f}s")
+    return [get_report_path(name) for name in output_names]
+
+
+def transfer_concurrently(function, configs):
+    """Run an S3 transfer for every config at once."""
+    with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        # Consuming the results raises the first error
+        list(executor.map(function, configs))
 
 
 def lambda_handler(event, context):
@@ -41,6 +114,7 @@ def lambda_handler(event, context):
     s3_input_keys = event["s3Keys"]
     project = event["projectName"]
     source_vcf_key = event["sourceVcfKey"]
+    vcf_profile_key = event.get("vcfProfileKey")
     missing_to_ref = event["missingToRef"]
 
     pharmcat_configs = []
@@ -50,6 +124,7 @@ def lambda_handler(event, context):
                 {
                     "inputKey": key,
                     "outputKey": f"{request_id}.pharmcat.ref.json",
+                    "localInput": f"{request_id}.ref.vcf.bgz",
                 }
             )
         elif ".nonref." in key:
@@ -57,6 +132,7 @@ def lambda_handler(event, context):
                 {
                     "inputKey": key,
                     "outputKey": f"{request_id}.pharmcat.nonref.json",
+                    "localInput": f"{request_id}.nonref.vcf.bgz",
                 }
             )
         else:
@@ -64,39 +140,40 @@ def lambda_handler(event, context):
                 {
                     "inputKey": key,
                     "outputKey": f"{request_id}.pharmcat.json",
+                    "localInput": f"{request_id}.preprocessed.vcf.gz",
                 }
             )
-    s3_output_keys = []
+    for config in pharmcat_configs:
+        config["localInput"] = os.path.join(LOCAL_DIR, config["localInput"])
 
-    try:
-        for config in pharmcat_configs:
-            preprocessed_vcf = f"{request_id}.preprocessed.vcf.gz"
-
-            local_input_path = os.path.join(LOCAL_DIR, preprocessed_vcf)
-            s3_input_key = config["inputKey"]
-            s3_client.download_file(
-                Bucket=PGXFLOW_BUCKET,
-                Key=s3_input_key,
-                Filename=local_input_path,
-            )
-
-            run_pharmcat(local_input_path, request_id)
-            processed_json = f"{request_id}.report.json"
-            local_output_path = os.path.join(LOCAL_DIR, processed_json)
-
-            s3_output_key = config["outputKey"]
-            s3_client.upload_file(
-                Bucket=PGXFLOW_BUCKET,
-                Key=s3_output_key,
-                Filename=local_output_path,
-            )
+    def download_input(config):
+        s3_client.download_file(
+            Bucket=PGXFLOW_BUCKET,
+            Key=config["inputKey"],
+            Filename=config["localInput"],
+        )
 
-            s3_client.delete_object(
-                Bucket=PGXFLOW_BUCKET,
-                Key=s3_input_key,
-            )
+    def upload_output(config):
+        s3_client.upload_file(
+            Bucket=PGXFLOW_BUCKET,
+            Key=config["outputKey"],
+            Filename=config["localOutput"],
+        )
+        s3_client.delete_object(
+            Bucket=PGXFLOW_BUCKET,
+            Key=config["inputKey"],
+        )
 
-            s3_output_keys.append(s3_output_key)
+    try:
+        transfer_concurrently(download_input, pharmcat_configs)
+        # Every input shares one JVM start and load of the PharmCAT data
+        report_paths = run_pharmcat(
+            [config["localInput"] for config in pharmcat_configs], request_id
+        )
+        for config, report_path in zip(pharmcat_configs, report_paths):
+            config["localOutput"] = report_path
+        transfer_concurrently(upload_output, pharmcat_configs)
+        s3_output_keys = [config["outputKey"] for config in pharmcat_configs]
 
         lambda_client.invoke(
             FunctionName=PGXFLOW_PHARMCAT_POSTPROCESSOR_LAMBDA,
@@ -107,6 +184,7 @@ def lambda_handler(event, context):
                     "projectName": project,
                     "s3Keys": s3_output_keys,
                     "sourceVcfKey": source_vcf_key,
+                    "vcfProfileKey": vcf_profile_key,
                     "missingToRef": missing_to_ref,
                 }
             ),
@@ -0,0 +1,204 @@
+import os
+import subprocess
+import threading
+import time
+
+PHARMCAT_JAR = "pharmcat.jar"
+WORKER_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_CLASS = "PharmcatWorker"
+WORKER_READY = "PHARMCAT_WORKER_READY"
+WORKER_DONE = "PHARMCAT_WORKER_DONE"
+# A worker that takes longer than this to load PharmCAT is killed, and jobs
+# run in a new JVM instead
+WORKER_READY_TIMEOUT = int(os.environ.get("PHARMCAT_WORKER_READY_TIMEOUT", 60))
+# Class data sharing archive written by the image build, see the Dockerfile
+CDS_ARCHIVE = os.path.join(WORKER_DIR, "pharmcat.jsa")
+# Leaves the rest of the memory for python, metaspace and native buffers
+JVM_HEAP_FRACTION = 0.75
+
+
+def get_java_options():
+    """
+    Size the heap from the memory configured for the lambda, falling back to
+    2 GiB outside lambda, and map PharmCAT's classes from the CDS archive
+    when the image has one.
+    """
+    memory_size = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    heap = f"{int(int(memory_size) * JVM_HEAP_FRACTION)}m" if memory_size else "2g"
+    options = [
+        f"-Xmx{heap}",
+        "-Dlogback.configurationFile=/opt/logback.xml",
+    ]
+    if os.path.exists(CDS_ARCHIVE):
+        # The JVM ignores the archive with a warning if it doesn't match
+        options.append(f"-XX:SharedArchiveFile={CDS_ARCHIVE}")
+    return options
+
+
+def run_once(pharmcat_args):
+    """Run PharmCAT in a new JVM, yielding its output lines."""
+    cmd = ["java"] + get_java_options() + ["-jar", PHARMCAT_JAR] + pharmcat_args
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8"
+    )
+    yield from process.stdout
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+class PharmcatWorker:
+    """
+    A PharmCAT JVM kept running across invocations of a warm container.
+
+    The worker is started during init and takes jobs over its stdin, see
+    PharmcatWorker.java, so warm invocations don't pay for JVM startup and
+    class loading again. A worker that has died is started again for the
+    next job. If the worker class isn't built or the worker can't start,
+    jobs fall back to running PharmCAT in a new JVM.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.ready = False
+        self.started_at = None
+
+    @property
+    def available(self):
+        return os.path.exists(os.path.join(WORKER_DIR, f"{WORKER_CLASS}.class"))
+
+    def start(self):
+        if not self.available:
+            print(f"{WORKER_CLASS} isn't built, PharmCAT will run in a new JVM")
+            return
+        cmd = (
+            ["java"]
+            + get_java_options()
+            + [
+                # Lets the worker trap PharmCAT's calls to System.exit
+                "-Djava.security.manager=allow",
+                "-cp",
+                os.pathsep.join([PHARMCAT_JAR, WORKER_DIR]),
+                WORKER_CLASS,
+            ]
+        )
+        self.started_at = time.perf_counter()
+        try:
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                encoding="utf-8",
+            )
+        except OSError as e:
+            print(f"Couldn't start the PharmCAT worker: {e}")
+            self.process = None
+        self.ready = False
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.ready = False
+
+    def wait_until_ready(self):
+        """
+        Wait up to WORKER_READY_TIMEOUT seconds for the worker to load PharmCAT.
+
+        Returns:
+            bool: Whether the worker is ready. A worker that exits or misses
+                the deadline is stopped, so the job runs in a new JVM.
+        """
+        timed_out = threading.Event()
+
+        def kill_worker():
+            timed_out.set()
+            self.process.kill()
+
+        # Killing the worker ends its output, which stops the wait below
+        timer = threading.Timer(WORKER_READY_TIMEOUT, kill_worker)
+        timer.start()
+        try:
+            for line in self.process.stdout:
+                if line.rstrip("\n") == WORKER_READY:
+                    self.ready = True
+                    break
+                print(line, end="")
+        finally:
+            timer.cancel()
+        if self.ready and not timed_out.is_set():
+            print(
+                "PharmCAT worker started in"
+                f" {time.perf_counter() - self.started_at:.2f}s"
+            )
+            return True
+        if timed_out.is_set():
+            print(f"PharmCAT worker wasn't ready after {WORKER_READY_TIMEOUT}s")
+        else:
+            print(f"PharmCAT worker exited with status {self.process.wait()}")
+        self.stop()
+        return False
+
+    def prepare(self):
+        """
+        Start the worker if it isn't running and wait until it's ready.
+
+        Returns:
+            float: Seconds this call spent waiting for the worker, 0 if it
+                was already ready, or None if jobs will run in a new JVM
+        """
+        if self.ready and self.is_running():
+            return 0.0
+        start = time.perf_counter()
+        if not self.is_running() and self.available:
+            if self.process is not None:
+                print("PharmCAT worker has died, restarting it")
+            self.stop()
+            self.start()
+        if self.process is None or not (self.ready or self.wait_until_ready()):
+            return None
+        return time.perf_counter() - start
+
+    def run(self, pharmcat_args):
+        """
+        Run a PharmCAT job, yielding its output lines.
+
+        If the job doesn't run to its end, because the worker dies or the
+        caller stops reading, the worker is stopped and started again for
+        the next job.
+
+        Args:
+            pharmcat_args (list[str]): Arguments of the PharmCAT command
+
+        Raises:
+            subprocess.CalledProcessError: If PharmCAT fails or the worker
+                dies during the job
+        """
+        if self.prepare() is None:
+            yield from run_once(pharmcat_args)
+            return
+        finished = False
+        try:
+            self.process.stdin.write("\t".join(pharmcat_args) + "\n")
+            self.process.stdin.flush()
+            for line in self.process.stdout:
+                if line.startswith(WORKER_DONE):
+                    finished = True
+                    status = int(line.split()[1])
+                    if status != 0:
+                        raise subprocess.CalledProcessError(status, pharmcat_args)
+                    return
+                yield line
+            # The worker died before finishing the job
+            returncode = self.process.wait()
+            raise subprocess.CalledProcessError(returncode, pharmcat_args)
+        finally:
+            if not finished:
+                # Left unread, the rest of this job's output would be taken
+                # for the next job's, so the worker is started again instead
+                self.stop()
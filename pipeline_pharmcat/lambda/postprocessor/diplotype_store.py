@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+
+DIPLOTYPE_STORE_BYTES = int(os.environ.get("DIPLOTYPE_STORE_BYTES", 256 * 1024 * 1024))
+# Decoded diplotypes kept after spilling to sqlite
+DECODED_CACHE_SIZE = 4096
+# Rough size of an empty diplotype dict and its lists
+DIPLOTYPE_OVERHEAD_BYTES = 1024
+
+
+def estimate_size(diplotype):
+    """Estimate the memory held by a diplotype without encoding it."""
+    size = DIPLOTYPE_OVERHEAD_BYTES
+    for value in diplotype.values():
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, list):
+            # Lists hold allele names, phenotypes, rsIDs and mapping IDs
+            size += sum(len(item) for item in value if isinstance(item, str))
+    return size
+
+
+class DiplotypeStore:
+    """
+    Diplotypes keyed by mapping ID, for joining with drug annotations.
+
+    Diplotypes are kept as dicts until their estimated size passes
+    DIPLOTYPE_STORE_BYTES, then all of them are moved to a sqlite database
+    at sqlite_path. Each diplotype is decoded at most once while it stays in
+    the cache of recently used diplotypes, and get returns a shallow copy,
+    so annotation properties can be set on it without copying its lists.
+
+    Args:
+        sqlite_path (str): Path of the database to spill to
+        max_bytes (int): Estimated memory budget of the dict backend
+    """
+
+    def __init__(self, sqlite_path, max_bytes=DIPLOTYPE_STORE_BYTES):
+        self.sqlite_path = sqlite_path
+        self.max_bytes = max_bytes
+        self.diplotypes = {}
+        self.size = 0
+        self.db = None
+        self.decoded = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def spill(self):
+        print(
+            f"Diplotypes passed {self.max_bytes} bytes, moving"
+            f" {len(self.diplotypes)} to {self.sqlite_path}"
+        )
+        if os.path.exists(self.sqlite_path):
+            os.remove(self.sqlite_path)
+        self.db = sqlite3.connect(self.sqlite_path)
+        # Only this invocation uses the database
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE diplotypes (id TEXT PRIMARY KEY, record TEXT)")
+        self.put_many(self.diplotypes.items())
+        self.diplotypes = {}
+
+    def put_many(self, items):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO diplotypes VALUES (?, ?)",
+            (
+                (diplotype_id, json.dumps(diplotype))
+                for diplotype_id, diplotype in items
+            ),
+        )
+
+    def put(self, diplotype_id, diplotype):
+        """Store a diplotype, replacing any earlier one with the same ID."""
+        if self.db is not None:
+            self.decoded.pop(diplotype_id, None)
+            self.put_many([(diplotype_id, diplotype)])
+            return
+        self.diplotypes[diplotype_id] = diplotype
+        self.size += estimate_size(diplotype)
+        if self.size > self.max_bytes:
+            self.spill()
+
+    def get(self, diplotype_id):
+        """
+        Returns:
+            dict: A shallow copy of the diplotype, or None if it isn't stored
+        """
+        if self.db is None:
+            diplotype = self.diplotypes.get(diplotype_id)
+            return None if diplotype is None else dict(diplotype)
+        diplotype = self.decoded.get(diplotype_id)
+        if diplotype is not None:
+            self.decoded.move_to_end(diplotype_id)
+            return dict(diplotype)
+        row = self.db.execute(
+            "SELECT record FROM diplotypes WHERE id = ?", (diplotype_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        diplotype = json.loads(row[0])
+        self.decoded[diplotype_id] = diplotype
+        if len(self.decoded) > DECODED_CACHE_SIZE:
+            self.decoded.popitem(last=False)
+        return dict(diplotype)
+
+    def close(self):
+        self.diplotypes = {}
+        self.decoded.clear()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            os.remove(self.sqlite_path)
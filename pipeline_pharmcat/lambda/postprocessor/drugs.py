@@ -3,10 +3,7 @@ import json
 import os
 from html.parser import HTMLParser
 
-import ijson
-
-from utils import is_entering_array, is_exiting_array, is_entering_map, is_exiting_map
-
+from utils import ALL_EVENTS
 
 DRUGS = os.environ["DRUGS"].strip().split(",")
 GENES = os.environ["GENES"].strip().split(",")
@@ -49,150 +46,118 @@ def create_annotation_objects(current_organisation, current_drug, pmids):
     }
 
 
-def yield_drugs(pharmcat_output_json):
-    with open(pharmcat_output_json, "rb") as f:
-        parser = ijson.parse(f)
+class DrugsHandler:
+    """
+    Collect the drug annotations in the drugs section of a PharmCAT report,
+    one for each diplotype they apply to.
+
+    Args:
+        on_annotations (function): Called with the annotations (list[dict])
+            of each guideline, as soon as its annotations array ends
+    """
+
+    # Properties copied to every annotation of a guideline
+    GENERIC_PROPERTIES = {
+        "dosingInformation",
+        "alternateDrugAvailable",
+        "otherPrescribingGuidance",
+    }
+
+    def __init__(self, on_annotations):
+        self.on_annotations = on_annotations
+        self.pmids = []
+        self.annotations = []
+        self.base_annotation = None
+        self.annotation = None
 
+    def register(self, matcher):
         DRUG_ORGS = {entry["drug"] for entry in ORGANISATIONS}
-        current_org = None
-        current_drug = None
-        in_citation_array = False
-        in_annotation_array = False
-        in_annotation_diplotype_array = False
-
-        for prefix, event, value in parser:
-            # Filter by organisation
-            if prefix == "drugs" and event == "map_key":
-                current_org = value
-            if current_org not in DRUG_ORGS:
-                continue
-
-            # Filter by drug and accumulated drug info for each new drug
-            if prefix == f"drugs.{current_org}" and event == "map_key":
-                current_drug = value
-                # Reset annotations for each new drug
-            if current_drug not in DRUGS:
-                continue
-
-            # Check whether processing citations
-            citation_array_prefix = f"drugs.{current_org}.{current_drug}.citations"
-            if is_entering_array(
-                in_citation_array, prefix, event, citation_array_prefix
-            ):
-                # Reset pmids
-                pmids = []
-                in_citation_array = True
-
-            # Citation processing
-            if in_citation_array:
-                citation_prefix = f"{citation_array_prefix}.item"
-
-                # Store pmids in array to be added to annotation
-                if prefix == f"{citation_prefix}.pmid" and event == "string":
-                    pmids.append(value)
-
-                if is_exiting_array(prefix, event, citation_array_prefix):
-                    in_citation_array = False
-
-            # Check whether processing drug annotations
-            annotation_array_prefix = (
-                f"drugs.{current_org}.{current_drug}.guidelines.item.annotations"
-            )
-            if is_entering_array(
-                in_annotation_array, prefix, event, annotation_array_prefix
-            ):
-                annotations = []
-                in_annotation_array = True
-
-            # Annotation processing
-            if in_annotation_array:
-                # Reset drug annotation object at new occurrence
-                annotation_prefix = f"{annotation_array_prefix}.item"
-                if is_entering_map(prefix, event, annotation_prefix):
-                    base_annotation = create_annotation_objects(
-                        current_org, current_drug, pmids
-                    )
-
-                # Add drug implications
-                if (
-                    prefix == f"{annotation_prefix}.implications.item"
-                    and event == "string"
-                ):
-                    base_annotation["implications"].append(strip_html(value))
-
-                # Add recommendations
-                if (
-                    prefix == f"{annotation_prefix}.drugRecommendation"
-                    and event == "string"
-                ):
-                    base_annotation["recommendation"] = strip_html(value)
-
-                # Add classification
-                if (
-                    prefix == f"{annotation_prefix}.classification"
-                    and event == "string"
-                ):
-                    base_annotation["classification"] = value
-
-                # Add population
-                if prefix == f"{annotation_prefix}.population" and event == "string":
-                    base_annotation["population"] = value
-
-                annotation_diplotype_array_prefix = (
-                    f"{annotation_prefix}.genotypes.item.diplotypes"
-                )
-                if is_entering_array(
-                    in_annotation_diplotype_array,
-                    prefix,
-                    event,
-                    annotation_diplotype_array_prefix,
-                ):
-                    in_annotation_diplotype_array = True
-
-                # Retrieving alleles - used to link drugs back to condensed diplotypes
-                if in_annotation_diplotype_array:
-                    annotation_diplotype_prefix = (
-                        f"{annotation_diplotype_array_prefix}.item"
-                    )
-
-                    if is_entering_map(prefix, event, annotation_diplotype_prefix):
-                        annotation = deepcopy(base_annotation)
-
-                    if (
-                        prefix == f"{annotation_diplotype_prefix}.gene"
-                        and event == "string"
-                    ):
-                        annotation["gene"] = value
-
-                    for allele in ["allele1", "allele2"]:
-                        if (
-                            prefix == f"{annotation_diplotype_prefix}.{allele}.name"
-                            and event == "string"
-                        ):
-                            annotation["alleles"].append(value)
-
-                    if (
-                        is_exiting_map(prefix, event, annotation_diplotype_prefix)
-                        and annotation.get("gene") in GENES
-                    ):
-                        annotations.append(annotation)
-
-                    if (
-                        prefix == annotation_diplotype_array_prefix
-                        and event == "end_array"
-                    ):
-                        in_annotation_diplotype_array = False
-
-                # Update generically structured properties of drug annotations
-                for key in [
-                    ("dosingInformation"),
-                    ("alternateDrugAvailable"),
-                    ("otherPrescribingGuidance"),
-                ]:
-                    if prefix == f"{annotation_prefix}.{key}":
-                        for annotation in annotations:
-                            annotation[key] = value
-
-                if is_exiting_array(prefix, event, annotation_array_prefix):
-                    yield annotations
-                    in_annotation_array = False
+        drug_path = ("drugs", DRUG_ORGS, DRUGS)
+        annotations_path = drug_path + ("guidelines", "item", "annotations")
+        annotation_path = annotations_path + ("item",)
+        diplotype_path = annotation_path + ("genotypes", "item", "diplotypes", "item")
+        matcher.register(
+            drug_path + ("citations",), ("start_array",), self.start_citations
+        )
+        matcher.register(
+            drug_path + ("citations", "item", "pmid"), ("string",), self.add_pmid
+        )
+        matcher.register(annotations_path, ("start_array",), self.start_annotations)
+        matcher.register(annotations_path, ("end_array",), self.end_annotations)
+        matcher.register(annotation_path, ("start_map",), self.start_annotation)
+        matcher.register(
+            annotation_path + ("implications", "item"),
+            ("string",),
+            self.add_implication,
+        )
+        matcher.register(
+            annotation_path + ("drugRecommendation",),
+            ("string",),
+            self.set_recommendation,
+        )
+        matcher.register(
+            annotation_path + ({"classification", "population"},),
+            ("string",),
+            self.set_property,
+        )
+        matcher.register(
+            annotation_path + (self.GENERIC_PROPERTIES,),
+            ALL_EVENTS,
+            self.set_generic_property,
+        )
+        matcher.register(diplotype_path, ("start_map",), self.start_diplotype)
+        matcher.register(diplotype_path, ("end_map",), self.end_diplotype)
+        matcher.register(diplotype_path + ("gene",), ("string",), self.set_gene)
+        matcher.register(
+            diplotype_path + ({"allele1", "allele2"}, "name"),
+            ("string",),
+            self.add_allele,
+        )
+
+    def start_citations(self, captures, value):
+        self.pmids = []
+
+    def add_pmid(self, captures, value):
+        # Stored to be added to annotations
+        self.pmids.append(value)
+
+    def start_annotations(self, captures, value):
+        self.annotations = []
+
+    def end_annotations(self, captures, value):
+        self.on_annotations(self.annotations)
+
+    def start_annotation(self, captures, value):
+        current_org, current_drug = captures
+        self.base_annotation = create_annotation_objects(
+            current_org, current_drug, self.pmids
+        )
+
+    def add_implication(self, captures, value):
+        self.base_annotation["implications"].append(strip_html(value))
+
+    def set_recommendation(self, captures, value):
+        self.base_annotation["recommendation"] = strip_html(value)
+
+    def set_property(self, captures, value):
+        *_, key = captures
+        self.base_annotation[key] = value
+
+    def set_generic_property(self, captures, value):
+        *_, key = captures
+        for annotation in self.annotations:
+            annotation[key] = value
+
+    def start_diplotype(self, captures, value):
+        self.annotation = deepcopy(self.base_annotation)
+
+    def set_gene(self, captures, value):
+        self.annotation["gene"] = value
+
+    def add_allele(self, captures, value):
+        # Used to link drugs back to condensed diplotypes
+        self.annotation["alleles"].append(value)
+
+    def end_diplotype(self, captures, value):
+        if self.annotation.get("gene") in GENES:
+            self.annotations.append(self.annotation)
@@ -1,20 +1,19 @@
+from bisect import bisect_left
+from collections import defaultdict
 import json
 import os
 import re
 
-import ijson
-
-from shared.utils import CheckedProcess, get_chromosome_mapping, match_chromosome_name
-from utils import (
-    is_entering_array,
-    is_exiting_array,
-    is_entering_map,
-    is_exiting_map,
-    create_b64_id,
+from shared.utils import (
+    CheckedProcess,
+    get_vcf_profile,
+    match_chromosome_name,
 )
+from utils import ALL_EVENTS, create_b64_id
 
-
+LOCAL_DIR = "/tmp"
 DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
+PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
 GENES = os.environ["GENES"].strip().split(",")
 ORGANISATIONS = json.loads(os.environ["ORGANISATIONS"])
 
@@ -22,6 +21,8 @@ REQUESTED_FIELDS = {
     "posVcf": "%POS",
     "refVcf": "%REF",
     "_alts": "%ALT",
+    # POS plus the length of REF, or INFO/END for gVCF reference blocks
+    "_end": "%END",
     "qual": "%QUAL",
     "filter": "%FILTER",
 }
@@ -35,24 +36,71 @@ REQUESTED_FORMAT_TAGS = {
 }
 
 
-def query_variant_zygosity(chrom_mapping, vcf_s3_location, chrom, pos, query_fields):
+def query_variant_genotypes(chrom_mapping, vcf_s3_location, positions, query_fields):
+    """
+    Query the source VCF once for all variant positions.
+
+    Args:
+        chrom_mapping (dict): Source VCF chromosome names to normalised names
+        vcf_s3_location (str): Location of the source VCF
+        positions (set): (chromosome, position) tuples to query
+        query_fields (dict): Output keys to bcftools query format fields
+
+    Returns:
+        dict: (VCF chromosome, position) to the raw query fields of the first
+            record overlapping that position
+    """
     reversed_chrom_mapping = {v: k for k, v in chrom_mapping.items()}
-    chrom = reversed_chrom_mapping[match_chromosome_name(chrom)]
+    requested = defaultdict(set)
+    for chrom, pos in positions:
+        requested[reversed_chrom_mapping[match_chromosome_name(chrom)]].add(int(pos))
+    genotypes = {}
+    if not requested:
+        return genotypes
+
+    local_regions_path = os.path.join(LOCAL_DIR, "zygosity_regions.txt")
+    with open(local_regions_path, "w") as f:
+        for chrom, chrom_positions in requested.items():
+            for pos in sorted(chrom_positions):
+                f.write(f"{chrom}\t{pos}\t{pos}\n")
+    requested = {chrom: sorted(pos_set) for chrom, pos_set in requested.items()}
+
     args = [
         "bcftools",
         "query",
         "-f",
-        "\t".join(query_fields.values()) + "\n",
+        "%CHROM\t" + "\t".join(query_fields.values()) + "\n",
         vcf_s3_location,
-        "-r",
-        f"{chrom}:{pos}-{pos}",
+        "-R",
+        local_regions_path,
     ]
     query_process = CheckedProcess(args)
-    query_output = query_process.check()
+    for line in query_process.stdout:
+        chrom, *values = line.rstrip("\n").split("\t")
+        record = dict(zip(query_fields.keys(), values))
+        # Like a -r chrom:pos-pos query, a record matches every requested
+        # position it spans, including those in gVCF reference blocks
+        start = int(record["posVcf"])
+        end = int(record.pop("_end"))
+        chrom_positions = requested.get(chrom, [])
+        i = bisect_left(chrom_positions, start)
+        while i < len(chrom_positions) and chrom_positions[i] <= end:
+            genotypes.setdefault((chrom, chrom_positions[i]), record)
+            i += 1
+    query_process.check()
+    os.remove(local_regions_path)
+    print(f"Found genotypes for {len(genotypes)}/{len(positions)} variant positions")
+    return genotypes
+
+
+def resolve_variant_zygosity(chrom_mapping, genotypes, chrom, pos, query_fields):
+    reversed_chrom_mapping = {v: k for k, v in chrom_mapping.items()}
+    chrom = reversed_chrom_mapping[match_chromosome_name(chrom)]
+    record = genotypes.get((chrom, int(pos)))
     output = {
         "chromRef": chrom_mapping[chrom],
     }
-    if not query_output:
+    if record is None:
         output |= {
             key: "." for key in query_fields.keys() if key.startswith("_") is False
         } | {
@@ -61,10 +109,7 @@ def query_variant_zygosity(chrom_mapping, vcf_s3_location, chrom, pos, query_fie
             "zygosity": "0|0",
         }
     else:
-        output |= {
-            key: value
-            for key, value in zip(query_fields.keys(), query_output.strip().split("\t"))
-        }
+        output |= record
         alts = [output["refVcf"]] + output.pop("_alts").split(",")
         alts_vcf = [
             alts[int(i)] if i.isdigit() else "."
@@ -101,25 +146,7 @@ def create_variant(current_org):
     }
 
 
-def get_format_tags(location):
-    args = [
-        "bcftools",
-        "head",
-        location,
-    ]
-    process = CheckedProcess(args)
-    format_tags = {
-        line.split("ID=")[1].split(",")[0]
-        for line in process.stdout
-        if line.startswith("##FORMAT=<ID=")
-    }
-    process.check()
-    print("Found FORMAT tags:", format_tags)
-    return format_tags
-
-
-def get_query_fields(location):
-    format_tags = get_format_tags(location)
+def get_query_fields(format_tags):
     return {
         **REQUESTED_FIELDS,
         **{
@@ -129,146 +156,172 @@ def get_query_fields(location):
     }
 
 
-def yield_genes(pharmcat_output_json, source_vcf):
+class GenesHandler:
+    """
+    Collect the diplotypes and called variants in the genes section of a
+    PharmCAT report, before zygosity is added by resolve_genes.
+
+    Args:
+        on_gene (function): Called with (diplotypes, diplotypeIds, variants)
+            for each gene, as soon as its variants array ends
+        on_genes_end (function): Called once the genes section ends
+    """
+
+    # PharmCAT variant properties to variant keys
+    VARIANT_PROPERTIES = {
+        "chromosome": "chr",
+        "position": "pos",
+        "dbSnpId": "rsid",
+        "call": "call",
+    }
+
+    def __init__(self, on_gene, on_genes_end=None):
+        self.on_gene = on_gene
+        self.on_genes_end = on_genes_end
+        self.diplotypes = []
+        self.diplotype_ids = []
+        self.variants = []
+        self.diplotype = None
+        self.variant = None
+
+    def register(self, matcher):
+        GENE_ORGS = {entry["gene"] for entry in ORGANISATIONS}
+        gene_path = ("genes", GENE_ORGS, GENES)
+        diplotype_path = gene_path + ("sourceDiplotypes", "item")
+        variants_path = gene_path + ("variants",)
+        variant_path = variants_path + ("item",)
+        if self.on_genes_end is not None:
+            matcher.register(("genes",), ("end_map",), self.end_genes)
+        matcher.register(gene_path, ("start_map",), self.start_gene)
+        matcher.register(diplotype_path, ("start_map",), self.start_diplotype)
+        matcher.register(diplotype_path, ("end_map",), self.end_diplotype)
+        matcher.register(
+            diplotype_path + ({"allele1", "allele2"}, "name"),
+            ("string",),
+            self.add_diplotype_allele,
+        )
+        matcher.register(
+            diplotype_path + ("phenotypes", "item"),
+            ("string",),
+            self.add_phenotype,
+        )
+        matcher.register(variants_path, ("end_array",), self.end_variants)
+        matcher.register(variant_path, ("start_map",), self.start_variant)
+        matcher.register(variant_path, ("end_map",), self.end_variant)
+        matcher.register(
+            variant_path + (self.VARIANT_PROPERTIES,),
+            ALL_EVENTS,
+            self.set_variant_property,
+        )
+        matcher.register(
+            variant_path + ("alleles", "item"),
+            ALL_EVENTS,
+            self.add_variant_allele,
+        )
+
+    def start_gene(self, captures, value):
+        # Reset the list of diplotypes for each new gene
+        self.diplotypes = []
+        self.diplotype_ids = []
+        self.variants = []
+
+    def start_diplotype(self, captures, value):
+        current_org, current_gene = captures
+        self.diplotype = create_diplotype(current_org, current_gene)
+
+    def add_diplotype_allele(self, captures, value):
+        self.diplotype["alleles"].append(value)
+
+    def add_phenotype(self, captures, value):
+        self.diplotype["phenotypes"].append(value)
+
+    def end_diplotype(self, captures, value):
+        self.diplotypes.append(self.diplotype)
+        # Create an ID to map between diplotypes and drugs
+        self.diplotype_ids.append(
+            create_b64_id(
+                self.diplotype["org"],
+                self.diplotype["gene"],
+                self.diplotype["alleles"],
+            )
+        )
+
+    def start_variant(self, captures, value):
+        current_org, _ = captures
+        self.variant = create_variant(current_org)
+
+    def set_variant_property(self, captures, value):
+        *_, property = captures
+        self.variant[self.VARIANT_PROPERTIES[property]] = value
+
+    def add_variant_allele(self, captures, value):
+        self.variant["alleles"].append(value)
+
+    def end_variant(self, captures, value):
+        if self.variant["call"] is not None:
+            # Zygosity is added once every variant position is known
+            self.variants.append(self.variant)
+
+    def end_variants(self, captures, value):
+        # Hand over the diplotypes and variants at the end of the chunk
+        self.on_gene((self.diplotypes, self.diplotype_ids, self.variants))
+
+    def end_genes(self, captures, value):
+        self.on_genes_end()
+
+
+def resolve_genes(gene_chunks, source_vcf, vcf_profile_key=None):
     """
-    Parse PharmCAT output JSON and yield gene information with diplotypes and variants.
+    Add zygosity from the source VCF to the variants collected by GenesHandler
+    and link them to the diplotypes of their gene.
 
     Args:
-        pharmcat_output_json (str): Path to the PharmCAT output JSON file
+        gene_chunks (list[tuple]): (diplotypes, diplotypeIds, variants) for
+            each gene, from GenesHandler
         source_vcf (str): Path to the source VCF file
+        vcf_profile_key (str): Key of the source VCF profile saved by initFlow
 
     Yields:
         tuple: (diplotypes, diplotypeIds, variants) for each gene
     """
     input_vcf_s3_uri = f"s3://{DPORTAL_BUCKET}/{source_vcf}"
-    chrom_mapping = get_chromosome_mapping(input_vcf_s3_uri)
-    query_fields = get_query_fields(input_vcf_s3_uri)
-    with open(pharmcat_output_json, "rb") as f:
-        parser = ijson.parse(f)
+    vcf_profile = get_vcf_profile(input_vcf_s3_uri, PGXFLOW_BUCKET, vcf_profile_key)
+    chrom_mapping = vcf_profile["chromosome_mapping"]
+    query_fields = get_query_fields(vcf_profile["format_tags"])
+    genotypes = query_variant_genotypes(
+        chrom_mapping,
+        input_vcf_s3_uri,
+        {
+            (variant["chr"], variant["pos"])
+            for _, _, variants in gene_chunks
+            for variant in variants
+        },
+        query_fields,
+    )
+    for diplotypes, diplotype_ids, variants in gene_chunks:
+        for variant in variants:
+            # Add zygosity and pos/ref/alt using the source VCF
+            variant.update(
+                resolve_variant_zygosity(
+                    chrom_mapping,
+                    genotypes,
+                    variant["chr"],
+                    variant["pos"],
+                    query_fields,
+                )
+            )
 
-        GENE_ORGS = {entry["gene"] for entry in ORGANISATIONS}
-        current_org = None
-        current_gene = None
-        in_diplotype_array = False
-        in_variant_array = False
-
-        for prefix, event, value in parser:
-            # Filter by organisation
-            if prefix == "genes" and event == "map_key":
-                current_org = value
-            if current_org not in GENE_ORGS:
-                continue
-
-            # Filter by gene and reset the list of diplotypes for each new gene
-            if prefix == f"genes.{current_org}" and event == "map_key":
-                current_gene = value
-                diplotypes = []
-                diplotype_ids = []
-                variants = []
-            if current_gene not in GENES:
-                continue
-
-            # Check whether processing diplotypes
-            diplotype_array_prefix = (
-                f"genes.{current_org}.{current_gene}.sourceDiplotypes"
+            # Create an ID to uniquely identify variants - eliminiates duplicate variants
+            variant["mapping"] = create_b64_id(
+                variant["org"],
+                variant["rsid"],
+                variant["call"],
+                variant["zygosity"],
             )
-            if is_entering_array(
-                in_diplotype_array, prefix, event, diplotype_array_prefix
-            ):
-                in_diplotype_array = True
-
-            # Diplotype preocessing
-            if in_diplotype_array:
-                # Reset diplotype object at new occurence
-                diplotype_prefix = f"{diplotype_array_prefix}.item"
-                if is_entering_map(prefix, event, diplotype_prefix):
-                    diplotype = create_diplotype(current_org, current_gene)
-
-                for allele in ["allele1", "allele2"]:
-                    if (
-                        prefix == f"{diplotype_prefix}.{allele}.name"
-                        and event == "string"
-                    ):
-                        diplotype["alleles"].append(value)
-
-                if (
-                    prefix == f"{diplotype_prefix}.phenotypes.item"
-                    and event == "string"
-                ):
-                    diplotype["phenotypes"].append(value)
-
-                if is_exiting_map(prefix, event, diplotype_prefix):
-                    diplotypes.append(diplotype)
-                    # Create an ID to map between diplotypes and drugs
-                    diplotype_b64_id = create_b64_id(
-                        diplotype["org"], diplotype["gene"], diplotype["alleles"]
-                    )
-                    diplotype_ids.append(diplotype_b64_id)
-
-                if is_exiting_array(prefix, event, diplotype_array_prefix):
-                    in_diplotype_array = False
-
-            variant_array_prefix = f"genes.{current_org}.{current_gene}.variants"
-            if is_entering_array(in_variant_array, prefix, event, variant_array_prefix):
-                in_variant_array = True
-
-            if in_variant_array:
-                variant_prefix = f"{variant_array_prefix}.item"
-                if is_entering_map(prefix, event, variant_prefix):
-                    variant = create_variant(current_org)
-
-                # Update generically structured properties of variants
-                for property, key in [
-                    ("chromosome", "chr"),
-                    ("position", "pos"),
-                    ("dbSnpId", "rsid"),
-                    ("call", "call"),
-                ]:
-                    if prefix == f"{variant_prefix}.{property}":
-                        variant[key] = value
-
-                # Update the list of alleles associated with a variant
-                if prefix == f"{variant_prefix}.alleles.item":
-                    variant["alleles"].append(value)
-
-                if (
-                    prefix == variant_prefix
-                    and event == "end_map"
-                    and variant["call"] is not None
-                ):
-                    # Add zygosity and pos/ref/alt using the source VCF
-                    zygosity = query_variant_zygosity(
-                        chrom_mapping,
-                        input_vcf_s3_uri,
-                        variant["chr"],
-                        variant["pos"],
-                        query_fields,
-                    )
-                    if not zygosity:
-                        continue
-                    variant.update(zygosity)
-
-                    # Create an ID to uniquely identify variants - eliminiates duplicate variants
-                    variant_b64_id = create_b64_id(
-                        variant["org"],
-                        variant["rsid"],
-                        variant["call"],
-                        variant["zygosity"],
-                    )
-                    variant["mapping"] = variant_b64_id
-
-                    variants.append(variant)
-
-                    # Store the variant's rsid and mapping ID to associated diplotypes
-                    for diplotype in diplotypes:
-                        if set(diplotype["alleles"]) & set(variant["alleles"]):
-                            diplotype["variants"].append(variant["rsid"])
-                            diplotype["mapping"].append(variant["mapping"])
-
-                # Yield the diplotype and associated variants at the end of the chunk
-                if is_exiting_array(prefix, event, variant_array_prefix):
-                    yield (diplotypes, diplotype_ids, variants)
-                    in_variant_array = False
-
-            else:
-                continue
+
+            # Store the variant's rsid and mapping ID to associated diplotypes
+            for diplotype in diplotypes:
+                if set(diplotype["alleles"]) & set(variant["alleles"]):
+                    diplotype["variants"].append(variant["rsid"])
+                    diplotype["mapping"].append(variant["mapping"])
+        yield (diplotypes, diplotype_ids, variants)
@@ -1,11 +1,13 @@
+from contextlib import nullcontext
 import json
 import os
 
-from genes import yield_genes, create_diplotype
-from drugs import yield_drugs
-from messages import yield_messages
-from utils import create_b64_id
-from shared.utils import handle_failed_execution, LoggingClient
+from genes import create_diplotype, GenesHandler, resolve_genes
+from diplotype_store import DiplotypeStore
+from drugs import DrugsHandler
+from messages import MessagesHandler
+from utils import create_b64_id, parse_report
+from shared.utils import handle_failed_execution, LoggingClient, S3MultipartWriter
 
 LOCAL_DIR = "/tmp"
 PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
@@ -16,88 +18,197 @@ lambda_client = LoggingClient("lambda")
 s3_client = LoggingClient("s3")
 
 
-def write_messages(messages_jsonl, local_input_path):
-    with open(messages_jsonl, "w") as m_f:
-        for message_chunk in yield_messages(local_input_path):
-            for message in message_chunk:
-                json.dump(message, m_f)
-                m_f.write("\n")
+def write_messages(m_f, messages):
+    for message in messages:
+        json.dump(message, m_f)
+        m_f.write("\n")
+
+
+class ReportJoin:
+    """
+    Join the drug annotations of a PharmCAT report to the diplotypes of its
+    genes while the report is being parsed.
+
+    The genes section comes before the drugs section, so genes are resolved
+    against the source VCF as soon as it ends, and each guideline's
+    annotations are written out as soon as they are parsed. Annotations
+    that arrive before the genes are resolved are held until they are.
+
+    Args:
+        diplotype_store (DiplotypeStore): Store for the resolved diplotypes
+        variants_file (file): Open JSONL file for the variants
+        diplotypes_file (file): Open JSONL file for the annotated diplotypes
+        source_vcf_key (str): Key of the source VCF in the dportal bucket
+        vcf_profile_key (str): Key of the source VCF profile saved by initFlow
+    """
+
+    def __init__(
+        self,
+        diplotype_store,
+        variants_file,
+        diplotypes_file,
+        source_vcf_key,
+        vcf_profile_key=None,
+    ):
+        self.diplotype_store = diplotype_store
+        self.variants_file = variants_file
+        self.diplotypes_file = diplotypes_file
+        self.source_vcf_key = source_vcf_key
+        self.vcf_profile_key = vcf_profile_key
+        self.drugs_to_genes = {entry["drug"]: entry["gene"] for entry in ORGANISATIONS}
+        self.gene_chunks = []
+        self.pending_annotation_chunks = []
+        self.genes_resolved = False
+
+    def add_gene(self, gene_chunk):
+        self.gene_chunks.append(gene_chunk)
+
+    def resolve_genes(self):
+        if self.genes_resolved:
+            return
+        write_diplotypes_and_variants(
+            self.gene_chunks,
+            self.source_vcf_key,
+            self.diplotype_store,
+            self.variants_file,
+            self.vcf_profile_key,
+        )
+        self.gene_chunks = []
+        self.genes_resolved = True
+        write_annotations(
+            self.diplotype_store,
+            self.diplotypes_file,
+            self.pending_annotation_chunks,
+            self.drugs_to_genes,
+        )
+        self.pending_annotation_chunks = []
+
+    def add_annotations(self, annotations):
+        if not self.genes_resolved:
+            self.pending_annotation_chunks.append(annotations)
+            return
+        write_annotations(
+            self.diplotype_store,
+            self.diplotypes_file,
+            [annotations],
+            self.drugs_to_genes,
+        )
+
+
+def read_report(local_input_path, messages_jsonl, with_messages, report_join=None):
+    """
+    Walk a PharmCAT report once, writing messages and joined annotations as
+    they are parsed.
+
+    Args:
+        local_input_path (str): Path to the PharmCAT report
+        messages_jsonl (str): Path to write the messages to
+        with_messages (bool): Whether to write the messages
+        report_join (ReportJoin): Join for the genes and drug annotations,
+            if they are needed
+    """
+    handlers = []
+    if report_join is not None:
+        handlers.append(
+            GenesHandler(report_join.add_gene, on_genes_end=report_join.resolve_genes)
+        )
+        handlers.append(DrugsHandler(report_join.add_annotations))
+    with open(messages_jsonl, "w") if with_messages else nullcontext() as m_f:
+        if with_messages:
+            handlers.append(
+                MessagesHandler(lambda messages: write_messages(m_f, messages))
+            )
+        parse_report(local_input_path, handlers)
+    if report_join is not None:
+        # In case the report has no genes section
+        report_join.resolve_genes()
 
 
 def write_diplotypes_and_variants(
-    local_input_path,
+    gene_chunks,
     source_vcf_key,
-    tmp_diplotypes_jsonl,
-    variants_jsonl,
+    diplotype_store,
+    v_f,
+    vcf_profile_key=None,
 ):
-    diplotype_offsets = {}
-    with open(tmp_diplotypes_jsonl, "w") as d1_f, open(variants_jsonl, "w") as v_f:
-        for (
-            diplotype_chunk,
-            diplotype_id_chunk,
-            variant_chunk,
-        ) in yield_genes(local_input_path, source_vcf_key):
-            for i in range(len(diplotype_chunk)):
-                offset = d1_f.tell()
-                diplotype_id = diplotype_id_chunk[i]
-                diplotype_offsets[diplotype_id] = offset
-                json.dump(diplotype_chunk[i], d1_f)
-                d1_f.write("\n")
-
-            visited_mapping_ids = set()
-            for variant in variant_chunk:
-                mapping_id = variant["mapping"]
-                if mapping_id not in visited_mapping_ids:
-                    visited_mapping_ids.add(mapping_id)
-                    json.dump(variant, v_f)
-                    v_f.write("\n")
-
-    return diplotype_offsets
+    for (
+        diplotype_chunk,
+        diplotype_id_chunk,
+        variant_chunk,
+    ) in resolve_genes(gene_chunks, source_vcf_key, vcf_profile_key):
+        for diplotype_id, diplotype in zip(diplotype_id_chunk, diplotype_chunk):
+            diplotype_store.put(diplotype_id, diplotype)
+
+        visited_mapping_ids = set()
+        for variant in variant_chunk:
+            mapping_id = variant["mapping"]
+            if mapping_id not in visited_mapping_ids:
+                visited_mapping_ids.add(mapping_id)
+                json.dump(variant, v_f)
+                v_f.write("\n")
 
 
 def write_annotations(
-    tmp_diplotypes_jsonl,
-    diplotypes_jsonl,
-    local_input_path,
-    diplotype_offsets,
+    diplotype_store,
+    d2_f,
+    annotation_chunks,
     drugs_to_genes,
 ):
-    with open(tmp_diplotypes_jsonl, "rb") as d1_f, open(diplotypes_jsonl, "w") as d2_f:
-        for annotation_chunk in yield_drugs(local_input_path):
-            for i in range(len(annotation_chunk)):
-                annotation = annotation_chunk[i]
-
-                diplotype_mapping_id = create_b64_id(
+    for annotation_chunk in annotation_chunks:
+        for annotation in annotation_chunk:
+            diplotype_mapping_id = create_b64_id(
+                drugs_to_genes.get(annotation["org"]),
+                annotation["gene"],
+                annotation["alleles"],
+            )
+            diplotype = diplotype_store.get(diplotype_mapping_id)
+            if diplotype is None:
+                diplotype = create_diplotype(
                     drugs_to_genes.get(annotation["org"]),
                     annotation["gene"],
-                    annotation["alleles"],
                 )
-                offset = diplotype_offsets.get(diplotype_mapping_id)
-                if offset is not None:
-                    d1_f.seek(offset)
-                    diplotype = json.loads(d1_f.readline())
-                else:
-                    diplotype = create_diplotype(
-                        drugs_to_genes.get(annotation["org"]),
-                        annotation["gene"],
-                    )
-                for prop in [
-                    # Organisation from drug annotation replaces org from gene
-                    "org",
-                    "drug",
-                    "pmids",
-                    "implications",
-                    "recommendation",
-                    "classification",
-                    "population",
-                    "dosingInformation",
-                    "alternateDrugAvailable",
-                    "otherPrescribingGuidance",
-                ]:
-                    diplotype[prop] = annotation[prop]
-
-                json.dump(diplotype, d2_f)
-                d2_f.write("\n")
+            for prop in [
+                # Organisation from drug annotation replaces org from gene
+                "org",
+                "drug",
+                "pmids",
+                "implications",
+                "recommendation",
+                "classification",
+                "population",
+                "dosingInformation",
+                "alternateDrugAvailable",
+                "otherPrescribingGuidance",
+            ]:
+                diplotype[prop] = annotation[prop]
+
+            json.dump(diplotype, d2_f)
+            d2_f.write("\n")
+
+
+def write_merged_json(s3_output_key, sections):
+    """
+    Stream a JSON object with an array for each JSONL file to S3.
+
+    Rows are copied through one line at a time, so memory use doesn't grow
+    with the number of rows.
+
+    Args:
+        s3_output_key (str): Key of the merged JSON in PGXFLOW_BUCKET
+        sections (dict): Top level key to the path of a JSONL file
+    """
+    with S3MultipartWriter(PGXFLOW_BUCKET, s3_output_key) as writer:
+        writer.write("{")
+        for i, (name, jsonl_path) in enumerate(sections.items()):
+            writer.write(f"{', ' if i else ''}{json.dumps(name)}: [")
+            separator = "\n"
+            with open(jsonl_path, "r") as f:
+                for line in f:
+                    writer.write(separator)
+                    writer.write(line.rstrip("\n"))
+                    separator = ",\n"
+            writer.write("\n]")
+        writer.write("}\n")
 
 
 def lambda_handler(event, _):
@@ -105,6 +216,7 @@ def lambda_handler(event, _):
     request_id = event["requestId"]
     s3_input_keys = event["s3Keys"]
     source_vcf_key = event["sourceVcfKey"]
+    vcf_profile_key = event.get("vcfProfileKey")
     project = event["projectName"]
     missing_to_ref = event["missingToRef"]
 
@@ -136,8 +248,8 @@ def lambda_handler(event, _):
 
     try:
         processed_json = f"{request_id}.pharmcat.json"
-        tmp_diplotypes_jsonl = os.path.join(
-            LOCAL_DIR, f"tmp_diplotypes_{processed_json}l"
+        diplotypes_sqlite = os.path.join(
+            LOCAL_DIR, f"diplotypes_{request_id}.pharmcat.sqlite"
         )
         diplotypes_jsonl = os.path.join(LOCAL_DIR, f"diplotypes_{processed_json}l")
         variants_jsonl = os.path.join(LOCAL_DIR, f"variants_{processed_json}l")
@@ -152,50 +264,29 @@ def lambda_handler(event, _):
             )
 
             pipeline_role = config.get("pipelineRole")
-            if not missing_to_ref or pipeline_role == "messages":
-                write_messages(
-                    messages_jsonl,
-                    local_input_path,
-                )
-
+            with_messages = not missing_to_ref or pipeline_role == "messages"
             if not missing_to_ref or pipeline_role == "annotations":
-                diplotype_offsets = write_diplotypes_and_variants(
-                    local_input_path,
-                    source_vcf_key,
-                    tmp_diplotypes_jsonl,
-                    variants_jsonl,
-                )
-
-                drugs_to_genes = {
-                    entry["drug"]: entry["gene"] for entry in ORGANISATIONS
-                }
-                write_annotations(
-                    tmp_diplotypes_jsonl,
-                    diplotypes_jsonl,
-                    local_input_path,
-                    diplotype_offsets,
-                    drugs_to_genes,
-                )
+                with DiplotypeStore(diplotypes_sqlite) as diplotype_store, open(
+                    variants_jsonl, "w"
+                ) as v_f, open(diplotypes_jsonl, "w") as d2_f:
+                    report_join = ReportJoin(
+                        diplotype_store, v_f, d2_f, source_vcf_key, vcf_profile_key
+                    )
+                    read_report(
+                        local_input_path, messages_jsonl, with_messages, report_join
+                    )
+            else:
+                read_report(local_input_path, messages_jsonl, with_messages)
 
         s3_output_key = f"{request_id}.postprocessed.json"
 
-        def load_jsonl(file_obj):
-            return [json.loads(line) for line in file_obj]
-
-        # Not memory safe, will be replaced merged with streaming process when sns orchestration is implemented
-        with open(messages_jsonl, "rb") as m_f, open(
-            diplotypes_jsonl, "rb"
-        ) as d_f, open(variants_jsonl, "rb") as v_f:
-            merged = {
-                "messages": load_jsonl(m_f),
-                "diplotypes": load_jsonl(d_f),
-                "variants": load_jsonl(v_f),
-            }
-
-        s3_client.put_object(
-            Bucket=PGXFLOW_BUCKET,
-            Key=s3_output_key,
-            Body=json.dumps(merged, indent=2).encode(),
+        write_merged_json(
+            s3_output_key,
+            {
+                "messages": messages_jsonl,
+                "diplotypes": diplotypes_jsonl,
+                "variants": variants_jsonl,
+            },
         )
 
         lambda_client.invoke(
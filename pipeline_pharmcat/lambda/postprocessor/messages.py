@@ -1,15 +1,6 @@
 import json
 import os
 
-import ijson
-
-from utils import (
-    is_entering_array,
-    is_exiting_array,
-    is_entering_map,
-    is_exiting_map,
-)
-
 ORGANISATIONS = json.loads(os.environ["ORGANISATIONS"])
 GENES = os.environ["GENES"].strip().split(",")
 
@@ -23,58 +14,46 @@ def create_message(current_org, current_gene):
     }
 
 
-def yield_messages(pharmcat_output_json):
+class MessagesHandler:
     """
-    Parse PharmCAT output JSON and yield messages.
+    Collect the messages in the genes section of a PharmCAT report.
 
     Args:
-        pharmcat_output_json (str): Path to the PharmCAT output JSON file
-
-    Yields:
-        messages (list[dict]): Messages from the PharmCAT output
+        on_messages (function): Called with the messages (list[dict]) of each
+            gene, as soon as its messages array ends
     """
-    with open(pharmcat_output_json, "rb") as f:
-        parser = ijson.parse(f)
 
-        GENE_ORGS = {entry["gene"] for entry in ORGANISATIONS}
-        current_org = None
-        current_gene = None
-        in_messages_array = False
-
-        for prefix, event, value in parser:
-            if prefix == "genes" and event == "map_key":
-                current_org = value
-            if current_org not in GENE_ORGS:
-                continue
+    def __init__(self, on_messages):
+        self.on_messages = on_messages
+        self.messages = []
+        self.message = None
 
-            if prefix == f"genes.{current_org}" and event == "map_key":
-                current_gene = value
-                messages = []
-            if current_gene not in GENES:
-                continue
+    def register(self, matcher):
+        GENE_ORGS = {entry["gene"] for entry in ORGANISATIONS}
+        messages_path = ("genes", GENE_ORGS, GENES, "messages")
+        message_path = messages_path + ("item",)
+        matcher.register(messages_path, ("start_array",), self.start_messages)
+        matcher.register(messages_path, ("end_array",), self.end_messages)
+        matcher.register(message_path, ("start_map",), self.start_message)
+        matcher.register(message_path, ("end_map",), self.end_message)
+        matcher.register(message_path + ("rule_name",), ("string",), self.set_name)
+        matcher.register(message_path + ("message",), ("string",), self.set_message)
 
-            messages_array_prefix = f"genes.{current_org}.{current_gene}.messages"
-            if is_entering_array(
-                in_messages_array, prefix, event, messages_array_prefix
-            ):
-                in_messages_array = True
+    def start_messages(self, captures, value):
+        self.messages = []
 
-            # Message processing
-            if in_messages_array:
-                # Reset message object at new occurence
-                message_prefix = f"{messages_array_prefix}.item"
-                if is_entering_map(prefix, event, message_prefix):
-                    message = create_message(current_org, current_gene)
+    def end_messages(self, captures, value):
+        self.on_messages(self.messages)
 
-                if prefix == f"{message_prefix}.rule_name" and event == "string":
-                    message["name"] = value
+    def start_message(self, captures, value):
+        current_org, current_gene = captures
+        self.message = create_message(current_org, current_gene)
 
-                if prefix == f"{message_prefix}.message" and event == "string":
-                    message["message"] = value
+    def end_message(self, captures, value):
+        self.messages.append(self.message)
 
-                if is_exiting_map(prefix, event, message_prefix):
-                    messages.append(message)
+    def set_name(self, captures, value):
+        self.message["name"] = value
 
-                if is_exiting_array(prefix, event, messages_array_prefix):
-                    yield messages
-                    in_messages_array = False
+    def set_message(self, captures, value):
+        self.message["message"] = value
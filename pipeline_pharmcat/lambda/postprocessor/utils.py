@@ -1,24 +1,144 @@
 import base64
 
+import ijson
 
-def is_entering_array(current_state, prefix, event, array_prefix):
-    """Check if we're entering a new array in the JSON steam."""
-    return not current_state and prefix == array_prefix and event == "start_array"
+try:
+    # Parsing is several times faster with the C backend than in pure python
+    ijson_backend = ijson.get_backend("yajl2_c")
+except ImportError:
+    print(f"The yajl2_c ijson backend isn't available, using {ijson.backend}")
+    ijson_backend = ijson
 
+WILDCARD = "*"
+ALL_EVENTS = (
+    "null",
+    "boolean",
+    "integer",
+    "double",
+    "number",
+    "string",
+    "map_key",
+    "start_map",
+    "end_map",
+    "start_array",
+    "end_array",
+)
+NO_ROUTES = {}
 
-def is_exiting_array(prefix, event, array_prefix):
-    """Check if we're exiting an array in the JSON stream"""
-    return prefix == array_prefix and event == "end_array"
 
+class PrefixNode:
+    __slots__ = ("children", "patterns", "routes")
 
-def is_entering_map(prefix, event, map_prefix):
-    """Check if we're entering a map in the JSON stream"""
-    return prefix == map_prefix and event == "start_map"
+    def __init__(self):
+        # Literal path components to nodes
+        self.children = {}
+        # (allowed components or None for any, node), in registration order
+        self.patterns = []
+        # Event to callbacks registered for the path ending at this node
+        self.routes = {}
 
 
-def is_exiting_map(prefix, event, map_prefix):
-    """Check if we're exiting a map in the JSON stream"""
-    return prefix == map_prefix and event == "end_map"
+class PrefixMatcher:
+    """
+    Route ijson events to the callbacks registered for their path.
+
+    Paths are registered once as tuples of components, each either a key,
+    WILDCARD or a collection of allowed keys, and stored in a trie. The trie
+    states of each distinct prefix are resolved the first time it is seen,
+    with one step from the states of its parent, and cached, so every later
+    event is routed with a couple of dict lookups. Prefixes outside every
+    registered path resolve to no states, and so do all their children.
+    Callbacks are called with the components matched by wildcards and
+    collections, and the event value.
+    """
+
+    def __init__(self):
+        self.root = PrefixNode()
+        self.resolved_prefixes = {}
+
+    def register(self, path, events, callback):
+        """
+        Args:
+            path (tuple): Components of the prefix to match
+            events (tuple): ijson events to call callback for
+            callback (function): Called with (captures, value)
+        """
+        node = self.root
+        for component in path:
+            if isinstance(component, str) and component != WILDCARD:
+                node = node.children.setdefault(component, PrefixNode())
+                continue
+            allowed = None if component == WILDCARD else frozenset(component)
+            for pattern_allowed, child in node.patterns:
+                if pattern_allowed == allowed:
+                    node = child
+                    break
+            else:
+                child = PrefixNode()
+                node.patterns.append((allowed, child))
+                node = child
+        for event in events:
+            node.routes.setdefault(event, []).append(callback)
+        self.resolved_prefixes.clear()
+
+    def resolve(self, prefix):
+        """
+        Return the trie states and routes of a prefix by stepping from those
+        of its parent, each a node with the components captured on the way.
+        """
+        if not prefix:
+            states = [(self.root, ())]
+        else:
+            parent, _, component = prefix.rpartition(".")
+            parent_states, _ = self.lookup(parent)
+            states = []
+            for node, captures in parent_states:
+                child = node.children.get(component)
+                if child is not None:
+                    states.append((child, captures))
+                for allowed, child in node.patterns:
+                    if allowed is None or component in allowed:
+                        states.append((child, captures + (component,)))
+        routes = {}
+        for node, captures in states:
+            for event, callbacks in node.routes.items():
+                routes.setdefault(event, []).extend(
+                    (callback, captures) for callback in callbacks
+                )
+        return states, routes or NO_ROUTES
+
+    def lookup(self, prefix):
+        resolved = self.resolved_prefixes.get(prefix)
+        if resolved is None:
+            resolved = self.resolved_prefixes[prefix] = self.resolve(prefix)
+        return resolved
+
+    def match(self, prefix):
+        """Return the event to (callback, captures) routes for a prefix."""
+        return self.lookup(prefix)[1]
+
+
+def parse_report(pharmcat_output_json, handlers):
+    """
+    Walk a PharmCAT report once, routing each event to the handlers.
+
+    Args:
+        pharmcat_output_json (str): Path to the PharmCAT output JSON file
+        handlers (list): Objects with a register(matcher) method that adds
+            their paths to a PrefixMatcher
+    """
+    matcher = PrefixMatcher()
+    for handler in handlers:
+        handler.register(matcher)
+    resolved_prefixes = matcher.resolved_prefixes
+    with open(pharmcat_output_json, "rb") as f:
+        for prefix, event, value in ijson_backend.parse(f):
+            # Inlines match for prefixes that have been seen before
+            resolved = resolved_prefixes.get(prefix) or matcher.lookup(prefix)
+            routes = resolved[1].get(event)
+            if routes:
+                for callback, captures in routes:
+                    callback(captures, value)
 
 
 def create_b64_id(*args):
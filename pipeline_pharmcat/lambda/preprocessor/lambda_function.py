@@ -1,8 +1,18 @@
 import json
 import os
-import subprocess
-
-from shared.utils import handle_failed_execution, LoggingClient
+import shutil
+
+from shared.utils import (
+    CheckedProcess,
+    get_vcf_profile,
+    handle_failed_execution,
+    LoggingClient,
+    match_chromosome_name,
+    merge_regions,
+    run_bounded_processes,
+)
+from shared.utils.chrom_matching import ChromosomeNotFoundError
+from reference_cache import ReferenceCache
 
 lambda_client = LoggingClient("lambda")
 s3_client = LoggingClient("s3")
@@ -12,6 +22,7 @@ DPORTAL_BUCKET = os.environ["DPORTAL_BUCKET"]
 PGXFLOW_BUCKET = os.environ["PGXFLOW_BUCKET"]
 REFERENCE_BUCKET = os.environ["REFERENCE_BUCKET"]
 PGXFLOW_PHARMCAT_LAMBDA = os.environ["PGXFLOW_PHARMCAT_LAMBDA"]
+GENES = os.environ["GENES"].strip().split(",")
 PHARMCAT_REFERENCES = [
     "pharmcat_positions.vcf.bgz",
     "pharmcat_positions.vcf.bgz.csi",
@@ -23,15 +34,87 @@ PHARMCAT_REFERENCES = [
     "pharmcat_regions.bed",
 ]
 
-
-def run_preprocessor(input_path, vcf, reference_fna, reference_vcf, missing_to_ref):
-    """Run the PharmCAT VCF preprocessor."""
+reference_cache = ReferenceCache(
+    REFERENCE_BUCKET,
+    "pharmcat-preprocessor",
+    PHARMCAT_REFERENCES,
+    os.path.join(LOCAL_DIR, "preprocessor_refs"),
+)
+try:
+    # Downloads continue in the background while the handler starts
+    reference_cache.prefetch()
+except Exception as e:
+    print(f"Couldn't prefetch the preprocessor references: {e}")
+
+
+def write_source_regions(pharmcat_regions_bed, chrom_mapping, regions_path):
+    """
+    Write the PharmCAT regions of the configured genes for bcftools -R, with
+    chromosomes named as in the source VCF.
+
+    Args:
+        pharmcat_regions_bed (str): Path to pharmcat_regions.bed, with the
+            gene of each region in its fourth column
+        chrom_mapping (dict): Source VCF contigs to normalised chromosomes
+        regions_path (str): Path to write 1-based inclusive regions to
+
+    Returns:
+        int: The number of regions written
+    """
+    regions = []
+    with open(pharmcat_regions_bed) as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chrom, start, end, *names = line.rstrip("\n").split("\t")
+            try:
+                chrom = match_chromosome_name(chrom)
+            except ChromosomeNotFoundError:
+                continue
+            regions.append((chrom, int(start) + 1, int(end), names[:1]))
+    gene_regions = [region for region in regions if set(region[3]) & set(GENES)]
+    if gene_regions:
+        regions = gene_regions
+    else:
+        print("No PharmCAT regions are named after the configured genes, using all")
+    reversed_chrom_mapping = {v: k for k, v in chrom_mapping.items()}
+    merged_regions = merge_regions(
+        (chrom, start, end)
+        for chrom, start, end, _ in regions
+        # Chromosomes without records in the source VCF
+        if chrom in reversed_chrom_mapping
+    )
+    with open(regions_path, "w") as f:
+        for chrom, start, end in merged_regions:
+            f.write(f"{reversed_chrom_mapping[chrom]}\t{start}\t{end}\n")
+    return len(merged_regions)
+
+
+def extract_source_regions(location, regions_path, n_regions, output_path):
+    """Stream the records in the regions out of the source VCF."""
+    args = ["bcftools", "view", "-Oz", "-o", output_path]
+    if n_regions:
+        args += ["-R", regions_path]
+    else:
+        # PharmCAT still needs the header and sample of a VCF with no records
+        args.append("-h")
+    args.append(location)
+    CheckedProcess(
+        args, error_message="Error extracting the PharmCAT regions of the source VCF"
+    ).check()
+    print(f"Extracted {n_regions} regions to {os.path.getsize(output_path)} bytes")
+
+
+def get_preprocessor_args(
+    input_path, output_dir, vcf, reference_fna, reference_vcf, missing_to_ref
+):
+    """Return the arguments to run the PharmCAT VCF preprocessor."""
     cmd = [
         "/opt/preprocessor/pharmcat_vcf_preprocessor",
         "--vcf",
         input_path,
         "--output-dir",
-        LOCAL_DIR,
+        output_dir,
         "--base-filename",
         vcf,
         "-refFna",
@@ -41,7 +124,7 @@ def run_preprocessor(input_path, vcf, reference_fna, reference_vcf, missing_to_r
     ]
     if missing_to_ref:
         cmd.append("--missing-to-ref")
-    subprocess.run(cmd, check=True)
+    return cmd
 
 
 def lambda_handler(event, context):
@@ -49,41 +132,36 @@ def lambda_handler(event, context):
     message = json.loads(event["Records"][0]["Sns"]["Message"])
     request_id = message["requestId"]
     source_vcf_key = message["sourceVcfKey"]
+    vcf_profile_key = message.get("vcfProfileKey")
     project = message["projectName"]
     missing_to_ref = message["missingToRef"]
 
     try:
+        # Picks up a new version of the references while the VCF is profiled
+        reference_cache.prefetch()
+        source_vcf_location = f"s3://{DPORTAL_BUCKET}/{source_vcf_key}"
+        vcf_profile = get_vcf_profile(
+            source_vcf_location, PGXFLOW_BUCKET, vcf_profile_key
+        )
+        local_reference_dir = reference_cache.get()
+
+        # PharmCAT only reads its regions, so only those are streamed from
+        # the source VCF instead of downloading all of it
+        regions_path = os.path.join(LOCAL_DIR, f"{request_id}.regions.txt")
+        n_regions = write_source_regions(
+            os.path.join(local_reference_dir, PHARMCAT_REFERENCES[7]),
+            vcf_profile["chromosome_mapping"],
+            regions_path,
+        )
         vcf = f"{request_id}.vcf.gz"
         local_input_path = os.path.join(LOCAL_DIR, vcf)
-
-        s3_client.download_file(
-            Bucket=DPORTAL_BUCKET,
-            Key=source_vcf_key,
-            Filename=local_input_path,
+        extract_source_regions(
+            source_vcf_location,
+            regions_path,
+            n_regions,
+            local_input_path,
         )
-
-        local_reference_dir = os.path.join(LOCAL_DIR, "preprocessor_refs")
-        os.makedirs(local_reference_dir, exist_ok=True)
-
-        local_references = [
-            os.path.join(local_reference_dir, reference_file)
-            for reference_file in PHARMCAT_REFERENCES
-        ]
-        for local_reference_path in local_references:
-            # Skip download if file exists to leverage warm starts
-            if os.path.exists(local_reference_path):
-                print(
-                    f"Skipping download of {local_reference_path} as it already exists."
-                )
-                continue
-            local_reference_path = os.path.join(
-                local_reference_dir, local_reference_path
-            )
-            s3_client.download_file(
-                Bucket=REFERENCE_BUCKET,
-                Key=f"pharmcat-preprocessor/{os.path.basename(local_reference_path)}",
-                Filename=local_reference_path,
-            )
+        os.remove(regions_path)
 
         reference_vcf = os.path.join(local_reference_dir, PHARMCAT_REFERENCES[0])
         reference_fna = os.path.join(local_reference_dir, PHARMCAT_REFERENCES[4])
@@ -93,10 +171,12 @@ def lambda_handler(event, context):
                 {
                     "flag": "",
                     "key": f"{request_id}.preprocessed.nonref.vcf.bgz",
+                    "outputDir": os.path.join(LOCAL_DIR, "preprocessed_nonref"),
                 },
                 {
                     "flag": "--missing-to-ref",
                     "key": f"{request_id}.preprocessed.ref.vcf.bgz",
+                    "outputDir": os.path.join(LOCAL_DIR, "preprocessed_ref"),
                 },
             ]
         else:
@@ -104,29 +184,46 @@ def lambda_handler(event, context):
                 {
                     "flag": "",
                     "key": f"{request_id}.preprocessed.vcf.bgz",
+                    "outputDir": os.path.join(LOCAL_DIR, "preprocessed"),
                 }
             ]
 
-        s3_output_keys = []
-
+        # Each run writes to its own directory, so that they can run at once
+        process_args = []
         for config in preprocessor_configs:
-            flag = config["flag"]
-            run_preprocessor(
-                local_input_path,
-                request_id,
-                reference_fna,
-                reference_vcf,
-                missing_to_ref=flag,
+            shutil.rmtree(config["outputDir"], ignore_errors=True)
+            os.makedirs(config["outputDir"])
+            process_args.append(
+                get_preprocessor_args(
+                    local_input_path,
+                    config["outputDir"],
+                    request_id,
+                    reference_fna,
+                    reference_vcf,
+                    missing_to_ref=config["flag"],
+                )
             )
-            preprocessed_vcf = f"{request_id}.preprocessed.vcf.bgz"
 
-            s3_output_key = config["key"]
+        preprocessed_vcf = f"{request_id}.preprocessed.vcf.bgz"
+        # Each output is uploaded as soon as its own run finishes
+        for index, stdout, _ in run_bounded_processes(
+            process_args,
+            max_workers=len(process_args),
+            error_message="Error running the PharmCAT VCF preprocessor",
+        ):
+            print(stdout)
+            config = preprocessor_configs[index]
+            local_preprocessed_path = os.path.join(
+                config["outputDir"], preprocessed_vcf
+            )
             s3_client.upload_file(
                 Bucket=PGXFLOW_BUCKET,
-                Key=s3_output_key,
-                Filename=os.path.join(LOCAL_DIR, preprocessed_vcf),
+                Key=config["key"],
+                Filename=local_preprocessed_path,
             )
-            s3_output_keys.append(s3_output_key)
+            os.remove(local_preprocessed_path)
+        os.remove(local_input_path)
+        s3_output_keys = [config["key"] for config in preprocessor_configs]
 
         lambda_client.invoke(
             FunctionName=PGXFLOW_PHARMCAT_LAMBDA,
@@ -137,6 +234,7 @@ def lambda_handler(event, context):
                     "projectName": project,
                     "s3Keys": s3_output_keys,
                     "sourceVcfKey": source_vcf_key,
+                    "vcfProfileKey": vcf_profile_key,
                     "missingToRef": missing_to_ref,
                 }
             ),
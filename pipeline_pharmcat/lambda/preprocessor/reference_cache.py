@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import threading
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from shared.utils import query_references_table
+
+# Updated together by the updateReferenceFiles lambda
+REFERENCE_VERSION_IDS = ["pharmcat_version", "pharmgkb_version"]
+INDEX_SUFFIXES = (".csi", ".fai", ".gzi")
+# The reference genome is large enough to be worth many parts in flight
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16,
+)
+
+s3_client = boto3.client("s3")
+
+
+class ReferenceCache:
+    """
+    Local copies of the PharmCAT preprocessor references, kept across warm
+    starts.
+
+    Each version of the references, as recorded in the references table, is
+    downloaded to its own directory under cache_dir, so a file from an old
+    version is never reused. Files are downloaded in parallel and written
+    under a temporary name before being renamed, so a file that exists is
+    always complete. Directories of other versions are removed once the
+    current version is ready.
+
+    Args:
+        bucket (str): Bucket holding the references
+        prefix (str): Key prefix of the references
+        filenames (list[str]): Names of the reference files
+        cache_dir (str): Local directory for the cached versions
+    """
+
+    def __init__(self, bucket, prefix, filenames, cache_dir):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.filenames = filenames
+        self.cache_dir = cache_dir
+        self.executor = ThreadPoolExecutor(max_workers=len(filenames))
+        self._lock = threading.Lock()
+        self._version = None
+        self._futures = []
+
+    def get_version(self):
+        versions = [
+            query_references_table(reference_id) or "unknown"
+            for reference_id in REFERENCE_VERSION_IDS
+        ]
+        return "_".join(versions).replace(os.sep, "-")
+
+    def get_version_dir(self, version):
+        return os.path.join(self.cache_dir, version)
+
+    def _download(self, version, filename):
+        local_path = os.path.join(self.get_version_dir(version), filename)
+        if os.path.exists(local_path):
+            print(f"Using cached reference {local_path}")
+            return
+        partial_path = f"{local_path}.{threading.get_ident()}.partial"
+        s3_client.download_file(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}/{filename}",
+            Filename=partial_path,
+            Config=TRANSFER_CONFIG,
+        )
+        os.replace(partial_path, local_path)
+        print(f"Downloaded reference {local_path}")
+
+    def prefetch(self):
+        """
+        Start downloading any missing references of the current version in
+        the background, unless that has already started.
+
+        Returns:
+            tuple: The version and the futures of its downloads
+        """
+        version = self.get_version()
+        with self._lock:
+            if version != self._version:
+                print(f"Fetching preprocessor references version {version}")
+                version_dir = self.get_version_dir(version)
+                os.makedirs(version_dir, exist_ok=True)
+                # Left behind by downloads cut short by a timeout
+                for filename in os.listdir(version_dir):
+                    if filename.endswith(".partial"):
+                        os.remove(os.path.join(version_dir, filename))
+                self._version = version
+                self._futures = [
+                    self.executor.submit(self._download, version, filename)
+                    for filename in self.filenames
+                ]
+            return self._version, self._futures
+
+    def get(self):
+        """
+        Wait for the references of the version last seen by prefetch.
+
+        Returns:
+            str: The directory holding the reference files
+        """
+        with self._lock:
+            version, futures = self._version, self._futures
+        if version is None:
+            version, futures = self.prefetch()
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            with self._lock:
+                # Downloads are started again on the next call
+                if self._version == version:
+                    self._version = None
+            raise
+        version_dir = self.get_version_dir(version)
+        # Downloads finish in any order, and htslib warns about indexes
+        # older than their data files
+        for filename in self.filenames:
+            if filename.endswith(INDEX_SUFFIXES):
+                os.utime(os.path.join(version_dir, filename))
+        for other_version in os.listdir(self.cache_dir):
+            if other_version == version:
+                continue
+            print(f"Removing preprocessor references version {other_version}")
+            other_path = os.path.join(self.cache_dir, other_version)
+            if os.path.isdir(other_path):
+                shutil.rmtree(other_path, ignore_errors=True)
+            else:
+                os.remove(other_path)
+        return version_dir
@@ -15,7 +15,8 @@ module "lambda-preprocessor" {
   create_package         = false
   image_uri              = module.docker_image_preprocessor_lambda.image_uri
   package_type           = "Image"
-  memory_size            = 2048
+  # Two vCPUs, so ref and nonref preprocessing can run side by side
+  memory_size            = 3584
   ephemeral_storage_size = 8192
   timeout                = 600
   attach_policy_jsons    = true
@@ -26,13 +27,15 @@ module "lambda-preprocessor" {
   source_path            = "${path.module}/lambda/preprocessor"
   tags                   = var.common-tags
   environment_variables = {
-    DPORTAL_BUCKET           = var.data-portal-bucket-name
-    PGXFLOW_BUCKET           = var.pgxflow-backend-bucket-name
-    REFERENCE_BUCKET         = var.pgxflow-reference-bucket-name
-    PGXFLOW_PHARMCAT_LAMBDA  = module.lambda-pharmcat.lambda_function_arn
-    DYNAMO_CLINIC_JOBS_TABLE = var.dynamo-clinic-jobs-table
-    SEND_JOB_EMAIL_ARN       = var.send-job-email-lambda-function-arn
-    HTS_S3_HOST              = "s3.${var.region}.amazonaws.com"
+    DPORTAL_BUCKET                  = var.data-portal-bucket-name
+    PGXFLOW_BUCKET                  = var.pgxflow-backend-bucket-name
+    REFERENCE_BUCKET                = var.pgxflow-reference-bucket-name
+    PGXFLOW_PHARMCAT_LAMBDA         = module.lambda-pharmcat.lambda_function_arn
+    DYNAMO_CLINIC_JOBS_TABLE        = var.dynamo-clinic-jobs-table
+    DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
+    SEND_JOB_EMAIL_ARN              = var.send-job-email-lambda-function-arn
+    HTS_S3_HOST                     = "s3.${var.region}.amazonaws.com"
+    GENES                           = join(",", var.pharmcat_configuration.GENES)
   }
 }
 
@@ -126,11 +129,13 @@ module "lambda-gnomad" {
   tags = var.common-tags
 
   environment_variables = {
-    DPORTAL_BUCKET           = var.data-portal-bucket-name
-    PGXFLOW_BUCKET           = var.pgxflow-backend-bucket-name
-    RESULT_SUFFIX            = local.result_suffix
-    DYNAMO_CLINIC_JOBS_TABLE = var.dynamo-clinic-jobs-table
-    SEND_JOB_EMAIL_ARN       = var.send-job-email-lambda-function-arn
+    DPORTAL_BUCKET                  = var.data-portal-bucket-name
+    PGXFLOW_BUCKET                  = var.pgxflow-backend-bucket-name
+    REFERENCE_BUCKET                = var.pgxflow-reference-bucket-name
+    RESULT_SUFFIX                   = local.result_suffix
+    DYNAMO_CLINIC_JOBS_TABLE        = var.dynamo-clinic-jobs-table
+    DYNAMO_PGXFLOW_REFERENCES_TABLE = var.dynamo-references-table
+    SEND_JOB_EMAIL_ARN              = var.send-job-email-lambda-function-arn
   }
 
   layers = [
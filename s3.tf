@@ -22,3 +22,20 @@ resource "aws_s3_bucket_versioning" "pgxflow-references" {
     status = "Enabled"
   }
 }
+
+resource "aws_s3_bucket_lifecycle_configuration" "pgxflow-bucket" {
+  bucket = aws_s3_bucket.pgxflow-bucket.id
+
+  rule {
+    id     = "expire-vcf-profiles"
+    status = "Enabled"
+
+    filter {
+      prefix = "vcf_profiles/"
+    }
+
+    expiration {
+      days = 30
+    }
+  }
+}
@@ -10,6 +10,8 @@ from .chrom_matching import (
     match_chromosome_name,
 )
 from .reference_utils import (
+    DBSNP_SUBSET_ID,
+    get_dbsnp_subset_key,
     sort,
     bgzip,
     tabix_index,
@@ -17,6 +19,37 @@ from .reference_utils import (
     query_references_table,
     update_references_table,
 )
+from .lookup_index import (
+    LOOKUP_INDEX_SUFFIX,
+    POSITION_JOIN_MODE,
+    RSID_JOIN_MODE,
+    get_lookup_index_key,
+    get_row_interval,
+    LookupIndex,
+    LookupIndexError,
+    write_lookup_index,
+)
+from .scheduler import run_bounded_processes
+from .gnomad_subset import (
+    GNOMAD_S3_PREFIX,
+    GNOMAD_S3_SUFFIX,
+    GNOMAD_SUBSET_ID,
+    get_gnomad_subset_prefix,
+    GnomadSubset,
+    load_gnomad_subset,
+)
+from .gnomad_cache import GnomadCache
+from .gnomad_query import (
+    GNOMAD_CACHE_RELEASE,
+    GNOMAD_COLUMNS,
+    query_gnomad,
+)
+from .multipart_writer import S3MultipartWriter
+from .regions import merge_regions
+from .query_planner import estimate_blocks, plan_position_queries
+from .index_cache import with_cached_index
+from .block_cache import log_block_cache_stats, with_block_cache
+from .vcf_profile import get_vcf_profile, load_vcf_profile, read_vcf_profile
 from .cognito_utils import get_cognito_user_by_id
 from .auth import (
     require_permission,
@@ -0,0 +1,313 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import quote, unquote, urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .index_cache import (
+    HTSLIB_INDEX_CACHE_TTL_SECONDS,
+    REMOTE_SCHEMES,
+    get_tmp_budget,
+    with_cached_index,
+)
+
+BLOCK_CACHE_DIR = os.environ.get("BLOCK_CACHE_DIR", "/tmp/block_cache")
+BLOCK_CACHE_BYTES = int(os.environ.get("BLOCK_CACHE_BYTES", get_tmp_budget(1 / 8)))
+BLOCK_CACHE_ENABLED = os.environ.get("BLOCK_CACHE_ENABLED", "true") == "true"
+# Larger than a BGZF block, so one fetch usually covers a whole region
+BLOCK_SIZE = 256 * 1024
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)")
+
+s3_client = boto3.client("s3")
+
+
+class RemoteObjectNotFound(Exception):
+    pass
+
+
+class BlockCache:
+    """
+    Disk-backed cache of fixed size blocks of remote s3:// and https://
+    objects, evicted least recently used first.
+
+    Blocks are keyed by URL and ETag (or Last-Modified). Like indexes, the
+    version of an object is checked again once it is older than
+    HTSLIB_INDEX_CACHE_TTL_SECONDS, and the blocks of a replaced version are
+    removed, so a changed object is never served from stale blocks.
+    """
+
+    def __init__(self, cache_dir=BLOCK_CACHE_DIR, max_bytes=BLOCK_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._cached_bytes = sum(
+            os.path.getsize(os.path.join(cache_dir, filename))
+            for filename in os.listdir(cache_dir)
+        )
+
+    def reset_stats(self):
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "bytes_served": 0,
+            "bytes_fetched": 0,
+        }
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def _get_object_name(self, url, version):
+        return hashlib.md5(f"{url}\n{version}".encode()).hexdigest()
+
+    def _remove_blocks(self, object_name):
+        with self._lock:
+            for filename in os.listdir(self.cache_dir):
+                if filename.split(".", 1)[0] != object_name:
+                    continue
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self._cached_bytes -= size
+
+    def get_object_info(self, url):
+        """Return the (size, version) of a remote object."""
+        checked_at, cached_info = self._objects.get(url, (0, None))
+        if time.time() - checked_at <= HTSLIB_INDEX_CACHE_TTL_SECONDS:
+            return cached_info
+        parsed_url = urlparse(url)
+        if parsed_url.scheme == "s3":
+            try:
+                response = s3_client.head_object(
+                    Bucket=parsed_url.netloc, Key=parsed_url.path.lstrip("/")
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("403", "404", "NoSuchKey"):
+                    raise RemoteObjectNotFound(url)
+                raise
+            info = (response["ContentLength"], response["ETag"])
+        else:
+            request = urllib.request.Request(url, method="HEAD")
+            try:
+                with urllib.request.urlopen(request) as response:
+                    headers = response.headers
+            except urllib.error.HTTPError as e:
+                if e.code in (403, 404):
+                    raise RemoteObjectNotFound(url)
+                raise
+            info = (
+                int(headers["Content-Length"]),
+                headers.get("ETag") or headers.get("Last-Modified"),
+            )
+        if cached_info is not None and cached_info[1] != info[1]:
+            print(f"{url} has changed, removing its cached blocks")
+            self._remove_blocks(self._get_object_name(url, cached_info[1]))
+        self._objects[url] = (time.time(), info)
+        return info
+
+    def _fetch_block(self, url, start, end):
+        parsed_url = urlparse(url)
+        byte_range = f"bytes={start}-{end}"
+        if parsed_url.scheme == "s3":
+            response = s3_client.get_object(
+                Bucket=parsed_url.netloc,
+                Key=parsed_url.path.lstrip("/"),
+                Range=byte_range,
+            )
+            return response["Body"].read()
+        request = urllib.request.Request(url, headers={"Range": byte_range})
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+    def get_block(self, url, block_index):
+        size, version = self.get_object_info(url)
+        object_name = self._get_object_name(url, version)
+        block_path = os.path.join(self.cache_dir, f"{object_name}.{block_index}")
+        try:
+            with open(block_path, "rb") as f:
+                data = f.read()
+            # Marks the block as recently used
+            os.utime(block_path)
+            self._count(hits=1)
+            return data
+        except FileNotFoundError:
+            pass
+        start = block_index * BLOCK_SIZE
+        data = self._fetch_block(url, start, min(start + BLOCK_SIZE, size) - 1)
+        self._count(misses=1, bytes_fetched=len(data))
+        partial_path = f"{block_path}.{threading.get_ident()}.partial"
+        with open(partial_path, "wb") as f:
+            f.write(data)
+        os.replace(partial_path, block_path)
+        with self._lock:
+            self._cached_bytes += len(data)
+            if self._cached_bytes > self.max_bytes:
+                self._evict()
+        return data
+
+    def _evict(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".partial"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        self._cached_bytes = sum(size for _, size, _ in entries)
+        # Leave some room so that eviction doesn't run for every new block
+        target_bytes = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if self._cached_bytes <= target_bytes:
+                break
+            os.remove(path)
+            self._cached_bytes -= size
+
+    def read_range(self, url, start, end):
+        """Yield the bytes from start to end inclusive, a block at a time."""
+        for block_index in range(start // BLOCK_SIZE, end // BLOCK_SIZE + 1):
+            block_start = block_index * BLOCK_SIZE
+            data = self.get_block(url, block_index)
+            chunk = data[
+                max(start - block_start, 0) : min(end - block_start + 1, len(data))
+            ]
+            self._count(bytes_served=len(chunk))
+            yield chunk
+
+
+class BlockCacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Requests are summarised by the cache stats instead
+        pass
+
+    def _send_headers(self, status, length, size=None, start=None):
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        if status == 206:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{start + length - 1}/{size}"
+            )
+        self.end_headers()
+
+    def _get_range(self, send_body):
+        url = unquote(self.path.lstrip("/"))
+        try:
+            size, _ = self.server.block_cache.get_object_info(url)
+        except RemoteObjectNotFound:
+            self._send_headers(404, 0)
+            return
+        match = RANGE_PATTERN.fullmatch(self.headers.get("Range", ""))
+        if match is None:
+            start, end, status = 0, size - 1, 200
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or size - 1), size - 1)
+            status = 206
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send_headers(status, end - start + 1, size, start)
+        if not send_body:
+            return
+        try:
+            # htslib asks for open ended ranges and disconnects when it seeks
+            for chunk in self.server.block_cache.read_range(url, start, end):
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self._get_range(send_body=False)
+
+    def do_GET(self):
+        self._get_range(send_body=True)
+
+
+class BlockCacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, block_cache):
+        self.block_cache = block_cache
+        super().__init__(("127.0.0.1", 0), BlockCacheRequestHandler)
+
+
+# Started on first use and kept running across warm starts
+block_cache_server = None
+block_cache_server_lock = threading.Lock()
+
+
+def get_block_cache_server():
+    global block_cache_server
+    with block_cache_server_lock:
+        if block_cache_server is None:
+            block_cache_server = BlockCacheServer(BlockCache())
+            threading.Thread(
+                target=block_cache_server.serve_forever, daemon=True
+            ).start()
+            print(
+                "Started block cache server on port"
+                f" {block_cache_server.server_address[1]}"
+            )
+    return block_cache_server
+
+
+def with_block_cache(location):
+    """
+    Route htslib reads of a remote VCF through the local block cache.
+
+    The returned location is an http:// URL on a server in this process,
+    which serves byte ranges of the remote object from BLOCK_CACHE_DIR and
+    fetches missing blocks on demand. The index is cached separately, see
+    with_cached_index.
+
+    Args:
+        location (str): Path or URL of a VCF or BCF
+
+    Returns:
+        str: The location to pass to bcftools, unchanged if it is local or
+            BLOCK_CACHE_ENABLED is not "true"
+    """
+    location = with_cached_index(location)
+    url, _, index_path = location.partition("##idx##")
+    if not BLOCK_CACHE_ENABLED or urlparse(url).scheme not in REMOTE_SCHEMES:
+        return location
+    port = get_block_cache_server().server_address[1]
+    cached_url = f"http://127.0.0.1:{port}/{quote(url, safe='')}"
+    return f"{cached_url}##idx##{index_path}" if index_path else cached_url
+
+
+def log_block_cache_stats():
+    """Print and reset the block cache counters, once per job."""
+    if block_cache_server is None:
+        return
+    block_cache = block_cache_server.block_cache
+    stats = block_cache.stats
+    requests = stats["hits"] + stats["misses"]
+    print(
+        f"Block cache: {stats['hits']}/{requests} block hits,"
+        f" served {stats['bytes_served']} bytes and fetched"
+        f" {stats['bytes_fetched']} bytes"
+    )
+    block_cache.reset_stats()
@@ -0,0 +1,279 @@
+import os
+import sqlite3
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+GNOMAD_CACHE_KEY = "gnomad/result_cache.sqlite3"
+# Saves that lose the race to another job merge with its copy and try again
+GNOMAD_CACHE_SAVE_ATTEMPTS = 5
+# Stays well below the bound variable limit of older sqlite builds
+MAX_POSITIONS_PER_SELECT = 500
+# The whole file is downloaded to /tmp and uploaded again on each save, so it
+# is started again from the latest results once it grows past this
+GNOMAD_CACHE_MAX_BYTES = int(os.environ.get("GNOMAD_CACHE_MAX_BYTES", 128 * 2**20))
+# Failing to read or write the cache only costs the queries it would save
+CACHE_IO_ERRORS = (BotoCoreError, ClientError, OSError, sqlite3.Error)
+
+s3_client = boto3.client("s3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queried (
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (chrom, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS records (
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chrom, pos, ref, alt)
+) WITHOUT ROWID;
+"""
+
+
+class GnomadCache:
+    """
+    Cross-job cache of gnomAD query results for a single release.
+
+    Positions are recorded once they have been queried, whether or not
+    gnomAD had a record for them, so that absent variants are not queried
+    again. The sqlite file is mirrored between local_dir and S3, and is
+    reset whenever the release it was built from changes or it grows past
+    max_bytes. If it can't be read or written, jobs carry on uncached.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        release,
+        local_dir="/tmp",
+        key=GNOMAD_CACHE_KEY,
+        max_bytes=GNOMAD_CACHE_MAX_BYTES,
+    ):
+        self.bucket = bucket
+        self.key = key
+        self.release = release
+        self.max_bytes = max_bytes
+        self.local_path = os.path.join(local_dir, os.path.basename(key))
+        self._etag = None
+        self._connection = None
+        self._pending_positions = []
+        self._pending_records = []
+
+    def load(self):
+        """Open the cache, only downloading it if it has changed in S3."""
+        try:
+            self._download()
+            self._connection = self._connect()
+        except CACHE_IO_ERRORS as e:
+            print(f"Could not load the gnomAD cache, continuing without it: {e}")
+            self._discard_local_copy()
+
+    def _discard_local_copy(self):
+        """Stop using the cache until it is next loaded from S3."""
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+        self._etag = None
+        self._pending_positions = []
+        self._pending_records = []
+        try:
+            os.remove(self.local_path)
+        except FileNotFoundError:
+            pass
+
+    def _download(self):
+        """Fetch the S3 copy unless the local copy is already up to date."""
+        kwargs = {"Bucket": self.bucket, "Key": self.key}
+        if self._etag is not None and os.path.exists(self.local_path):
+            kwargs["IfNoneMatch"] = self._etag
+        try:
+            response = s3_client.get_object(**kwargs)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("304", "NotModified"):
+                return
+            if code in ("404", "NoSuchKey"):
+                print(f"No gnomAD cache at s3://{self.bucket}/{self.key}")
+                self._etag = None
+                return
+            raise
+        partial_path = f"{self.local_path}.partial"
+        with open(partial_path, "wb") as f:
+            for chunk in response["Body"].iter_chunks():
+                f.write(chunk)
+        os.replace(partial_path, self.local_path)
+        self._etag = response["ETag"]
+
+    def _connect(self):
+        connection = sqlite3.connect(self.local_path)
+        connection.executescript(SCHEMA)
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'release'"
+        ).fetchone()
+        if row is None or row[0] != self.release:
+            print("Starting a new gnomAD cache for this release")
+            self._reset(connection)
+        return connection
+
+    def _reset(self, connection):
+        with connection:
+            connection.execute("DELETE FROM queried")
+            connection.execute("DELETE FROM records")
+            connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('release', ?)",
+                (self.release,),
+            )
+        connection.execute("VACUUM")
+
+    def _select_by_position(self, columns, table, chrom, positions):
+        """Yield rows of a table at the given positions of a chromosome."""
+        positions = sorted(set(positions))
+        for i in range(0, len(positions), MAX_POSITIONS_PER_SELECT):
+            chunk = positions[i : i + MAX_POSITIONS_PER_SELECT]
+            yield from self._connection.execute(
+                f"SELECT {columns} FROM {table} WHERE chrom = ?"
+                f" AND pos IN ({','.join('?' * len(chunk))})",
+                (chrom, *chunk),
+            )
+
+    def missing_positions(self, chrom, positions):
+        """
+        Return the positions that have not been queried yet, in order.
+
+        Args:
+            chrom (str): Chromosome name as queried in gnomAD
+            positions (Iterable[int]): Positions to check
+        """
+        positions = list(positions)
+        if self._connection is None:
+            return positions
+        queried = {
+            pos
+            for (pos,) in self._select_by_position("pos", "queried", chrom, positions)
+        }
+        return [pos for pos in positions if pos not in queried]
+
+    def get_query_output(self, chrom, positions):
+        """
+        Rebuild the output of a gnomAD query from cached records.
+
+        Args:
+            chrom (str): Chromosome name as queried in gnomAD
+            positions (Iterable[int]): Previously queried positions
+
+        Returns:
+            str: Tab separated POS, REF, ALT and data lines
+        """
+        if self._connection is None:
+            return ""
+        rows = self._select_by_position(
+            "pos, ref, alt, data", "records", chrom, positions
+        )
+        return "".join(f"{pos}\t{ref}\t{alt}\t{data}\n" for pos, ref, alt, data in rows)
+
+    def add(self, chrom, positions, query_output):
+        """
+        Queue the results of a query to be written back in the next save.
+
+        Args:
+            chrom (str): Chromosome name as queried in gnomAD
+            positions (Iterable[int]): Every position that was queried
+            query_output (str): Tab separated POS, REF, ALT and data lines
+        """
+        if self._connection is None:
+            return
+        positions = set(positions)
+        self._pending_positions.extend((chrom, pos) for pos in positions)
+        for line in query_output.splitlines():
+            if not line.strip():
+                continue
+            pos, ref, alt, data = line.split("\t", 3)
+            # Overlapping records from other positions can't match any input
+            if int(pos) in positions:
+                self._pending_records.append((chrom, int(pos), ref, alt, data))
+
+    def _write_pending(self):
+        self._insert_pending()
+        if os.path.getsize(self.local_path) > self.max_bytes:
+            print(
+                f"gnomAD cache is larger than {self.max_bytes} bytes,"
+                " starting it again from the latest results"
+            )
+            self._reset(self._connection)
+            self._insert_pending()
+
+    def _insert_pending(self):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO queried VALUES (?, ?)", self._pending_positions
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                self._pending_records,
+            )
+
+    def save(self):
+        """
+        Write queued results in one batch and upload the cache to S3.
+
+        The upload only succeeds if the S3 copy is still the one the results
+        were merged into. Otherwise another job has saved in the meantime, so
+        its copy is downloaded and merged with the results again.
+        """
+        if self._connection is None:
+            return
+        self._connection.close()
+        self._connection = None
+        if not self._pending_positions:
+            return
+        try:
+            self._save_pending()
+        except CACHE_IO_ERRORS as e:
+            print(f"Could not save to the gnomAD cache, dropping the results: {e}")
+            self._discard_local_copy()
+
+    def _save_pending(self):
+        print(
+            f"Adding {len(self._pending_positions)} positions and"
+            f" {len(self._pending_records)} records to the gnomAD cache"
+        )
+        for attempt in range(1, GNOMAD_CACHE_SAVE_ATTEMPTS + 1):
+            # Pick up rows other jobs have written since this copy was downloaded
+            self._download()
+            self._connection = self._connect()
+            self._write_pending()
+            self._connection.close()
+            self._connection = None
+            if self._etag is None:
+                condition = {"IfNoneMatch": "*"}
+            else:
+                condition = {"IfMatch": self._etag}
+            try:
+                with open(self.local_path, "rb") as f:
+                    response = s3_client.put_object(
+                        Bucket=self.bucket, Key=self.key, Body=f, **condition
+                    )
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                    raise
+                print(f"gnomAD cache changed while saving (attempt {attempt})")
+                continue
+            self._etag = response["ETag"]
+            self._pending_positions = []
+            self._pending_records = []
+            return
+        # The results are only an optimisation, so they are dropped rather
+        # than failing the job
+        print("Gave up saving to the gnomAD cache after repeated conflicts")
+        self._etag = None
+        self._pending_positions = []
+        self._pending_records = []
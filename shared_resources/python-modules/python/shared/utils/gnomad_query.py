@@ -0,0 +1,198 @@
+import os
+
+from .block_cache import with_block_cache
+from .gnomad_subset import GNOMAD_S3_PREFIX, GNOMAD_S3_SUFFIX
+from .query_planner import estimate_blocks, plan_position_queries
+from .scheduler import run_bounded_processes
+
+# Query planning, see plan_position_queries. gnomAD genome records are large,
+# so a compressed block only spans a few hundred bases.
+GNOMAD_BLOCK_SPAN_BP = int(os.environ.get("GNOMAD_BLOCK_SPAN_BP", 200))
+GNOMAD_MAX_GAP_BP = int(os.environ.get("GNOMAD_MAX_GAP_BP", 2000))
+GNOMAD_MAX_BLOCKS_PER_QUERY = int(os.environ.get("GNOMAD_MAX_BLOCKS_PER_QUERY", 40))
+MAX_RANGES_PER_QUERY = 1000
+GNOMAD_MAX_WORKERS = int(os.environ.get("GNOMAD_MAX_WORKERS", 8))
+# Just the columns after the identifying columns
+GNOMAD_COLUMNS = {
+    "afAfr": "INFO/AF_afr",
+    "afEas": "INFO/AF_eas",
+    "afFin": "INFO/AF_fin",
+    "afNfe": "INFO/AF_nfe",
+    "afSas": "INFO/AF_sas",
+    "afAmr": "INFO/AF_amr",
+    "af": "INFO/AF",
+    "ac": "INFO/AC",
+    "an": "INFO/AN",
+    "siftMax": "INFO/sift_max",
+}
+# Cached results are only valid for the release and columns they were queried with
+GNOMAD_CACHE_RELEASE = (
+    f"{GNOMAD_S3_PREFIX}{GNOMAD_S3_SUFFIX}:{','.join(GNOMAD_COLUMNS.values())}"
+)
+GNOMAD_CACHE_LOCATION = "cache"
+
+
+def get_query_args(ranges, ref_chrom, location=None):
+    chrom = f"chr{ref_chrom}"
+    if location is None:
+        # Every query to a chromosome shares one download of its index, and
+        # blocks read by earlier queries are served from the local cache
+        location = with_block_cache(f"{GNOMAD_S3_PREFIX}{chrom}{GNOMAD_S3_SUFFIX}")
+    columns = "\t".join(f"%{val}" for val in GNOMAD_COLUMNS.values())
+    args = [
+        "bcftools",
+        "query",
+        "--regions",
+        ",".join(
+            f"{chrom}:{start}" if start == end else f"{chrom}:{start}-{end}"
+            for start, end in ranges
+        ),
+        "--format",
+        f"%POS\t%REF\t%ALT\t{columns}\n",
+        location,
+    ]
+    return args
+
+
+def plan_queries(chrom, location, pos_list):
+    """
+    Split sorted positions into queries of nearby ranges.
+
+    Returns:
+        list[tuple]: The location, ranges and positions of each query
+    """
+    # The local subset is cheap to seek in, so only argument length bounds it
+    max_blocks = GNOMAD_MAX_BLOCKS_PER_QUERY if location is None else float("inf")
+    queries = plan_position_queries(
+        pos_list,
+        GNOMAD_BLOCK_SPAN_BP,
+        GNOMAD_MAX_GAP_BP,
+        max_blocks,
+        MAX_RANGES_PER_QUERY,
+    )
+    print(
+        f"Planned chr{chrom} {'public' if location is None else 'subset'} queries:"
+        f" {len(pos_list)} positions in {sum(map(len, queries))} ranges and"
+        f" {len(queries)} queries, about"
+        f" {estimate_blocks(sum(queries, []), GNOMAD_BLOCK_SPAN_BP)} blocks"
+    )
+    planned = []
+    pos_iter = iter(pos_list)
+    for ranges in queries:
+        # Ranges end at a position, so each takes the positions up to its end
+        query_pos_list = []
+        for _, end in ranges:
+            for pos in pos_iter:
+                query_pos_list.append(pos)
+                if pos == end:
+                    break
+        planned.append((location, ranges, query_pos_list))
+    return planned
+
+
+def plan_chrom_queries(chrom, pos_list, gnomad_subset=None, gnomad_cache=None):
+    """
+    Split the positions of a chromosome between the cache, subset and public files.
+
+    Returns:
+        list[tuple]: The location, ranges and positions of each query, with
+            GNOMAD_CACHE_LOCATION and no ranges for positions in the cache
+    """
+    # Positions already queried by earlier jobs are read from the cache, those
+    # covered by the local subset from it, and the rest from the public files
+    pos_list = sorted(pos_list)
+    cached_pos_list = []
+    if gnomad_cache is not None:
+        missing_pos_list = gnomad_cache.missing_positions(f"chr{chrom}", pos_list)
+        missing_pos_set = set(missing_pos_list)
+        cached_pos_list = [pos for pos in pos_list if pos not in missing_pos_set]
+        pos_list = missing_pos_list
+    if gnomad_subset is None:
+        subset_pos_list = []
+    else:
+        subset_pos_list = [
+            pos for pos in pos_list if gnomad_subset.contains(f"chr{chrom}", pos)
+        ]
+        subset_pos_set = set(subset_pos_list)
+        pos_list = [pos for pos in pos_list if pos not in subset_pos_set]
+    planned = (
+        [(GNOMAD_CACHE_LOCATION, None, cached_pos_list)] if cached_pos_list else []
+    )
+    if subset_pos_list:
+        planned += plan_queries(chrom, gnomad_subset.location, subset_pos_list)
+    if pos_list:
+        planned += plan_queries(chrom, None, pos_list)
+    return planned
+
+
+def parse_query_output(query_output, pos_list):
+    """
+    Parse bcftools query output, keeping only records at the queried positions.
+
+    Yields:
+        tuple: (pos, ref, alt, {column name: value}) for each matching record
+    """
+    # Ranges return every record inside them, only queried positions match
+    pos_set = set(pos_list)
+    for line in query_output.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        pos_s, ref, alt, *query_data = line.split("\t")
+        pos = int(pos_s)
+        if pos in pos_set:
+            yield pos, ref, alt, dict(zip(GNOMAD_COLUMNS, query_data))
+
+
+def query_gnomad(positions, gnomad_subset=None, gnomad_cache=None):
+    """
+    Look up the gnomAD records at positions from the cheapest source of each.
+
+    Results queried from the subset or public files are added to gnomad_cache,
+    which the caller loads beforehand and saves once it is done.
+
+    Args:
+        positions (dict): Sets of positions keyed by chromosome, without the
+            chr prefix
+        gnomad_subset (GnomadSubset): The local subset, if there is one
+        gnomad_cache (GnomadCache): The loaded results cache, if there is one
+
+    Yields:
+        tuple: (chrom, pos, ref, alt, {column name: value}) for each gnomAD
+            record at a requested position
+    """
+    planned = [
+        (chrom, location, ranges, pos_list)
+        for chrom, chrom_positions in positions.items()
+        for location, ranges, pos_list in plan_chrom_queries(
+            chrom, chrom_positions, gnomad_subset, gnomad_cache
+        )
+    ]
+    queries = []
+    for chrom, location, ranges, pos_list in planned:
+        if location == GNOMAD_CACHE_LOCATION:
+            query_output = gnomad_cache.get_query_output(f"chr{chrom}", pos_list)
+            for record in parse_query_output(query_output, pos_list):
+                yield chrom, *record
+        else:
+            queries.append((chrom, location, ranges, pos_list))
+    subset_queries = sum(location is not None for _, location, _, _ in queries)
+    print(
+        f"Read {len(planned) - len(queries)} chromosomes from the gnomAD cache,"
+        f" querying gnomAD with {subset_queries} subset and"
+        f" {len(queries) - subset_queries} public queries"
+    )
+    query_args = [
+        get_query_args(ranges, chrom, location)
+        for chrom, location, ranges, _ in queries
+    ]
+    for index, query_output, _ in run_bounded_processes(
+        query_args,
+        max_workers=GNOMAD_MAX_WORKERS,
+        error_message="bcftools error querying gnomAD",
+    ):
+        chrom, _, _, pos_list = queries[index]
+        for record in parse_query_output(query_output, pos_list):
+            yield chrom, *record
+        if gnomad_cache is not None:
+            gnomad_cache.add(f"chr{chrom}", pos_list, query_output)
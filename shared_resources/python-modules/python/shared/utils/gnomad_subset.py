@@ -0,0 +1,100 @@
+from bisect import bisect_right
+import os
+import shutil
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .reference_utils import query_references_table
+
+# The gnomAD release queried by the lambdas and extracted into the subset
+GNOMAD_S3_PREFIX = "https://gnomad-public-us-east-1.s3.amazonaws.com/release/4.1/vcf/genomes/gnomad.genomes.v4.1.sites."
+GNOMAD_S3_SUFFIX = ".vcf.bgz"
+# Each subset is published under its own version, which is only switched to
+# in the references table once all of its files are uploaded
+GNOMAD_SUBSET_ID = "gnomad_subset_version"
+GNOMAD_SUBSET_FILENAME = "pgx_subset.vcf.bgz"
+GNOMAD_SUBSET_REGIONS_FILENAME = "pgx_subset_regions.txt"
+GNOMAD_SUBSET_FILES = [
+    GNOMAD_SUBSET_FILENAME,
+    f"{GNOMAD_SUBSET_FILENAME}.csi",
+    GNOMAD_SUBSET_REGIONS_FILENAME,
+]
+
+s3_client = boto3.client("s3")
+
+
+class GnomadSubset:
+    """A local gnomAD VCF holding only the records inside its regions."""
+
+    def __init__(self, location, regions_path):
+        self.location = location
+        self.regions = {}
+        with open(regions_path) as f:
+            for line in f:
+                chrom, start, end = line.rstrip("\n").split("\t")
+                starts, ends = self.regions.setdefault(chrom, ([], []))
+                starts.append(int(start))
+                ends.append(int(end))
+
+    def contains(self, chrom, pos):
+        # Regions are sorted and merged, so only the closest start can match
+        starts, ends = self.regions.get(chrom, ((), ()))
+        i = bisect_right(starts, pos) - 1
+        return i >= 0 and pos <= ends[i]
+
+
+def get_gnomad_subset_prefix(version):
+    """Return the key prefix the files of a subset version are published under."""
+    return f"gnomad/{version}/"
+
+
+def load_gnomad_subset(bucket, local_dir="/tmp"):
+    """
+    Download the PGx gnomAD subset built by updateReferenceFiles.
+
+    The files are kept in local_dir across warm starts and are only
+    downloaded again when the version in the references table changes.
+
+    Args:
+        bucket (str): Reference bucket holding the subset
+        local_dir (str): Directory to cache the subset in
+
+    Returns:
+        GnomadSubset: The subset, or None if none has been published
+    """
+    version = query_references_table(GNOMAD_SUBSET_ID)
+    if version is None:
+        print("No gnomAD subset has been published, using public gnomAD files")
+        return None
+    cache_dir = os.path.join(local_dir, "gnomad_subset")
+    subset_dir = os.path.join(cache_dir, version)
+    complete_marker = os.path.join(subset_dir, ".complete")
+    if not os.path.exists(complete_marker):
+        # Only one version of the subset is kept
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(subset_dir)
+        prefix = get_gnomad_subset_prefix(version)
+        for filename in GNOMAD_SUBSET_FILES:
+            key = f"{prefix}{filename}"
+            print(f"Downloading s3://{bucket}/{key}")
+            try:
+                s3_client.download_file(
+                    Bucket=bucket,
+                    Key=key,
+                    Filename=os.path.join(subset_dir, filename),
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                    raise
+                # Replaced by a newer version since the table was read
+                print(f"gnomAD subset {version} was removed, using public files")
+                shutil.rmtree(subset_dir, ignore_errors=True)
+                return None
+        open(complete_marker, "w").close()
+    else:
+        print(f"Using cached gnomAD subset {version}")
+    return GnomadSubset(
+        os.path.join(subset_dir, GNOMAD_SUBSET_FILENAME),
+        os.path.join(subset_dir, GNOMAD_SUBSET_REGIONS_FILENAME),
+    )
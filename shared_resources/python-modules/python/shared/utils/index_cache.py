@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def get_tmp_budget(fraction):
+    """Return a share of the ephemeral storage, in bytes, for a /tmp cache."""
+    return int(shutil.disk_usage("/tmp").total * fraction)
+
+
+HTSLIB_INDEX_CACHE_DIR = os.environ.get(
+    "HTSLIB_INDEX_CACHE_DIR", "/tmp/htslib_index_cache"
+)
+# /tmp also holds the block cache, reference subsets and the VCFs being
+# processed, so without a configured budget the cache only takes a share of it
+HTSLIB_INDEX_CACHE_BYTES = int(
+    os.environ.get("HTSLIB_INDEX_CACHE_BYTES", get_tmp_budget(1 / 16))
+)
+# Index validators are checked again after this long
+HTSLIB_INDEX_CACHE_TTL_SECONDS = 300
+# Tried in the same order as htslib
+INDEX_SUFFIXES = [".csi", ".tbi"]
+REMOTE_SCHEMES = ("s3", "http", "https")
+
+s3_client = boto3.client("s3")
+
+# Remote location to (checked at, cached index path or None), per container
+checked_locations = {}
+
+
+def get_index_validator(index_url):
+    """Return the ETag or Last-Modified of a remote index, or None if missing."""
+    parsed_url = urlparse(index_url)
+    if parsed_url.scheme == "s3":
+        try:
+            response = s3_client.head_object(
+                Bucket=parsed_url.netloc, Key=parsed_url.path.lstrip("/")
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("403", "404", "NoSuchKey"):
+                return None
+            raise
+        return response["ETag"]
+    request = urllib.request.Request(index_url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request) as response:
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code in (403, 404):
+            return None
+        raise
+    return headers.get("ETag") or headers.get("Last-Modified")
+
+
+def download_index(index_url, local_path):
+    partial_path = f"{local_path}.partial"
+    parsed_url = urlparse(index_url)
+    if parsed_url.scheme == "s3":
+        s3_client.download_file(
+            Bucket=parsed_url.netloc,
+            Key=parsed_url.path.lstrip("/"),
+            Filename=partial_path,
+        )
+    else:
+        with urllib.request.urlopen(index_url) as response, open(
+            partial_path, "wb"
+        ) as f:
+            shutil.copyfileobj(response, f)
+    os.replace(partial_path, local_path)
+
+
+def evict_indexes(keep_path):
+    """Remove the least recently used indexes until under the disk budget."""
+    entries = []
+    for filename in os.listdir(HTSLIB_INDEX_CACHE_DIR):
+        path = os.path.join(HTSLIB_INDEX_CACHE_DIR, filename)
+        if path.endswith(".partial"):
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= HTSLIB_INDEX_CACHE_BYTES:
+            break
+        if path == keep_path:
+            continue
+        print(f"Evicting {path} from the htslib index cache")
+        os.remove(path)
+        total_bytes -= size
+
+
+def find_cached_index(location):
+    for suffix in INDEX_SUFFIXES:
+        index_url = f"{location}{suffix}"
+        validator = get_index_validator(index_url)
+        if validator is None:
+            continue
+        cache_name = hashlib.md5(f"{index_url}\n{validator}".encode()).hexdigest()
+        local_path = os.path.join(HTSLIB_INDEX_CACHE_DIR, f"{cache_name}{suffix}")
+        if os.path.exists(local_path):
+            print(f"Using cached index {local_path} for {index_url}")
+        else:
+            os.makedirs(HTSLIB_INDEX_CACHE_DIR, exist_ok=True)
+            print(f"Caching index {index_url} in {local_path}")
+            download_index(index_url, local_path)
+            evict_indexes(local_path)
+        return local_path
+    return None
+
+
+def with_cached_index(location):
+    """
+    Point htslib at a locally cached index for a remote VCF or BCF.
+
+    Without this, every bcftools or tabix process downloads the index of a
+    remote file again. Indexes are cached by URL and ETag (or Last-Modified)
+    in HTSLIB_INDEX_CACHE_DIR, which is kept across warm starts and trimmed
+    to HTSLIB_INDEX_CACHE_BYTES, least recently used first. CheckedProcess
+    applies it to every argument of bcftools and tabix.
+
+    Args:
+        location (str): Path or URL of a VCF or BCF
+
+    Returns:
+        str: location with an ##idx## suffix naming the cached index, or
+            location unchanged if it is local or has no index
+    """
+    if urlparse(location).scheme not in REMOTE_SCHEMES or "##idx##" in location:
+        return location
+    checked_at, local_path = checked_locations.get(location, (0, None))
+    if time.time() - checked_at > HTSLIB_INDEX_CACHE_TTL_SECONDS or (
+        local_path is not None and not os.path.exists(local_path)
+    ):
+        local_path = find_cached_index(location)
+        checked_locations[location] = (time.time(), local_path)
+    if local_path is None:
+        return location
+    # Marks the index as recently used
+    os.utime(local_path)
+    return f"{location}##idx##{local_path}"
@@ -8,9 +8,12 @@ import boto3
 from botocore.config import Config
 
 from shared.dynamodb import query_clinic_job, update_clinic_job
+from .index_cache import with_cached_index
 
 REGION = os.environ.get("REGION")
 MAX_PRINT_LENGTH = 1024
+# Remote VCFs passed to these share one cached copy of their index
+INDEXED_COMMANDS = ("bcftools", "tabix")
 
 s3_client = boto3.client(
     "s3",
@@ -34,6 +37,10 @@ class ProcessError(Exception):
 
 class CheckedProcess:
     def __init__(self, args, error_message=None, **kwargs):
+        if os.path.basename(args[0]) in INDEXED_COMMANDS:
+            args = [
+                with_cached_index(arg) if isinstance(arg, str) else arg for arg in args
+            ]
         defaults = {
             "args": args,
             "stderr": subprocess.PIPE,
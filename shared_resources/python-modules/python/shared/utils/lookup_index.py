@@ -0,0 +1,313 @@
+import mmap
+import os
+import struct
+
+from .chrom_matching import ChromosomeNotFoundError, match_chromosome_name
+
+LOOKUP_INDEX_SUFFIX = ".idx"
+LOOKUP_INDEX_MAGIC_V1 = b"PGXLKIX1"
+# Adds a section of row coordinates for position joins
+LOOKUP_INDEX_MAGIC = b"PGXLKIX2"
+
+RSID_JOIN_MODE = "rsid"
+POSITION_JOIN_MODE = "position"
+
+# magic, column count, string count, row count, key count,
+# then the byte offsets of each section
+HEADER_V1 = struct.Struct("<8sIIII5Q")
+# As above, then interval count, longest interval and the interval offset
+HEADER = struct.Struct("<8sIIII5QIIQ")
+UINT32 = struct.Struct("<I")
+KEY_ENTRY = struct.Struct("<III")
+# chromosome string id, start, end, row
+INTERVAL_ENTRY = struct.Struct("<IIII")
+
+
+class LookupIndexError(Exception):
+    pass
+
+
+def get_lookup_index_key(lookup_reference, lookup_hash):
+    """
+    Return the key of the index published for a version of the matrix, so
+    that a download never pairs one version's hash with another's index.
+    """
+    return f"{lookup_reference}.{lookup_hash}{LOOKUP_INDEX_SUFFIX}"
+
+
+def get_row_interval(row, interval_columns):
+    """
+    Return the normalised (chromosome, start, end) of a row, or None if the
+    row doesn't have valid coordinates.
+
+    Args:
+        row (dict): Row of the association matrix
+        interval_columns (tuple[str]): Chromosome, start and end columns
+    """
+    chr_column, start_column, end_column = interval_columns
+    try:
+        return (
+            match_chromosome_name(row.get(chr_column) or ""),
+            int(row[start_column]),
+            int(row[end_column]),
+        )
+    except (ChromosomeNotFoundError, KeyError, TypeError, ValueError):
+        return None
+
+
+def write_lookup_index(
+    output_path, fieldnames, rows, key_column, interval_columns=None
+):
+    """
+    Compile association matrix rows into a memory-mappable binary index.
+
+    The file holds an interned string table, a fixed width row table of
+    string ids and a key table of (key string id, first row, row count)
+    sorted by key so that rows can be found with a binary search. Rows with
+    coordinates also get an entry in an interval table sorted by chromosome
+    and start, so that rows can be found by position.
+
+    Args:
+        output_path (str): Path to write the index to
+        fieldnames (list[str]): Column names, in output order
+        rows (Iterable[dict]): Rows of the association matrix
+        key_column (str): Column used to look rows up
+        interval_columns (tuple[str]): Chromosome, start and end columns, if
+            rows should also be indexed by position
+    """
+    strings = {}
+
+    def intern(string):
+        if string not in strings:
+            strings[string] = len(strings)
+        return strings[string]
+
+    column_ids = [intern(column) for column in fieldnames]
+    grouped_rows = {}
+    for row in rows:
+        row_ids = [intern(row.get(column) or "") for column in fieldnames]
+        interval = interval_columns and get_row_interval(row, interval_columns)
+        if interval:
+            chrom, start, end = interval
+            interval = (intern(chrom), start, end)
+        grouped_rows.setdefault(row[key_column], []).append((row_ids, interval))
+
+    encoded_strings = [string.encode("utf-8") for string in strings]
+    sorted_keys = sorted(grouped_rows, key=lambda key: key.encode("utf-8"))
+
+    columns_pos = HEADER.size
+    string_offsets_pos = columns_pos + UINT32.size * len(column_ids)
+    string_data_pos = string_offsets_pos + UINT32.size * (len(encoded_strings) + 1)
+    string_data_size = sum(len(string) for string in encoded_strings)
+    # Keep the integer tables 4-byte aligned
+    rows_pos = string_data_pos + string_data_size + (-string_data_size % 4)
+    row_count = sum(len(key_rows) for key_rows in grouped_rows.values())
+    keys_pos = rows_pos + UINT32.size * len(column_ids) * row_count
+    intervals_pos = keys_pos + KEY_ENTRY.size * len(sorted_keys)
+
+    # Rows are written grouped by key, so intervals refer to that order
+    intervals = []
+    row_index = 0
+    for key in sorted_keys:
+        for _, interval in grouped_rows[key]:
+            if interval:
+                intervals.append((*interval, row_index))
+            row_index += 1
+    intervals.sort(key=lambda entry: (encoded_strings[entry[0]], entry[1]))
+    max_span = max((end - start for _, start, end, _ in intervals), default=0)
+
+    with open(output_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                LOOKUP_INDEX_MAGIC,
+                len(column_ids),
+                len(encoded_strings),
+                row_count,
+                len(sorted_keys),
+                columns_pos,
+                string_offsets_pos,
+                string_data_pos,
+                rows_pos,
+                keys_pos,
+                len(intervals),
+                max_span,
+                intervals_pos,
+            )
+        )
+        f.write(struct.pack(f"<{len(column_ids)}I", *column_ids))
+        offset = 0
+        for string in encoded_strings:
+            f.write(UINT32.pack(offset))
+            offset += len(string)
+        f.write(UINT32.pack(offset))
+        for string in encoded_strings:
+            f.write(string)
+        f.write(b"\0" * (-string_data_size % 4))
+        for key in sorted_keys:
+            for row_ids, _ in grouped_rows[key]:
+                f.write(struct.pack(f"<{len(row_ids)}I", *row_ids))
+        row_start = 0
+        for key in sorted_keys:
+            key_rows = grouped_rows[key]
+            f.write(KEY_ENTRY.pack(strings[key], row_start, len(key_rows)))
+            row_start += len(key_rows)
+        for interval in intervals:
+            f.write(INTERVAL_ENTRY.pack(*interval))
+
+    print(
+        f"Wrote lookup index with {row_count} rows, {len(sorted_keys)} keys,"
+        f" {len(intervals)} intervals and {len(encoded_strings)} distinct strings"
+        f" to {output_path}"
+    )
+
+
+class LookupIndex:
+    """Read-only view of a compiled lookup index backed by mmap."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_V1.size:
+                raise LookupIndexError(f"{path} is too short to be a lookup index")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header(size)
+        except (LookupIndexError, struct.error, UnicodeDecodeError) as e:
+            self._mmap.close()
+            raise LookupIndexError(f"{path} is not a valid lookup index: {e}")
+
+    def _read_header(self, size):
+        magic = self._mmap[:8]
+        if magic == LOOKUP_INDEX_MAGIC:
+            header = HEADER.unpack_from(self._mmap, 0)
+            self.n_intervals, self._max_span, self._intervals_pos = header[10:]
+        elif magic == LOOKUP_INDEX_MAGIC_V1:
+            header = HEADER_V1.unpack_from(self._mmap, 0)
+            self.n_intervals, self._max_span, self._intervals_pos = 0, 0, None
+        else:
+            raise LookupIndexError("unknown magic")
+        (
+            self.n_columns,
+            self.n_strings,
+            self.n_rows,
+            self.n_keys,
+            columns_pos,
+            self._string_offsets_pos,
+            self._string_data_pos,
+            self._rows_pos,
+            self._keys_pos,
+        ) = header[1:10]
+        # A truncated upload would otherwise only fail on some lookups
+        section_ends = [
+            columns_pos + UINT32.size * self.n_columns,
+            self._string_offsets_pos + UINT32.size * (self.n_strings + 1),
+            self._rows_pos + UINT32.size * self.n_columns * self.n_rows,
+            self._keys_pos + KEY_ENTRY.size * self.n_keys,
+        ]
+        if self._intervals_pos is not None:
+            section_ends.append(
+                self._intervals_pos + INTERVAL_ENTRY.size * self.n_intervals
+            )
+        if max(section_ends) > size:
+            raise LookupIndexError(f"sections end after its {size} bytes")
+        (string_data_size,) = UINT32.unpack_from(
+            self._mmap, self._string_offsets_pos + UINT32.size * self.n_strings
+        )
+        if self._string_data_pos + string_data_size > size:
+            raise LookupIndexError(f"strings end after its {size} bytes")
+        # Indexes written before intervals were added can only join by key
+        self.has_intervals = self._intervals_pos is not None
+        self._row_format = struct.Struct(f"<{self.n_columns}I")
+        self.columns = [
+            self._string(string_id)
+            for string_id in struct.unpack_from(
+                f"<{self.n_columns}I", self._mmap, columns_pos
+            )
+        ]
+
+    def _string_bytes(self, string_id):
+        start, end = struct.unpack_from(
+            "<II", self._mmap, self._string_offsets_pos + UINT32.size * string_id
+        )
+        return self._mmap[self._string_data_pos + start : self._string_data_pos + end]
+
+    def _string(self, string_id):
+        return self._string_bytes(string_id).decode("utf-8")
+
+    def _find_key(self, key):
+        target = key.encode("utf-8")
+        low, high = 0, self.n_keys
+        while low < high:
+            mid = (low + high) // 2
+            string_id, row_start, row_count = KEY_ENTRY.unpack_from(
+                self._mmap, self._keys_pos + KEY_ENTRY.size * mid
+            )
+            current = self._string_bytes(string_id)
+            if current < target:
+                low = mid + 1
+            elif current > target:
+                high = mid
+            else:
+                return row_start, row_count
+        return None
+
+    def _row(self, row):
+        return dict(
+            zip(
+                self.columns,
+                (
+                    self._string(string_id)
+                    for string_id in self._row_format.unpack_from(
+                        self._mmap, self._rows_pos + self._row_format.size * row
+                    )
+                ),
+            )
+        )
+
+    def get(self, key, default=None):
+        """Return the rows for a key as dicts, like a dict of lists of rows."""
+        found = self._find_key(key)
+        if found is None:
+            return default
+        row_start, row_count = found
+        return [self._row(row) for row in range(row_start, row_start + row_count)]
+
+    def _interval(self, i):
+        return INTERVAL_ENTRY.unpack_from(
+            self._mmap, self._intervals_pos + INTERVAL_ENTRY.size * i
+        )
+
+    def overlapping(self, chrom, pos):
+        """
+        Return the rows whose interval contains a position, as dicts.
+
+        Intervals are half-open, so a row from 100 to 101 only holds position
+        100, except that a row whose start equals its end holds that position.
+
+        Args:
+            chrom (str): Normalised chromosome name
+            pos (int): Position, in the same coordinates as the matrix
+        """
+        if not self.has_intervals:
+            raise LookupIndexError("Lookup index has no intervals")
+        target = (chrom.encode("utf-8"), max(0, pos - self._max_span))
+        # Find the first interval that could contain pos
+        low, high = 0, self.n_intervals
+        while low < high:
+            mid = (low + high) // 2
+            string_id, start, _, _ = self._interval(mid)
+            if (self._string_bytes(string_id), start) < target:
+                low = mid + 1
+            else:
+                high = mid
+        rows = []
+        for i in range(low, self.n_intervals):
+            string_id, start, end, row = self._interval(i)
+            if start > pos or self._string_bytes(string_id) != target[0]:
+                break
+            if pos < end or pos == start:
+                rows.append(self._row(row))
+        return rows
+
+    def close(self):
+        self._mmap.close()
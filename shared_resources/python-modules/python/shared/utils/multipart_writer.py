@@ -0,0 +1,86 @@
+import boto3
+
+# S3 requires every part except the last to be at least 5 MiB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+s3_client = boto3.client("s3")
+
+
+class S3MultipartWriter:
+    """
+    Write text to an S3 object as it is produced, holding at most one part
+    in memory.
+
+    Objects smaller than a single part are uploaded with put_object. Used as
+    a context manager, the upload is completed on exit or aborted if an
+    exception was raised.
+    """
+
+    def __init__(self, bucket, key, part_size=DEFAULT_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer.clear()
+
+    def close(self):
+        if self._upload_id is None:
+            s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+            )
+        else:
+            if self._buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        print(
+            f"Wrote {self.bytes_written} bytes in {max(1, len(self._parts))} parts"
+            f" to s3://{self.bucket}/{self.key}"
+        )
+
+    def abort(self):
+        if self._upload_id is not None:
+            s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        self._buffer.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,58 @@
+def estimate_blocks(ranges, block_span):
+    """
+    Estimate the compressed blocks read by a query, counting one block for
+    the seek to each range and one for every block_span bases it covers.
+    """
+    return sum(1 + (end - start) // block_span for start, end in ranges)
+
+
+def plan_position_queries(
+    positions, block_span, max_gap, max_blocks_per_query, max_ranges_per_query=1000
+):
+    """
+    Group sorted positions into ranges and ranges into queries by distance.
+
+    Positions at most max_gap apart are read as one range, because fetching
+    the blocks between them costs less than another seek. Queries are then
+    filled with ranges until they would read more than max_blocks_per_query
+    blocks, so nearby positions share a query while distant ones are spread
+    across queries that can run in parallel. Ranges return every record
+    inside them, so callers need to filter for the exact positions.
+
+    Args:
+        positions (list[int]): Sorted, distinct positions to query
+        block_span (int): Estimated bases covered by one compressed block
+        max_gap (int): Largest distance between positions in one range
+        max_blocks_per_query (int): Estimated block budget of one query
+        max_ranges_per_query (int): Bounds the length of the region argument
+
+    Returns:
+        list[list[tuple]]: Queries, each a list of 1-based inclusive
+            (start, end) ranges
+    """
+    max_range_span = block_span * max_blocks_per_query
+    ranges = []
+    for pos in positions:
+        if (
+            ranges
+            and pos - ranges[-1][1] <= max_gap
+            and pos - ranges[-1][0] < max_range_span
+        ):
+            ranges[-1][1] = pos
+        else:
+            ranges.append([pos, pos])
+
+    queries = []
+    query_blocks = 0
+    for start, end in ranges:
+        blocks = estimate_blocks([(start, end)], block_span)
+        if (
+            not queries
+            or query_blocks + blocks > max_blocks_per_query
+            or len(queries[-1]) >= max_ranges_per_query
+        ):
+            queries.append([])
+            query_blocks = 0
+        queries[-1].append((start, end))
+        query_blocks += blocks
+    return queries
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import urllib
@@ -6,6 +7,9 @@ import boto3
 from botocore.exceptions import ClientError
 
 DYNAMO_PGXFLOW_REFERENCES_TABLE = os.environ.get("DYNAMO_PGXFLOW_REFERENCES_TABLE")
+# Each dbSNP subset is published under its own version, which is only switched
+# to in the references table once the subset and its index are uploaded
+DBSNP_SUBSET_ID = "dbsnp_subset_version"
 
 s3 = boto3.resource("s3")
 dynamodb = boto3.client("dynamodb")
@@ -19,6 +23,13 @@ def fetch_remote_content(url):
         return response.read()
 
 
+# Published reference keys
+def get_dbsnp_subset_key(version):
+    """Return the key the dbSNP subset of a version is published under."""
+    # Versions join the dbSNP and lookup versions with colons
+    return f"dbsnp/{hashlib.md5(version.encode()).hexdigest()}/pgx_subset.vcf.gz"
+
+
 # dynamodb actions
 def query_references_table(id):
     kwargs = {
@@ -0,0 +1,33 @@
+from .chrom_matching import CHROMOSOME_LENGTHS_MBP
+
+CHROMOSOME_ORDER = {chrom: i for i, chrom in enumerate(CHROMOSOME_LENGTHS_MBP)}
+
+
+def merge_regions(regions):
+    """
+    Sort, deduplicate and merge 1-based inclusive regions per chromosome.
+
+    Overlapping and adjacent regions are merged, so that bcftools -R seeks
+    to each locus once and never returns the same record twice.
+
+    Args:
+        regions (Iterable[tuple]): (chromosome, start, end) regions, with
+            normalised chromosome names
+
+    Returns:
+        list[list]: Merged [chromosome, start, end] regions, in chromosome
+            and then position order
+    """
+    merged = []
+    for chrom, start, end in sorted(
+        regions,
+        key=lambda region: (
+            CHROMOSOME_ORDER.get(region[0], len(CHROMOSOME_ORDER)),
+            *region,
+        ),
+    ):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, start, end])
+    return merged
@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+
+from .lambda_utils import CheckedProcess
+
+DEFAULT_MAX_WORKERS = 8
+
+
+def _run_checked_process(args, error_message):
+    start = time.perf_counter()
+    process = CheckedProcess(args, error_message=error_message)
+    stdout = process.check()
+    return stdout, time.perf_counter() - start
+
+
+def run_bounded_processes(
+    process_args, max_workers=DEFAULT_MAX_WORKERS, error_message=None
+):
+    """
+    Run commands with CheckedProcess, with at most max_workers running at once.
+
+    Args:
+        process_args (list[list[str]]): Arguments for each command
+        max_workers (int): Maximum number of concurrent processes
+        error_message (str): Error message for a failed process
+
+    Yields:
+        tuple: (index into process_args, stdout, elapsed seconds) for each
+            command, in order of completion
+    """
+    max_workers = max(1, min(max_workers, len(process_args)))
+    print(f"Running {len(process_args)} processes with {max_workers} workers")
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            executor.submit(_run_checked_process, args, error_message): i
+            for i, args in enumerate(process_args)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            stdout, elapsed = future.result()
+            print(f"Process {index + 1}/{len(process_args)} finished in {elapsed:.2f}s")
+            yield index, stdout, elapsed
+    finally:
+        # Don't start anything new if the caller stopped early or a process failed
+        executor.shutdown(wait=True, cancel_futures=True)
+    print(
+        f"Finished {len(process_args)} processes in {time.perf_counter() - start:.2f}s"
+    )
@@ -0,0 +1,158 @@
+import json
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .chrom_matching import ChromosomeNotFoundError, match_chromosome_name
+from .lambda_utils import CheckedProcess, ProcessError
+
+VCF_PROFILE_PREFIX = "vcf_profiles/"
+
+s3_client = boto3.client("s3")
+
+# Kept across warm starts, keyed by profile key
+loaded_vcf_profiles = {}
+
+
+def get_header_id(line):
+    return line.split("ID=", 1)[1].split(",", 1)[0].rstrip(">")
+
+
+def read_index_contigs(location, cwd="/tmp"):
+    """
+    List the contigs with records in the index of a VCF.
+
+    Args:
+        location (str): Path or URL of an indexed VCF
+        cwd (str): Directory to run bcftools in
+
+    Returns:
+        list[tuple]: Each contig and its record count, or None for the count
+            if the index doesn't record it
+    """
+    stats_process = CheckedProcess(["bcftools", "index", "--stats", location], cwd=cwd)
+    stats_lines = list(stats_process.stdout)
+    try:
+        stats_process.check()
+    except ProcessError as e:
+        # Indexes written by htsjdk, e.g. by GATK, have no count metadata
+        print(f"Couldn't read index stats, listing contigs instead: {e}")
+        list_process = CheckedProcess(["tabix", "--list-chroms", location], cwd=cwd)
+        contigs = [line.rstrip("\n") for line in list_process.stdout]
+        list_process.check()
+        return [(contig, None) for contig in contigs if contig]
+    contig_counts = []
+    for line in stats_lines:
+        contig, _, count = line.rstrip("\n").split("\t")
+        contig_counts.append((contig, None if count == "." else int(count)))
+    return contig_counts
+
+
+def read_vcf_profile(location, cwd="/tmp"):
+    """
+    Read the header and index of a VCF once and summarise them.
+
+    Args:
+        location (str): Path or URL of an indexed VCF
+        cwd (str): Directory to run bcftools in
+
+    Returns:
+        dict: samples, contigs, chromosome_mapping (contigs with records to
+            their normalised names), format_tags, info_tags and record_count,
+            which only counts contigs whose index records it
+    """
+    profile = {
+        "samples": [],
+        "contigs": [],
+        "chromosome_mapping": {},
+        "format_tags": [],
+        "info_tags": [],
+        "record_count": 0,
+    }
+    header_process = CheckedProcess(["bcftools", "head", location], cwd=cwd)
+    for line in header_process.stdout:
+        if line.startswith("##contig=<ID="):
+            profile["contigs"].append(get_header_id(line))
+        elif line.startswith("##FORMAT=<ID="):
+            profile["format_tags"].append(get_header_id(line))
+        elif line.startswith("##INFO=<ID="):
+            profile["info_tags"].append(get_header_id(line))
+        elif line.startswith("#CHROM"):
+            profile["samples"] = line.rstrip("\n").split("\t")[9:]
+    header_process.check()
+
+    # The index lists only contigs with records, like tabix --list-chroms
+    for contig, count in read_index_contigs(location, cwd):
+        try:
+            profile["chromosome_mapping"][contig] = match_chromosome_name(contig)
+        except ChromosomeNotFoundError:
+            print(f"Ignoring contig {contig}, it isn't a supported chromosome")
+        if count is not None:
+            profile["record_count"] += count
+    print(
+        f"Profiled {location}: {len(profile['samples'])} samples,"
+        f" {len(profile['chromosome_mapping'])} chromosomes with records,"
+        f" about {profile['record_count']} records"
+    )
+    return profile
+
+
+def get_vcf_profile_key(location):
+    """Return the profile key for an S3 VCF, based on its ETag."""
+    parsed_location = urlparse(location)
+    response = s3_client.head_object(
+        Bucket=parsed_location.netloc, Key=parsed_location.path.lstrip("/")
+    )
+    etag = response["ETag"].strip('"')
+    return f"{VCF_PROFILE_PREFIX}{etag}.json"
+
+
+def load_vcf_profile(bucket, profile_key):
+    """
+    Load a profile saved by get_vcf_profile.
+
+    Returns:
+        dict: The profile, or None if it hasn't been saved
+    """
+    if profile_key in loaded_vcf_profiles:
+        return loaded_vcf_profiles[profile_key]
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=profile_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    profile = json.loads(response["Body"].read())
+    loaded_vcf_profiles[profile_key] = profile
+    return profile
+
+
+def get_vcf_profile(location, bucket, profile_key=None):
+    """
+    Return the profile of an S3 VCF, reading it only once per object version.
+
+    Profiles are saved in bucket under the ETag of the VCF, so later stages
+    of the same job can load it by key instead of reading the VCF again.
+
+    Args:
+        location (str): s3:// URI of an indexed VCF
+        bucket (str): Bucket to save profiles in
+        profile_key (str): Key of the profile passed on by an earlier stage
+
+    Returns:
+        dict: The profile, with its key in profile_key
+    """
+    if profile_key is None:
+        profile_key = get_vcf_profile_key(location)
+    profile = load_vcf_profile(bucket, profile_key)
+    if profile is not None:
+        print(f"Using saved VCF profile s3://{bucket}/{profile_key}")
+        return profile
+    profile = read_vcf_profile(location)
+    profile["profile_key"] = profile_key
+    s3_client.put_object(
+        Bucket=bucket, Key=profile_key, Body=json.dumps(profile).encode()
+    )
+    loaded_vcf_profiles[profile_key] = profile
+    return profile
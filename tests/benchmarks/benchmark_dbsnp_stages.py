@@ -0,0 +1,170 @@
+"""
+Compare the time of each dbsnp lambda stage between the original path, which
+compressed the renamed VCF, indexed both outputs with separate bcftools index
+runs and filtered by the regions again while annotating, and the current path.
+
+Needs bcftools with remote file support, as in the binaries layer. Run from
+the tests directory:
+    python benchmarks/benchmark_dbsnp_stages.py --dbsnp DBSNP_VCF
+        [--vcf SOURCE_VCF] [--margin N] [--repeats N]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+TEST_VCF = os.path.join(
+    os.path.dirname(__file__),
+    "../test_lookup/annotated_01JWWAZ668XYVCTYW0ZNKN26CN.vcf.gz",
+)
+
+
+def run(args):
+    start = time.perf_counter()
+    subprocess.run(args, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def write_regions(vcf, regions_path, margin):
+    """Write padded, merged regions around every record of the VCF."""
+    records = subprocess.run(
+        ["bcftools", "query", "-f", "%CHROM\t%POS\n", vcf],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.splitlines()
+    regions = []
+    for record in records:
+        chrom, pos = record.split("\t")
+        start, end = max(1, int(pos) - margin), int(pos) + margin
+        if regions and regions[-1][0] == chrom and start <= regions[-1][2] + 1:
+            regions[-1][2] = max(regions[-1][2], end)
+        else:
+            regions.append([chrom, start, end])
+    with open(regions_path, "w") as f:
+        for chrom, start, end in regions:
+            f.write(f"{chrom}\t{start}\t{end}\n")
+    with open(f"{regions_path}.chrs", "w") as f:
+        for chrom in dict.fromkeys(chrom for chrom, _, _ in regions):
+            f.write(f"{chrom}\t{chrom}\n")
+
+
+def original_stages(vcf, dbsnp, regions_path, work_dir):
+    renamed = os.path.join(work_dir, "original_renamed.vcf.gz")
+    annotated = os.path.join(work_dir, "original_annotated.vcf.gz")
+    return {
+        "rename": run(
+            [
+                "bcftools",
+                "annotate",
+                "--rename-chrs",
+                f"{regions_path}.chrs",
+                "-R",
+                regions_path,
+                vcf,
+                "-Oz",
+                "-o",
+                renamed,
+            ]
+        ),
+        "index renamed": run(["bcftools", "index", "-f", renamed]),
+        "annotate": run(
+            [
+                "bcftools",
+                "annotate",
+                "--annotations",
+                dbsnp,
+                "--columns",
+                "ID",
+                "-R",
+                regions_path,
+                renamed,
+                "-Oz",
+                "-o",
+                annotated,
+            ]
+        ),
+        "index annotated": run(["bcftools", "index", "-f", annotated]),
+    }
+
+
+def current_stages(vcf, dbsnp, regions_path, work_dir):
+    renamed = os.path.join(work_dir, "current_renamed.bcf")
+    annotated = os.path.join(work_dir, "current_annotated.vcf.gz")
+    return {
+        "rename": run(
+            [
+                "bcftools",
+                "annotate",
+                "--rename-chrs",
+                f"{regions_path}.chrs",
+                "-R",
+                regions_path,
+                vcf,
+                "-Ob0",
+                "--write-index",
+                "-o",
+                renamed,
+            ]
+        ),
+        "index renamed": 0.0,
+        "annotate": run(
+            [
+                "bcftools",
+                "annotate",
+                "--annotations",
+                dbsnp,
+                "--columns",
+                "ID",
+                renamed,
+                "-Oz",
+                "--write-index",
+                "-o",
+                annotated,
+            ]
+        ),
+        "index annotated": 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vcf", default=TEST_VCF)
+    parser.add_argument("--dbsnp", required=True)
+    parser.add_argument("--margin", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        regions_path = os.path.join(work_dir, "regions.txt")
+        write_regions(args.vcf, regions_path, args.margin)
+        original = [
+            original_stages(args.vcf, args.dbsnp, regions_path, work_dir)
+            for _ in range(args.repeats)
+        ]
+        current = [
+            current_stages(args.vcf, args.dbsnp, regions_path, work_dir)
+            for _ in range(args.repeats)
+        ]
+
+    print(f"{'stage':<16} {'original':>10} {'current':>10} {'saved':>10}")
+    for stage in original[0]:
+        original_time = statistics.median(run[stage] for run in original)
+        current_time = statistics.median(run[stage] for run in current)
+        print(
+            f"{stage:<16} {original_time:>9.2f}s {current_time:>9.2f}s"
+            f" {original_time - current_time:>9.2f}s"
+        )
+    original_total = statistics.median(sum(run.values()) for run in original)
+    current_total = statistics.median(sum(run.values()) for run in current)
+    print(
+        f"{'total':<16} {original_total:>9.2f}s {current_total:>9.2f}s"
+        f" {original_total - current_total:>9.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Compare peak memory of the lookup -> gnomad hand-off as one JSON document
+against streamed JSON lines, on a synthetic VCF where every variant matches
+several wide association matrix rows.
+
+Run from the tests directory:
+    python benchmarks/benchmark_lookup_jsonl.py [--variants N] [--matches N]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import boto3
+from moto import mock_aws
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../test_lookup"))
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), "../../pipeline_lookup/lambda/lookup")
+)
+sys.path.append(
+    os.path.join(
+        os.path.dirname(__file__), "../../shared_resources/python-modules/python"
+    )
+)
+
+# Sets the lambda environment variables on import
+import test_utils.env  # noqa: E402,F401
+import lambda_function  # noqa: E402
+from shared.utils import S3MultipartWriter  # noqa: E402
+
+BUCKET = os.environ["PGXFLOW_BUCKET"]
+ROW_WIDTH = 40
+
+
+def synthetic_query_lines(fields, n_variants):
+    """bcftools query output for a VCF whose every variant has an rsID."""
+    for i in range(n_variants):
+        values = {
+            "_rsid": f"rs{i}",
+            "chromVcf": "chr1",
+            "posVcf": str(1000 + i),
+            "refVcf": "A",
+            "_alts": "C,T",
+            "qual": ".",
+            "filter": "PASS",
+        }
+        yield "\t".join(values.get(field, "0/1") for field in fields) + "\n"
+
+
+def synthetic_lookup_table(n_variants, n_matches):
+    return {
+        f"rs{i}": [
+            {
+                "Variant": f"rs{i}",
+                "Description": f"Association {j} " + "x" * ROW_WIDTH,
+                **{f"column_{k}": "value " * 4 for k in range(10)},
+            }
+            for j in range(n_matches)
+        ]
+        for i in range(n_variants)
+    }
+
+
+def measure(name, function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<28} {elapsed:>8.2f}s {peak / 1024 / 1024:>10.1f} MiB peak")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variants", type=int, default=20000)
+    parser.add_argument("--matches", type=int, default=5)
+    args = parser.parse_args()
+
+    fields = {
+        **lambda_function.REQUESTED_FIELDS,
+        **{field: "." for field in lambda_function.REQUESTED_FORMAT_TAGS},
+    }
+    lookup_table = synthetic_lookup_table(args.variants, args.matches)
+
+    with mock_aws():
+        s3_client = boto3.client("s3")
+        s3_client.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={
+                "LocationConstraint": os.environ["AWS_DEFAULT_REGION"],
+            },
+        )
+
+        def write_json():
+            results = list(
+                lambda_function.join_lookup(
+                    synthetic_query_lines(fields, args.variants), fields, lookup_table
+                )
+            )
+            s3_client.put_object(
+                Bucket=BUCKET,
+                Key="benchmark_lookup.json",
+                Body=json.dumps(results).encode(),
+            )
+            return len(results)
+
+        def write_jsonl():
+            n_results = 0
+            with S3MultipartWriter(BUCKET, "benchmark_lookup.jsonl") as writer:
+                for result in lambda_function.join_lookup(
+                    synthetic_query_lines(fields, args.variants), fields, lookup_table
+                ):
+                    writer.write(json.dumps(result) + "\n")
+                    n_results += 1
+            return n_results
+
+        def read_json():
+            body = s3_client.get_object(Bucket=BUCKET, Key="benchmark_lookup.json")
+            return len(json.loads(body["Body"].read().decode("utf-8")))
+
+        def read_jsonl(batch_size=10000):
+            body = s3_client.get_object(Bucket=BUCKET, Key="benchmark_lookup.jsonl")
+            n_rows = 0
+            batch = []
+            for line in body["Body"].iter_lines():
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    n_rows += len(batch)
+                    batch = []
+            return n_rows + len(batch)
+
+        print(f"{args.variants} variants with {args.matches} matches each")
+        n_json = measure("lookup write, JSON", write_json)
+        n_jsonl = measure("lookup write, JSONL", write_jsonl)
+        assert n_json == n_jsonl
+        measure("gnomad read, JSON", read_json)
+        measure("gnomad read, JSONL batches", read_jsonl)
+        print(f"{n_jsonl} rows")
+
+
+if __name__ == "__main__":
+    main()
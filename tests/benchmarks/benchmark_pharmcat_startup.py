@@ -0,0 +1,97 @@
+"""
+Compare the time PharmCAT takes to its first output line and to its report
+on the test VCFs, with and without the AppCDS archive built into the
+pharmcat image.
+
+Needs java and the jar and archive from the image, for example copied out
+of it with docker cp. Run from the tests directory:
+    python benchmarks/benchmark_pharmcat_startup.py --jar-dir DIR [--repeats N]
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+TEST_VCFS = sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), "../test_pharmcat/*.vcf.gz"))
+)
+
+
+def run_pharmcat(jar_dir, vcf, output_dir, java_options):
+    """Return the seconds to the first output line and to the end of the run."""
+    cmd = (
+        ["java"]
+        + java_options
+        + [
+            "-jar",
+            # The archive only matches the class path it was created with
+            "pharmcat.jar",
+            "--reporter-extended",
+            "--reporter-save-json",
+            "--matcher-save-html",
+            "-vcf",
+            os.path.abspath(vcf),
+            "-o",
+            output_dir,
+            "-bf",
+            "benchmark",
+        ]
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        cmd,
+        cwd=jar_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+    )
+    first_output = None
+    output = []
+    for line in process.stdout:
+        if first_output is None:
+            first_output = time.perf_counter() - start
+        output.append(line)
+    if process.wait() != 0:
+        raise RuntimeError(f"PharmCAT failed:\n{''.join(output)}")
+    return first_output, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jar-dir", required=True, help="Has pharmcat.jar")
+    parser.add_argument("--archive", help="Defaults to pharmcat.jsa in --jar-dir")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    archive = os.path.abspath(
+        args.archive or os.path.join(args.jar_dir, "pharmcat.jsa")
+    )
+    configurations = {
+        "without archive": [],
+        # Fails instead of silently running without a mismatched archive
+        "with archive": [f"-XX:SharedArchiveFile={archive}", "-Xshare:on"],
+    }
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for vcf in TEST_VCFS:
+            print(os.path.basename(vcf))
+            # Warms the page cache for the jar, so both runs read it from memory
+            run_pharmcat(args.jar_dir, vcf, output_dir, [])
+            for name, java_options in configurations.items():
+                timings = [
+                    run_pharmcat(args.jar_dir, vcf, output_dir, java_options)
+                    for _ in range(args.repeats)
+                ]
+                first_output = statistics.median(t[0] for t in timings)
+                total = statistics.median(t[1] for t in timings)
+                print(
+                    f"  {name:<16} first output {first_output:>6.2f}s,"
+                    f" report {total:>6.2f}s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Compare the time to walk a large synthetic PharmCAT report with ijson alone
+against parse_report routing every event to the postprocessor handlers.
+
+Run from the tests directory:
+    python benchmarks/benchmark_postprocessor_parse.py [--genes N] [--drugs N]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+N_ALLELES = 8
+ORGANISATIONS = [
+    {"gene": "CPIC", "drug": "CPIC Guideline Annotation"},
+    {"gene": "DPWG", "drug": "DPWG Guideline Annotation"},
+]
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(__file__), "../../pipeline_pharmcat/lambda/postprocessor"
+    )
+)
+sys.path.append(
+    os.path.join(
+        os.path.dirname(__file__), "../../shared_resources/python-modules/python"
+    )
+)
+
+
+def set_environment(n_genes, n_drugs):
+    # Half of the genes and drugs are configured, like a real deployment
+    os.environ.update(
+        {
+            "AWS_DEFAULT_REGION": "ap-southeast-2",
+            "DPORTAL_BUCKET": "dportal-bucket",
+            "PGXFLOW_BUCKET": "pgxflow-bucket",
+            "ORGANISATIONS": json.dumps(ORGANISATIONS),
+            "GENES": ",".join(f"GENE{i}" for i in range(0, n_genes, 2)),
+            "DRUGS": ",".join(f"drug{i}" for i in range(0, n_drugs, 2)),
+        }
+    )
+
+
+def synthetic_gene(rng, name, n_diplotypes, n_variants):
+    alleles = [f"*{i}" for i in range(1, N_ALLELES)]
+    return {
+        "geneSymbol": name,
+        "sourceDiplotypes": [
+            {
+                "allele1": {"name": rng.choice(alleles), "function": "Normal"},
+                "allele2": {"name": rng.choice(alleles), "function": "Normal"},
+                "phenotypes": ["Normal Metabolizer"],
+            }
+            for _ in range(n_diplotypes)
+        ],
+        "variants": [
+            {
+                "chromosome": "chr1",
+                "position": 1000 + i,
+                "dbSnpId": f"rs{i}",
+                "call": rng.choice(["A|G", "A|A", None]),
+                "alleles": rng.sample(alleles, 2),
+            }
+            for i in range(n_variants)
+        ],
+        "messages": [
+            {"rule_name": f"rule_{i}", "message": "Message " * 10} for i in range(3)
+        ],
+    }
+
+
+def synthetic_drug(rng, name, n_genes, n_annotations):
+    return {
+        "name": name,
+        "citations": [{"pmid": str(i), "title": "Citation " * 5} for i in range(3)],
+        "guidelines": [
+            {
+                "annotations": [
+                    {
+                        "implications": ["<b>Implication</b> " * 3],
+                        "drugRecommendation": "<p>Recommendation</p>",
+                        "classification": "Strong",
+                        "population": "general",
+                        "genotypes": [
+                            {
+                                "diplotypes": [
+                                    {
+                                        "gene": f"GENE{rng.randrange(n_genes)}",
+                                        "allele1": {"name": "*1"},
+                                        "allele2": {
+                                            "name": f"*{rng.randrange(1, N_ALLELES)}"
+                                        },
+                                    }
+                                    for _ in range(2)
+                                ]
+                            }
+                        ],
+                        "dosingInformation": True,
+                        "alternateDrugAvailable": False,
+                        "otherPrescribingGuidance": False,
+                    }
+                    for _ in range(n_annotations)
+                ]
+            }
+        ],
+    }
+
+
+def write_report(path, n_genes, n_drugs):
+    rng = random.Random(0)
+    report = {
+        "title": "Synthetic PharmCAT report",
+        "genes": {
+            org["gene"]: {
+                f"GENE{i}": synthetic_gene(rng, f"GENE{i}", 4, 40)
+                for i in range(n_genes)
+            }
+            for org in ORGANISATIONS
+        },
+        "drugs": {
+            org["drug"]: {
+                f"drug{i}": synthetic_drug(rng, f"drug{i}", n_genes, 6)
+                for i in range(n_drugs)
+            }
+            for org in ORGANISATIONS
+        },
+    }
+    with open(path, "w") as f:
+        json.dump(report, f)
+
+
+def measure(name, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed:>8.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--genes", type=int, default=200)
+    parser.add_argument("--drugs", type=int, default=2000)
+    args = parser.parse_args()
+    set_environment(args.genes, args.drugs)
+
+    from drugs import DrugsHandler
+    from genes import GenesHandler
+    from messages import MessagesHandler
+    from utils import ijson_backend, parse_report
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        write_report(report_path, args.genes, args.drugs)
+        size = os.path.getsize(report_path)
+        print(f"{size / 1024 / 1024:.1f} MiB report, {ijson_backend.backend} backend")
+
+        def walk():
+            with open(report_path, "rb") as f:
+                return sum(1 for _ in ijson_backend.parse(f))
+
+        def dispatch():
+            # Chunks handed over by each handler
+            counts = {"genes": 0, "guidelines": 0, "messages": 0}
+
+            def counter(name):
+                def count(chunk):
+                    counts[name] += 1
+
+                return count
+
+            parse_report(
+                report_path,
+                [
+                    GenesHandler(counter("genes")),
+                    DrugsHandler(counter("guidelines")),
+                    MessagesHandler(counter("messages")),
+                ],
+            )
+            return counts
+
+        n_events = measure("ijson walk", walk)
+        counts = measure("parse_report, all handlers", dispatch)
+        print(f"{n_events} events, {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import csv
 import os
 import sys
 import io
@@ -45,6 +46,10 @@ def lambda_handler(event, context):
 @pytest.fixture(autouse=True, scope="session")
 def resources_dict():
     with mock_aws():
+        # shared.utils creates boto3 clients on import, which need the mocked
+        # credentials and the region from test_utils.env
+        from shared.utils import get_lookup_index_key, write_lookup_index
+
         s3_client = boto3.client("s3")
         lambda_client = boto3.client("lambda")
         iam = boto3.client("iam")
@@ -77,6 +82,37 @@ def resources_dict():
             "test_association_matrix.csv",
         )
 
+        lookup_index_path = "./test_lookup/test_association_matrix.csv.idx"
+        with open(
+            "./test_lookup/test_association_matrix.csv", encoding="utf-8-sig"
+        ) as f:
+            reader = csv.DictReader(f)
+            write_lookup_index(
+                lookup_index_path,
+                reader.fieldnames,
+                reader,
+                "Variant",
+                interval_columns=("chr", "start", "end"),
+            )
+        s3_client.upload_file(
+            lookup_index_path,
+            os.environ["REFERENCE_BUCKET"],
+            get_lookup_index_key("test_association_matrix.csv", "test_lookup_hash"),
+        )
+        os.remove(lookup_index_path)
+
+        dynamodb_client = boto3.client("dynamodb")
+        dynamodb_client.create_table(
+            TableName=os.environ["DYNAMO_PGXFLOW_REFERENCES_TABLE"],
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        dynamodb_client.put_item(
+            TableName=os.environ["DYNAMO_PGXFLOW_REFERENCES_TABLE"],
+            Item={"id": {"S": "lookup_hash"}, "version": {"S": "test_lookup_hash"}},
+        )
+
         role_response = iam.create_role(
             RoleName="test-role",
             AssumeRolePolicyDocument="""{
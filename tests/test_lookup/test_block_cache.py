@@ -0,0 +1,77 @@
+import os
+import threading
+import urllib.request
+from urllib.parse import quote
+
+import boto3
+import pytest
+
+TEST_KEY = "block_cache_test.bin"
+
+
+@pytest.fixture
+def block_cache_server(resources_dict, tmp_path):
+    from shared.utils.block_cache import BLOCK_SIZE, BlockCache, BlockCacheServer
+
+    # Room for two and a half blocks, so reading the whole object evicts
+    block_cache = BlockCache(str(tmp_path), max_bytes=BLOCK_SIZE * 5 // 2)
+    server = BlockCacheServer(block_cache)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def upload_test_object(data):
+    boto3.client("s3").put_object(
+        Bucket=os.environ["PGXFLOW_BUCKET"], Key=TEST_KEY, Body=data
+    )
+
+
+def read_range(server, start=None, end=None):
+    url = f"s3://{os.environ['PGXFLOW_BUCKET']}/{TEST_KEY}"
+    port = server.server_address[1]
+    headers = {} if start is None else {"Range": f"bytes={start}-{end}"}
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/{quote(url, safe='')}", headers=headers
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def get_cached_bytes(server):
+    cache_dir = server.block_cache.cache_dir
+    return sum(
+        os.path.getsize(os.path.join(cache_dir, filename))
+        for filename in os.listdir(cache_dir)
+    )
+
+
+def test_block_cache_ranges(block_cache_server, monkeypatch):
+    from shared.utils import block_cache
+    from shared.utils.block_cache import BLOCK_SIZE
+
+    stats = block_cache_server.block_cache.stats
+    data = os.urandom(BLOCK_SIZE * 3 + 100)
+    upload_test_object(data)
+
+    assert read_range(block_cache_server, 100, 200) == data[100:201]
+    assert (stats["hits"], stats["misses"]) == (0, 1)
+    assert read_range(block_cache_server, 150, 250) == data[150:251]
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    # Spans the end of the cached block and the start of the next
+    start = BLOCK_SIZE - 10
+    assert read_range(block_cache_server, start, start + 20) == data[start : start + 21]
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+
+    assert read_range(block_cache_server) == data
+    assert (stats["hits"], stats["misses"]) == (4, 4)
+    assert get_cached_bytes(block_cache_server) <= BLOCK_SIZE * 5 // 2
+
+    # Once the version is checked again, blocks of the old version are dropped
+    changed_data = os.urandom(BLOCK_SIZE + 100)
+    upload_test_object(changed_data)
+    monkeypatch.setattr(block_cache, "HTSLIB_INDEX_CACHE_TTL_SECONDS", -1)
+    assert read_range(block_cache_server, 100, 200) == changed_data[100:201]
+    assert (stats["hits"], stats["misses"]) == (4, 5)
+    assert get_cached_bytes(block_cache_server) == BLOCK_SIZE
@@ -15,6 +15,67 @@ def mock_make_api_call(self, operation_name, kwarg):
     return orig(self, operation_name, kwarg)
 
 
+TARGET_OUTPUT = [
+    {
+        "Variant": "rs7412",
+        "Zygosity": "1/0",
+        "chr": "chr19",
+        "start": "44908822",
+        "end": "44908823",
+        "Description": "Test present variant 1",
+        "chromVcf": "chr19",
+        "posVcf": 44908822,
+        "refVcf": "C",
+        "altVcf": "T",
+        "qual": ".",
+        "filter": "PASS",
+        "gt": "1/1",
+        "dp": "137",
+        "gq": "15",
+        "mq": ".",
+        "qd": ".",
+    },
+    {
+        "Variant": "rs7412",
+        "Zygosity": "1/0",
+        "chr": "chr19",
+        "start": "44908822",
+        "end": "44908823",
+        "Description": "Test present variant 2",
+        "chromVcf": "chr19",
+        "posVcf": 44908822,
+        "refVcf": "C",
+        "altVcf": "T",
+        "qual": ".",
+        "filter": "PASS",
+        "gt": "1/1",
+        "dp": "137",
+        "gq": "15",
+        "mq": ".",
+        "qd": ".",
+    },
+    {
+        "Variant": "rs7412",
+        "Zygosity": "1/0",
+        "chr": "chr19",
+        "start": "44908822",
+        "end": "44908823",
+        "Description": "Test present variant 3",
+        "chromVcf": "chr19",
+        "posVcf": 44908822,
+        "refVcf": "C",
+        "altVcf": "T",
+        "qual": ".",
+        "filter": "PASS",
+        "gt": "1/1",
+        "dp": "137",
+        "gq": "15",
+        "mq": ".",
+        "qd": ".",
+    },
+]
+
+
 def test_lookup(resources_dict):
     import lambda_function
 
@@ -36,69 +97,52 @@ def test_lookup(resources_dict):
         content = (
             s3_client.get_object(
                 Bucket=os.environ["PGXFLOW_BUCKET"],
-                Key="01JWWAZ668XYVCTYW0ZNKN26CN_lookup.json",
+                Key="01JWWAZ668XYVCTYW0ZNKN26CN_lookup.jsonl",
             )["Body"]
             .read()
             .decode("utf-8")
         )
-        actual_output = json.loads(content)
-        target_output = [
-            {
-                "Variant": "rs7412",
-                "Zygosity": "1/0",
-                "chr": "chr19",
-                "start": "44908822",
-                "end": "44908823",
-                "Description": "Test present variant 1",
-                "chromVcf": "chr19",
-                "posVcf": 44908822,
-                "refVcf": "C",
-                "altVcf": "T",
-                "qual": ".",
-                "filter": "PASS",
-                "gt": "1/1",
-                "dp": "137",
-                "gq": "15",
-                "mq": ".",
-                "qd": ".",
-            },
-            {
-                "Variant": "rs7412",
-                "Zygosity": "1/0",
-                "chr": "chr19",
-                "start": "44908822",
-                "end": "44908823",
-                "Description": "Test present variant 2",
-                "chromVcf": "chr19",
-                "posVcf": 44908822,
-                "refVcf": "C",
-                "altVcf": "T",
-                "qual": ".",
-                "filter": "PASS",
-                "gt": "1/1",
-                "dp": "137",
-                "gq": "15",
-                "mq": ".",
-                "qd": ".",
-            },
-            {
-                "Variant": "rs7412",
-                "Zygosity": "1/0",
-                "chr": "chr19",
-                "start": "44908822",
-                "end": "44908823",
-                "Description": "Test present variant 3",
-                "chromVcf": "chr19",
-                "posVcf": 44908822,
-                "refVcf": "C",
-                "altVcf": "T",
-                "qual": ".",
-                "filter": "PASS",
-                "gt": "1/1",
-                "dp": "137",
-                "gq": "15",
-                "mq": ".",
-                "qd": ".",
-            },
-        ]
-        assert actual_output == target_output
+        actual_output = [json.loads(line) for line in content.splitlines()]
+        assert actual_output == TARGET_OUTPUT
+
+
+def test_lookup_position_join(resources_dict):
+    import lambda_function
+
+    fields = {
+        **lambda_function.REQUESTED_FIELDS,
+        **{
+            field: f"[%{tag}]"
+            for field, tag in lambda_function.REQUESTED_FORMAT_TAGS.items()
+        },
+    }
+    # Without an rsID, so rows can only be matched by their coordinates
+    query_lines = [".\tchr19\t44908822\tC\tT\t.\tPASS\t1/1\t137\t15\t.\t.\n"]
+    lookup_table = lambda_function.load_lookup_table(lambda_function.POSITION_JOIN_MODE)
+    actual_output = list(
+        lambda_function.join_lookup(
+            query_lines, fields, lookup_table, lambda_function.POSITION_JOIN_MODE
+        )
+    )
+    assert actual_output == TARGET_OUTPUT
+    # The matrix row ends at 44908823, which it doesn't include
+    adjacent_lines = [".\tchr19\t44908823\tC\tT\t.\tPASS\t1/1\t137\t15\t.\t.\n"]
+    adjacent_output = list(
+        lambda_function.join_lookup(
+            adjacent_lines, fields, lookup_table, lambda_function.POSITION_JOIN_MODE
+        )
+    )
+    assert adjacent_output == []
+
+
+@pytest.mark.parametrize("length", [0, 40, 200])
+def test_truncated_lookup_index(resources_dict, tmp_path, length):
+    from shared.utils import LookupIndex, LookupIndexError, write_lookup_index
+
+    index_path = tmp_path / "matrix.csv.idx"
+    rows = [{"Variant": f"rs{i}", "Description": "x" * 20} for i in range(10)]
+    write_lookup_index(index_path, ["Variant", "Description"], rows, "Variant")
+    with open(index_path, "r+b") as f:
+        f.truncate(length)
+    with pytest.raises(LookupIndexError):
+        LookupIndex(index_path)
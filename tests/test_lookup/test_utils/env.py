@@ -12,6 +12,11 @@ keys = {
     "PGXFLOW_BUCKET": "pgxflow-bucket",
     "REFERENCE_BUCKET": "reference-bucket",
     "LOOKUP_REFERENCE": "test_association_matrix.csv",
+    "CHR_HEADER": "chr",
+    "START_HEADER": "start",
+    "END_HEADER": "end",
+    # dynamodb
+    "DYNAMO_PGXFLOW_REFERENCES_TABLE": "pgxflow-references",
     # lambda
     "PGXFLOW_GNOMAD_LAMBDA": "PGXFLOW_GNOMAD_LAMBDA",
     "LOCAL_DIR": "test_lookup",
@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(__file__), "../../pipeline_pharmcat/lambda/postprocessor"
+        )
+    )
+)
+
+GVCF = os.path.join(os.path.dirname(__file__), "gvcf_ref_block.vcf.gz")
+
+
+def test_query_variant_genotypes_gvcf_ref_block():
+    from genes import get_query_fields, query_variant_genotypes
+
+    query_fields = get_query_fields(["GT", "DP"])
+    genotypes = query_variant_genotypes(
+        {"chr10": "10"},
+        GVCF,
+        {("chr10", 1500), ("chr10", 2500), ("chr10", 3000)},
+        query_fields,
+    )
+
+    # The reference block at 1000 has END=2000, so it covers 1500
+    assert genotypes[("chr10", 1500)]["posVcf"] == "1000"
+    assert genotypes[("chr10", 1500)]["zygosity"] == "0/0"
+    assert genotypes[("chr10", 3000)]["zygosity"] == "0/1"
+    assert ("chr10", 2500) not in genotypes
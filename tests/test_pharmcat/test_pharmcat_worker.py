@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+TEST_VCFS = [
+    os.path.join(
+        os.path.dirname(__file__), "preprocessed_01JWWAZ668XYVCTYW0ZNKN26CN.vcf.gz"
+    ),
+    os.path.join(
+        os.path.dirname(__file__),
+        "../../pipeline_pharmcat/lambda/pharmcat/cds_sample.preprocessed.vcf.gz",
+    ),
+]
+
+
+@pytest.fixture
+def pharmcat_worker(tmp_path, monkeypatch):
+    import pharmcat_worker
+
+    for command in ("javac", "java"):
+        if shutil.which(command) is None:
+            pytest.skip(f"{command} isn't installed")
+    if not os.path.exists(pharmcat_worker.PHARMCAT_JAR):
+        pytest.skip(f"{pharmcat_worker.PHARMCAT_JAR} isn't in the working directory")
+    # Built into the image by the Dockerfile, so compiled here for the test
+    worker_dir = tmp_path / "worker"
+    subprocess.run(
+        [
+            "javac",
+            "--release",
+            "17",
+            "-d",
+            str(worker_dir),
+            os.path.join(pharmcat_worker.WORKER_DIR, "PharmcatWorker.java"),
+        ],
+        check=True,
+    )
+    monkeypatch.setattr(pharmcat_worker, "WORKER_DIR", str(worker_dir))
+    worker = pharmcat_worker.PharmcatWorker()
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+def get_pharmcat_args(vcf, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    return [
+        "--reporter-extended",
+        "--reporter-save-json",
+        "-vcf",
+        os.path.abspath(vcf),
+        "-o",
+        str(output_dir),
+        "-bf",
+        "test",
+    ]
+
+
+def read_report(output_dir):
+    with open(output_dir / "test.report.json") as f:
+        report = json.load(f)
+    # The rest of the report holds timestamps and paths
+    return report["genes"], report["drugs"]
+
+
+def test_worker_matches_run_once(pharmcat_worker, tmp_path):
+    from pharmcat_worker import run_once
+
+    worker_pid = None
+    for i, vcf in enumerate(TEST_VCFS):
+        worker_output_dir = tmp_path / f"worker_{i}"
+        run_once_output_dir = tmp_path / f"run_once_{i}"
+        list(pharmcat_worker.run(get_pharmcat_args(vcf, worker_output_dir)))
+        # Both jobs run in the same JVM
+        assert worker_pid in (None, pharmcat_worker.process.pid)
+        worker_pid = pharmcat_worker.process.pid
+        list(run_once(get_pharmcat_args(vcf, run_once_output_dir)))
+        assert read_report(worker_output_dir) == read_report(run_once_output_dir)
+
+
+def test_worker_restarts_after_unfinished_job(pharmcat_worker, tmp_path):
+    job = pharmcat_worker.run(get_pharmcat_args(TEST_VCFS[0], tmp_path / "stopped"))
+    next(job)
+    job.close()
+    # Its unread output would otherwise be taken for the next job's
+    assert pharmcat_worker.process is None
+
+    output_dir = tmp_path / "restarted"
+    list(pharmcat_worker.run(get_pharmcat_args(TEST_VCFS[1], output_dir)))
+    assert pharmcat_worker.is_running()
+    assert os.path.exists(output_dir / "test.report.json")
+
+
+def test_worker_stopped_when_not_ready(monkeypatch):
+    import pharmcat_worker
+
+    monkeypatch.setattr(pharmcat_worker, "WORKER_READY_TIMEOUT", 1)
+    worker = pharmcat_worker.PharmcatWorker()
+    # Stands in for a JVM that never finishes loading PharmCAT
+    worker.process = subprocess.Popen(
+        [sys.executable, "-c", "import time; time.sleep(60)"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+    )
+    worker.started_at = time.perf_counter()
+    assert not worker.wait_until_ready()
+    assert worker.process is None
+    assert time.perf_counter() - worker.started_at < 30
@@ -9,6 +9,10 @@ keys = {
     "COGNITO_REGISTRATION_EMAIL_LAMBDA": "COGNITO_REGISTRATION_EMAIL_LAMBDA",
     # s3
     "PGXFLOW_BUCKET": "pgxflow-bucket",
+    "DPORTAL_BUCKET": "dportal-bucket",
+    # postprocessor
+    "GENES": "SLCO1B1,CYP2C19",
+    "ORGANISATIONS": '[{"gene": "CPIC", "drug": "CPIC Guideline Annotation"}]',
     # lambda
     "PGXFLOW_PHARMCAT_POSTPROCESSOR_LAMBDA": "PGXFLOW_PHARMCAT_POSTPROCESSOR_LAMBDA",
     "LOCAL_DIR": "./test_pharmcat/test_output",
@@ -109,6 +109,15 @@ variable "lookup_configuration" {
     chr_header            = string
     start_header          = string
     end_header            = string
+    # "rsid" or "position"; position joins match on chr/start/end, with end
+    # exclusive unless it equals start, and only fall back to rsIDs for rows
+    # without coordinates
+    join_mode = optional(string, "rsid")
+    # Column holding the alt allele of each row. Position joins without it
+    # apply each row to every alt allele at its position.
+    allele_header = optional(string, "")
+    # Bases added around each matrix region in the dbSNP subset
+    dbsnp_subset_margin = optional(number, 100)
   })
   description = "Filename and header information (chr, start, end) for the association matrix"
 }